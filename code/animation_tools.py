@@ -0,0 +1,206 @@
+import os
+import time
+import shutil
+import subprocess
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont, GifImagePlugin
+import instrumentation as instr
+
+# Frame labelling and streaming animation writers for the monthly timelines.
+# Frames are encoded as they come (GIF natively, MP4/WebP through a local ffmpeg), so only
+# one frame is in memory at a time. GIF frames are mapped onto one shared palette instead of
+# being quantised one by one, and fonts, labels and the NO DATA frame are rendered once.
+
+
+@lru_cache(maxsize=None)
+def get_font(font_path, size):
+    return ImageFont.truetype(font_path, size)
+
+
+@lru_cache(maxsize=256)
+def _label_patch(text, font_path, font_size, pad=8):
+    # white text on a black box, the box extended to the bottom of the glyphs
+    font = get_font(font_path, font_size)
+    left, top, right, bottom = font.getbbox(text)
+    width = max(right - left, right) + 2 * pad + 1
+    height = max(bottom - top, bottom) + 2 * pad + 1
+    patch = Image.new("RGB", (width, height), (0, 0, 0))
+    ImageDraw.Draw(patch).text((pad, pad), text, fill=(255, 255, 255), font=font)
+    return patch
+
+
+def draw_date_label(img, text, font_path, font_size=48, y_offset=20, pad=8):
+    # label centred at the top of the frame, pasted from the cached label patch
+    patch = _label_patch(text, font_path, font_size, pad)
+    left, _, right, _ = get_font(font_path, font_size).getbbox(text)
+    x = (img.width - (right - left)) // 2
+    img = img.convert("RGB") if img.mode != "RGB" else img.copy()
+    img.paste(patch, (x - pad, y_offset - pad))
+    return img
+
+
+@lru_cache(maxsize=16)
+def no_data_frame(frame_size, font_path, font_size=64):
+    # black frame with a centred NO DATA, rendered once per size and font (do not modify, copy first)
+    font = get_font(font_path, font_size)
+    img = Image.new("RGBA", frame_size, (0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    text = "NO DATA"
+    bbox = draw.textbbox((0, 0), text, font=font)
+    x = (img.width - (bbox[2] - bbox[0])) // 2
+    y = (img.height - (bbox[3] - bbox[1])) // 2
+    draw.text((x, y), text, fill=(255, 255, 255, 180), font=font, stroke_width=2, stroke_fill=(0, 0, 0, 200))
+    return img.convert("RGB")
+
+
+def shared_palette(images, thumb_size=(120, 100), colors=256, max_images=24):
+
+    # One palette for all frames of an animation, from a mosaic of thumbnails.
+    # images: PIL images or image paths (e.g. the monthly pngs and the NO DATA frame)
+    # thumb_size: thumbnail size in the mosaic, the palette only needs the colour distribution
+    # colors: palette size, at most 256 for GIF
+    # max_images: evenly spaced sample of the images used, each one is decoded
+    # Returns P-mode image holding the palette, for Image.quantize(palette=...)
+
+    images = list(images)
+    if len(images) > max_images:
+        step = len(images) / max_images
+        images = [images[int(i * step)] for i in range(max_images - 1)] + [images[-1]]
+    mosaic = Image.new("RGB", (thumb_size[0] * max(len(images), 1), thumb_size[1] + 2), (0, 0, 0))
+    for i, img in enumerate(images):
+        if not isinstance(img, Image.Image):
+            img = Image.open(img)
+        mosaic.paste(img.convert("RGB").resize(thumb_size, Image.Resampling.NEAREST), (i * thumb_size[0], 0))
+    # exact white and black for the labels
+    mosaic.paste((255, 255, 255), (0, thumb_size[1], mosaic.width, thumb_size[1] + 2))
+    mosaic.paste((0, 0, 0), (0, thumb_size[1], mosaic.width // 2, thumb_size[1] + 2))
+    return mosaic.quantize(colors, method=Image.Quantize.MEDIANCUT)
+
+
+class GifWriter:
+
+    def __init__(self, path, duration=600, loop=0, palette=None, dither=False):
+
+        # Streaming GIF writer, frames are encoded and written one by one.
+        # path: output gif, written to path + '.part' and renamed on close
+        # duration: frame duration in ms
+        # loop: number of loops, 0 for endless
+        # palette: P-mode image from shared_palette, None to use the palette of the first frame
+        # dither: Floyd-Steinberg dithering when mapping frames onto the palette
+
+        self.path = path
+        self.duration = duration
+        self.loop = loop
+        self.palette = palette
+        self.dither = Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE
+        self.n_frames = 0
+        self._fp = open(path + ".part", "wb")
+
+    def write(self, img):
+        img = img.convert("RGB")
+        if self.palette is None:
+            self.palette = img.quantize(256, method=Image.Quantize.MEDIANCUT)
+        frame = img.quantize(palette=self.palette, dither=self.dither)
+        if self.n_frames == 0:
+            header, _ = GifImagePlugin.getheader(frame, info={"loop": self.loop, "duration": self.duration})
+            self._fp.write(b"".join(header))
+        self._fp.write(b"".join(GifImagePlugin.getdata(frame, duration=self.duration)))
+        self.n_frames += 1
+
+    def close(self):
+        self._fp.write(b";")  # trailer
+        self._fp.close()
+        os.replace(self.path + ".part", self.path)
+
+    def abort(self):
+        self._fp.close()
+        os.remove(self.path + ".part")
+
+
+# ffmpeg output options per container
+FFMPEG_OPTIONS = {
+    ".mp4": ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-movflags", "+faststart"],
+    ".webp": ["-c:v", "libwebp_anim", "-lossless", "0", "-quality", "80", "-loop", "0"],
+}
+
+
+class FfmpegWriter:
+
+    def __init__(self, path, frame_size, duration=600, ffmpeg="ffmpeg", options=None):
+
+        # Streaming video writer piping raw RGB frames into a local ffmpeg.
+        # path: output file, .mp4 or .webp (or any container with options given)
+        # frame_size: (width, height) of every frame
+        # duration: frame duration in ms
+        # ffmpeg: ffmpeg executable name or path
+        # options: ffmpeg output options, default from FFMPEG_OPTIONS by extension
+
+        executable = shutil.which(ffmpeg)
+        if executable is None:
+            raise RuntimeError(f"{ffmpeg} not found, needed to write {os.path.basename(path)}")
+        ext = os.path.splitext(path)[1].lower()
+        if options is None:
+            if ext not in FFMPEG_OPTIONS:
+                raise ValueError(f"No ffmpeg options for {ext}, give them with options=")
+            options = FFMPEG_OPTIONS[ext]
+        self.path = path
+        self.frame_size = tuple(frame_size)
+        self.n_frames = 0
+        cmd = [executable, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+               "-s", f"{frame_size[0]}x{frame_size[1]}", "-framerate", f"{1000 / duration:g}", "-i", "-",
+               *options, "-f", ext.lstrip("."), path + ".part"]
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, img):
+        img = img.convert("RGB")
+        if img.size != self.frame_size:
+            img = img.resize(self.frame_size)
+        self._proc.stdin.write(img.tobytes())
+        self.n_frames += 1
+
+    def close(self):
+        self._proc.stdin.close()
+        error = self._proc.stderr.read().decode(errors="replace")
+        if self._proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed writing {self.path}: {error}")
+        os.replace(self.path + ".part", self.path)
+
+    def abort(self):
+        self._proc.kill()
+        self._proc.wait()
+        if os.path.exists(self.path + ".part"):
+            os.remove(self.path + ".part")
+
+
+def write_animation(frames, paths, frame_size, duration=600, palette=None, loop=0):
+
+    # Stream frames into one or more animations, each frame is encoded for all outputs before the next is made.
+    # frames: iterable of PIL images (e.g. a generator)
+    # paths: output files, .gif natively, other extensions through ffmpeg (see FFMPEG_OPTIONS)
+    # frame_size: (width, height) of the frames
+    # duration: frame duration in ms
+    # palette: shared GIF palette from shared_palette, None for the palette of the first frame
+    # Returns number of frames and seconds spent
+
+    t0 = time.perf_counter()
+    writers = []
+    try:
+        for path in paths:
+            if path.lower().endswith(".gif"):
+                writers.append(GifWriter(path, duration=duration, loop=loop, palette=palette))
+            else:
+                writers.append(FfmpegWriter(path, frame_size, duration=duration))
+        n_frames = 0
+        for img in frames:
+            for writer in writers:
+                writer.write(img)
+            n_frames += 1
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    for writer in writers:
+        writer.close()
+        instr.count("animation.bytes_written", os.path.getsize(writer.path))
+    instr.count("animation.frames", n_frames)
+    return n_frames, time.perf_counter() - t0
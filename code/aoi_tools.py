@@ -0,0 +1,101 @@
+import hashlib
+import numpy as np
+import geopandas as gpd
+import shapely
+
+# AOI point clipping shared by the downloader (lon/lat) and the gridding code (UTM).
+# Only depends on numpy/shapely/geopandas so it can be used in both environments.
+
+
+class AOIClipper:
+
+    def __init__(self, aoi: gpd.GeoDataFrame, crs=None, simplify_tolerance: float | None = None, cell_size: float | None = None):
+
+        # aoi: area of interest polygons
+        # crs: crs of the points to clip, the AOI is reprojected to it (default: AOI crs)
+        # simplify_tolerance: simplify the AOI outline by this distance (crs units) before testing
+        # cell_size: if given, rasterise the AOI into cells of this size (crs units). Points in cells
+        #            fully inside/outside the AOI are decided by lookup, only points in boundary
+        #            cells are tested against the polygon, so results are exact.
+
+        if crs is not None:
+            aoi = aoi.to_crs(crs)
+        self.crs = aoi.crs
+
+        geom = shapely.union_all(aoi.geometry.values)
+        if simplify_tolerance:
+            geom = shapely.simplify(geom, simplify_tolerance)
+        shapely.prepare(geom)
+        self.geom = geom
+        self.bounds = geom.bounds  # (minx, miny, maxx, maxy)
+
+        self.cell_size = cell_size
+        self.cell_state = None
+        if cell_size:
+            self._rasterise(cell_size)
+
+    def _rasterise(self, cell_size):
+        # cell state: 0 outside, 1 inside, 2 boundary
+        minx, miny, maxx, maxy = self.bounds
+        nx = max(1, int(np.ceil((maxx - minx) / cell_size)))
+        ny = max(1, int(np.ceil((maxy - miny) / cell_size)))
+        x0 = minx + cell_size * np.arange(nx)
+        y0 = miny + cell_size * np.arange(ny)
+        X0, Y0 = np.meshgrid(x0, y0)
+        boxes = shapely.box(X0.ravel(), Y0.ravel(), X0.ravel() + cell_size, Y0.ravel() + cell_size)
+
+        state = np.zeros(boxes.size, dtype=np.uint8)
+        state[shapely.intersects(self.geom, boxes)] = 2
+        state[shapely.contains_properly(self.geom, boxes)] = 1
+        self.cell_state = state.reshape(ny, nx)
+
+    def bbox_mask(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        minx, miny, maxx, maxy = self.bounds
+        return (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)
+
+    def mask(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        # boolean mask of points intersecting the AOI (same as gpd.clip keeping them)
+        # prepared state does not survive pickling to worker processes, re-preparing is a no-op otherwise
+        shapely.prepare(self.geom)
+        x = np.asarray(x)
+        y = np.asarray(y)
+        mask = self.bbox_mask(x, y)
+        idx = np.flatnonzero(mask)
+        if idx.size == 0:
+            return mask
+
+        xi = x[idx]
+        yi = y[idx]
+        if self.cell_state is None:
+            mask[idx] = shapely.intersects_xy(self.geom, xi, yi)
+            return mask
+
+        ny, nx = self.cell_state.shape
+        col = np.minimum(((xi - self.bounds[0]) // self.cell_size).astype(np.int64), nx - 1)
+        row = np.minimum(((yi - self.bounds[1]) // self.cell_size).astype(np.int64), ny - 1)
+        state = self.cell_state[row, col]
+
+        inside = state == 1
+        boundary = np.flatnonzero(state == 2)
+        inside[boundary] = shapely.intersects_xy(self.geom, xi[boundary], yi[boundary])
+        mask[idx] = inside
+        return mask
+
+    def clip(self, df, x: str = "lon", y: str = "lat"):
+        # subset of a (Geo)DataFrame whose x/y columns fall in the AOI
+        return df[self.mask(df[x].to_numpy(), df[y].to_numpy())]
+
+
+def points_to_gdf(df, x: str = "lon", y: str = "lat", crs="EPSG:4326") -> gpd.GeoDataFrame:
+    # build point geometries, call after clipping so only survivors get geometry objects
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[x].to_numpy(), df[y].to_numpy()), crs=crs)
+
+
+def aoi_hash(aoi: gpd.GeoDataFrame = None) -> str:
+    # hash of the AOI crs and geometry, identifies products derived from an AOI
+    if aoi is None:
+        return "none"
+    h = hashlib.sha256(str(aoi.crs).encode())
+    for wkb in aoi.geometry.to_wkb():
+        h.update(wkb)
+    return h.hexdigest()
@@ -0,0 +1,175 @@
+import os
+import json
+import numpy as np
+import rasterio
+import raster_io as rio
+import instrumentation as instr
+
+# Block-windowed temporal compositing of co-registered scenes (e.g. the Sentinel-2 exports of
+# one month). The output is processed block by block: each block is read from every scene,
+# reduced over time and written to the output COG (raster_io.CogWriter), so memory is bounded by
+# block size x scene count instead of the whole stack. Blocks run on a thread pool
+# (rasterio releases the GIL while reading), writes happen on the calling thread.
+#
+# Each composite records the scenes it was made from (path, size and mtime) in a 'scenes' tag, so
+# callers can recompute a month when a scene is added, removed or re-exported (see recorded_scenes).
+
+
+def _sorted_valid(stack):
+    # stack sorted along time (NaN last) and the number of valid values per pixel
+    return np.sort(stack, axis=0), np.count_nonzero(~np.isnan(stack), axis=0)
+
+
+def _take(sorted_stack, i):
+    return np.take_along_axis(sorted_stack, np.maximum(i, 0)[None], axis=0)[0]
+
+
+def reduce_median(stack):
+    # same result as np.nanmedian(stack, axis=0) from one sort, np.nanmedian falls back to a
+    # slow masked-array path when there are NaNs
+    s, n = _sorted_valid(stack)
+    out = (_take(s, (n - 1) // 2) + _take(s, n // 2)) / 2
+    out[n == 0] = np.nan
+    return out
+
+
+def reduce_percentile(stack, q):
+    # same result as np.nanpercentile(stack, q, axis=0) (linear method), which loops over pixels in python
+    s, n = _sorted_valid(stack)
+    pos = (np.maximum(n, 1) - 1) * (q / 100)
+    lo = np.floor(pos).astype(np.int64)
+    t = pos - lo
+    a = _take(s, lo)
+    b = _take(s, np.minimum(lo + 1, np.maximum(n, 1) - 1))
+    # numpy's lerp, interpolating from the nearer end with the weights rounded to the stack dtype
+    diff = b - a
+    out = np.where(t >= 0.5, b - diff * (1 - t).astype(s.dtype), a + diff * t.astype(s.dtype))
+    out[n == 0] = np.nan
+    return out
+
+
+def reduce_mean(stack):
+    return np.nanmean(stack, axis=0)
+
+
+def reduce_medoid(stack):
+    # per pixel, the observation (all bands) with the smallest summed Euclidean distance to the
+    # other valid observations; observations with any NaN band are ignored
+    n = stack.shape[0]
+    valid = ~np.isnan(stack).any(axis=1)
+    cost = np.zeros((n,) + stack.shape[2:], dtype=np.float64)
+    for i in range(n):
+        for j in range(i + 1, n):
+            d = np.sqrt(np.sum((stack[i] - stack[j]) ** 2, axis=0, dtype=np.float64))
+            both = valid[i] & valid[j]
+            cost[i] += np.where(both, d, 0)
+            cost[j] += np.where(both, d, 0)
+    cost[~valid] = np.inf
+    best = np.argmin(cost, axis=0)
+    out = np.take_along_axis(stack, best[None, None], axis=0)[0]
+    out[:, ~valid.any(axis=0)] = np.nan
+    return out
+
+
+def get_reducer(reducer):
+    # reducer: 'median', 'mean', 'medoid', 'p<q>' (e.g. 'p25') or a function of an (N, bands, h, w) block
+    if callable(reducer):
+        return reducer
+    if reducer == "median":
+        return reduce_median
+    if reducer == "mean":
+        return reduce_mean
+    if reducer == "medoid":
+        return reduce_medoid
+    if reducer.startswith("p"):
+        q = float(reducer[1:])
+        return lambda stack: reduce_percentile(stack, q)
+    raise ValueError(f"Unknown reducer: {reducer}")
+
+
+def _usable_scenes(files):
+    # scenes with the shape of the first readable scene, and the profile of that scene
+    scenes = []
+    meta = None
+    for f in files:
+        try:
+            with rasterio.open(f) as src:
+                if meta is None:
+                    meta = src.meta.copy()
+                    ref_shape = (src.count, src.height, src.width)
+                if (src.count, src.height, src.width) != ref_shape:
+                    print(f"    Skipping (shape mismatch): {os.path.basename(f)} "
+                          f"{(src.count, src.height, src.width)} != {ref_shape}")
+                    continue
+            scenes.append(f)
+        except Exception:
+            print(f"    Skipping (read error): {os.path.basename(f)}")
+    return scenes, meta
+
+
+class _SceneReader:
+
+    def __init__(self, scenes):
+        instr.count("composite.scenes_read", len(scenes))
+        self.datasets = rio.ThreadDatasets(scenes)
+
+    def read(self, window):
+        # (scenes, bands, h, w) float32 stack of one block
+        return np.stack([src.read(window=window).astype(np.float32) for src in self.datasets.get()], axis=0)
+
+    def close(self):
+        self.datasets.close()
+
+
+@instr.timed
+def composite_scenes(files, out_tif, reducer="median", block_size=512, n_threads=4, compress="lzw",
+                     encoding="float32", scale=1.0, offset=0.0):
+
+    # files: scenes to composite, scenes with a shape different from the first readable scene are skipped
+    # out_tif: output COG (tiled, with overviews) on the grid of the first scene, with the signatures
+    #          of all files in its 'scenes' tag (see recorded_scenes)
+    # reducer: temporal reducer, see get_reducer
+    # block_size: block edge in pixels (multiple of 16), memory is ~ block_size^2 x bands x scenes x 4 bytes per thread
+    # n_threads: number of blocks processed in parallel
+    # encoding, scale, offset: band encoding of the composite, 'float32' or 'int16' stored as
+    #                          (value - offset) / scale, see raster_io
+    # Returns list of the scenes used
+
+    reduce = get_reducer(reducer)
+    scenes, meta = _usable_scenes(files)
+    if not scenes:
+        return scenes
+    reader = _SceneReader(scenes)
+
+    def process(window):
+        return window, reduce(reader.read(window)).astype(np.float32)
+
+    count = meta["count"]
+    dst = rio.CogWriter(out_tif, meta["height"], meta["width"], count, meta["crs"], meta["transform"],
+                        encoding=encoding, scales=[scale] * count, offsets=[offset] * count, blocksize=block_size,
+                        compress=compress, tags={"scenes": json.dumps({f: scene_signature(f) for f in files})})
+    try:
+        def write(result):
+            window, data = result
+            dst.write(data, window=window)
+        rio.run_blocks(rio.block_windows(meta["height"], meta["width"], block_size), process, write, n_threads)
+    except BaseException:
+        dst.abort()
+        raise
+    finally:
+        reader.close()
+    dst.close()
+    return scenes
+
+
+def scene_signature(path):
+    # [size, mtime] of a scene file, a changed signature means the scene was re-exported
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def recorded_scenes(out_tif):
+    # {scene path: signature} a composite was made from, None for composites without the tag
+    with rasterio.open(out_tif) as src:
+        scenes = src.tags().get("scenes")
+    return None if scenes is None else json.loads(scenes)
@@ -0,0 +1,15 @@
+import glob
+import pixc_io
+
+# One-shot conversion of the trimmed GeoJSON archive (*_trimmed.geojson) to GeoParquet (*_trimmed.parquet).
+# Run once before using download_pixc.py / generate_pixc_raster.py with parquet output.
+
+
+########### ----------------------- USER INPUT ----------------------- ###########
+trimmed_filelist = glob.glob("C:\\Users\\safr\\Documents\\test_altimetry_project\\data\\swot\\PIXC\\*_trimmed.geojson")
+remove_geojson_flag = False  # set to True to delete the GeoJSON files once converted
+
+
+########### ----------------------- Convert ----------------------- ###########
+written = pixc_io.convert_geojson_archive(trimmed_filelist, remove_geojson=remove_geojson_flag)
+print(f"Converted {len(written)} of {len(trimmed_filelist)} files.")
@@ -0,0 +1,109 @@
+import hashlib
+from functools import lru_cache
+import numpy as np
+import geopandas as gpd
+import shapely
+from pyproj import CRS, Transformer
+
+# Point coordinates as NumPy arrays, without geometry objects.
+# Trimmed PIXC points carry lon/lat columns; they are projected once with a cached pyproj
+# Transformer and the result is stored as x/y columns named after the crs (e.g. x_32737, y_32737),
+# so later gridding, clipping and raster sampling in that crs read the columns instead of
+# reprojecting or building shapely points. Projecting to the crs the points are already in is a no-op.
+
+WGS84 = "EPSG:4326"
+
+
+def _crs(crs):
+    return CRS.from_user_input(crs)
+
+
+def _srs(crs):
+    # cache key of a crs, strings are not parsed
+    if isinstance(crs, str):
+        return crs
+    return _crs(crs).srs
+
+
+@lru_cache(maxsize=64)
+def _same_crs(src, dst):
+    return src == dst or _crs(src).equals(_crs(dst), ignore_axis_order=True)
+
+
+def same_crs(src, dst):
+    # whether two crs (anything pyproj accepts) are the same, cached
+    return _same_crs(_srs(src), _srs(dst))
+
+
+@lru_cache(maxsize=64)
+def _transformer(src, dst):
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+
+def get_transformer(src, dst):
+    # cached always_xy Transformer from src to dst, one per crs pair and process
+    return _transformer(_srs(src), _srs(dst))
+
+
+@lru_cache(maxsize=64)
+def _xy_columns(srs):
+    crs = _crs(srs)
+    code = crs.to_epsg()
+    if code is None:
+        code = hashlib.sha1(crs.to_wkt().encode()).hexdigest()[:8]
+    return f"x_{code}", f"y_{code}"
+
+
+def xy_columns(crs):
+    # names of the stored projected coordinate columns of crs, e.g. ('x_32737', 'y_32737')
+    return _xy_columns(_srs(crs))
+
+
+def transform_xy(x, y, src, dst):
+    # x, y arrays from crs src to crs dst, returned unchanged if the crs are the same
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if same_crs(src, dst):
+        return x, y
+    return get_transformer(src, dst).transform(x, y)
+
+
+def get_xy(points, crs):
+
+    # x, y arrays of points in crs, in order of preference:
+    # stored x/y columns of crs (see add_xy), the geometry of a GeoDataFrame, the lon/lat columns
+    # points: DataFrame with lon/lat columns (e.g. read with geometry=False) or GeoDataFrame in any crs
+    # Returns one x, y per row, NaN for missing or empty point geometries (outside any grid)
+
+    x_col, y_col = xy_columns(crs)
+    if x_col in points and y_col in points:
+        return points[x_col].to_numpy(), points[y_col].to_numpy()
+    if isinstance(points, gpd.GeoDataFrame) and points.active_geometry_name is not None:
+        geometry = np.asarray(points.geometry.values)
+        valid = ~(shapely.is_missing(geometry) | shapely.is_empty(geometry))
+        x = np.full(len(geometry), np.nan)
+        y = np.full(len(geometry), np.nan)
+        x[valid] = shapely.get_x(geometry[valid])
+        y[valid] = shapely.get_y(geometry[valid])
+        return transform_xy(x, y, points.crs, crs)
+    if "lon" in points and "lat" in points:
+        return transform_xy(points["lon"].to_numpy(), points["lat"].to_numpy(), WGS84, crs)
+    raise ValueError("Points need a geometry, lon/lat columns or stored x/y columns")
+
+
+def add_xy(points, crs):
+    # store the coordinates of points in crs as x/y columns (in place), no-op if they are stored already
+    # Returns points
+    x_col, y_col = xy_columns(crs)
+    if x_col not in points or y_col not in points:
+        x, y = get_xy(points, crs)
+        points[x_col] = x
+        points[y_col] = y
+    return points
+
+
+def projected_crs(aoi: gpd.GeoDataFrame):
+    # crs of the AOI if projected, else the UTM zone of its centre
+    if aoi.crs is not None and aoi.crs.is_projected:
+        return aoi.crs
+    return aoi.estimate_utm_crs()
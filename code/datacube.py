@@ -0,0 +1,195 @@
+import os
+import datetime
+import numpy as np
+import pandas as pd
+import netCDF4
+import rasterio
+import eo_tools as eot
+import raster_io as rio
+from grid_spec import GridSpec
+
+# Chunked (time, y, x) NetCDF4 datacube of the gridded SWOT products, one variable per band
+# ('heightEGM_median', ..., 'count') and one time step per date, on one GridSpec.
+# Dates are appended as they are processed. Chunks of time_chunk dates x space_chunk^2 cells
+# keep map reads (one date) and per-pixel time series (all dates of a few cells) to a few
+# chunk reads each. Time series for many points/buffers come from one windowed read per
+# point (or one read of their common bounding box) instead of one file open per point and date.
+# The file is CF-style (x/y/time coordinates, crs variable), so xarray and GDAL can open it too.
+
+
+class RasterCube:
+
+    def __init__(self, path, mode="r"):
+
+        # path: .nc datacube created with RasterCube.create
+        # mode: 'r' to read, 'a' to append dates
+
+        self.path = path
+        self.ds = netCDF4.Dataset(path, mode)
+        self.ds.set_auto_mask(False)
+        self.grid = GridSpec(self.ds.x0, self.ds.y0, self.ds.resolution, self.ds.nx, self.ds.ny, self.ds.crs_wkt)
+        self.bands = [name for name, var in self.ds.variables.items() if var.dimensions == ("time", "y", "x")]
+        self._dates = None
+
+    @classmethod
+    def create(cls, path, grid: GridSpec, bands, time_chunk=8, space_chunk=128, complevel=4):
+
+        # path: output .nc file
+        # grid: grid of all dates
+        # bands: band names, e.g. ['heightEGM_median', 'count'] (see eo_tools.grid_sampling_multi)
+        # time_chunk, space_chunk: chunk size along time and along x/y
+        # complevel: zlib compression level
+
+        ds = netCDF4.Dataset(path, "w", format="NETCDF4")
+        for name, value in grid.to_dict().items():
+            ds.setncattr("crs_wkt" if name == "crs" else name, value)
+        ds.Conventions = "CF-1.8"
+
+        ds.createDimension("time", None)
+        ds.createDimension("y", grid.ny)
+        ds.createDimension("x", grid.nx)
+        x_centres, y_centres = grid.cell_centres()
+        x = ds.createVariable("x", "f8", ("x",))
+        x[:] = x_centres
+        x.standard_name = "projection_x_coordinate"
+        y = ds.createVariable("y", "f8", ("y",))
+        y[:] = y_centres
+        y.standard_name = "projection_y_coordinate"
+        time = ds.createVariable("time", "i4", ("time",))
+        time.units = "days since 1970-01-01"
+        time.calendar = "standard"
+
+        crs = ds.createVariable("spatial_ref", "i4")
+        crs.crs_wkt = grid.crs.to_wkt()
+        crs.spatial_ref = grid.crs.to_wkt()
+        crs.GeoTransform = " ".join(str(v) for v in grid.transform.to_gdal())
+
+        chunks = (time_chunk, min(space_chunk, grid.ny), min(space_chunk, grid.nx))
+        for band in bands:
+            var = ds.createVariable(band, "f4", ("time", "y", "x"), zlib=True, complevel=complevel, shuffle=True,
+                                    chunksizes=chunks, fill_value=np.float32(np.nan))
+            var.grid_mapping = "spatial_ref"
+        ds.close()
+        return cls(path, mode="a")
+
+    @classmethod
+    def open(cls, path, grid: GridSpec = None, bands=None, **kwargs):
+        # open an existing cube for appending, or create it with grid/bands if it does not exist
+        if os.path.exists(path):
+            cube = cls(path, mode="a")
+            if grid is not None and not cube.grid.same_grid(grid):
+                raise ValueError(f"{path} is on a different grid: {cube.grid}")
+            return cube
+        return cls.create(path, grid, bands, **kwargs)
+
+    @property
+    def dates(self):
+        # dates of the time steps in storage order
+        if self._dates is None:
+            days = self.ds.variables["time"][:]
+            self._dates = [datetime.date(1970, 1, 1) + datetime.timedelta(days=int(d)) for d in days]
+        return self._dates
+
+    def append(self, date, bands: dict):
+
+        # date: date of the grids, a date already in the cube is overwritten
+        # bands: {band name: north-up (ny, nx) raster}, bands of the cube not given are left NaN
+
+        date = pd.Timestamp(date).date()
+        if date in self.dates:
+            i = self.dates.index(date)
+        else:
+            i = len(self.dates)
+            self.ds.variables["time"][i] = (date - datetime.date(1970, 1, 1)).days
+            self._dates = None
+        for name, raster in bands.items():
+            if raster.shape != self.grid.shape:
+                raise ValueError(f"Band {name} has shape {raster.shape}, cube grid is {self.grid.shape}")
+            self.ds.variables[name][i, :, :] = raster.astype(np.float32)
+        self.ds.sync()
+
+    def append_geotiff(self, raster_file, date):
+        # add a multi-band GeoTIFF written by eo_tools.grid_sampling_multi (bands read by description)
+        with rasterio.open(raster_file) as src:
+            if not GridSpec.from_raster(raster_file).same_grid(self.grid):
+                raise ValueError(f"{raster_file} is not on the cube grid")
+            bands = {name: rio.read_scaled(src, i) for i, name in enumerate(src.descriptions, start=1) if name in self.bands}
+        self.append(date, bands)
+
+    def read_map(self, band, date):
+        # north-up raster of one band at one date
+        return self.ds.variables[band][self.dates.index(pd.Timestamp(date).date()), :, :].astype(np.float64)
+
+    def time_series(self, x, y, bands=('heightEGM_median',), buffer: float = 0.0, ids=None, max_block_cells=4_000_000):
+
+        # Time series of many points in one pass.
+        # x, y: point coordinates in the cube crs
+        # bands: bands to extract
+        # buffer: half-width (crs units) of the square window averaged around each point, 0 for the pixel value
+        #         (GridSpec.window_cells)
+        # ids: point identifiers (default 0..n-1)
+        # max_block_cells: read the bounding box of all windows over all dates at once when it is at most
+        #                  this many values (cells x dates, 4 bytes each), otherwise read one window per point
+        # Returns tidy DataFrame with columns id, date, band, value (NaN-ignoring window mean), n_valid,
+        # sorted by id, band and date. Points outside the grid get NaN.
+
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        n_points = len(x)
+        ids = np.arange(n_points) if ids is None else np.asarray(ids)
+        point, rows, cols = self.grid.window_cells(x, y, buffer=buffer)
+
+        order = np.argsort(self.ds.variables["time"][:], kind="stable")
+        dates = pd.to_datetime(np.array(self.dates)[order])
+        n_dates = len(dates)
+
+        # one block covering all windows if small enough, otherwise one block per point
+        if rows.size and (np.ptp(rows) + 1) * (np.ptp(cols) + 1) * n_dates <= max_block_cells:
+            blocks = [np.arange(rows.size)]
+        else:
+            blocks = np.split(np.arange(rows.size), np.flatnonzero(np.diff(point)) + 1) if rows.size else []
+
+        frames = []
+        for band in bands:
+            var = self.ds.variables[band]
+            sums = np.zeros((n_dates, n_points))
+            n_valid = np.zeros((n_dates, n_points), dtype=np.int64)
+            for cells in blocks:
+                r, c = rows[cells], cols[cells]
+                block = var[:, r.min():r.max() + 1, c.min():c.max() + 1]
+                # window cells first, so only they are copied into date order
+                values = block[:, r - r.min(), c - c.min()][order].astype(np.float64)
+                valid = ~np.isnan(values)
+                np.add.at(sums.T, point[cells], np.where(valid, values, 0).T)
+                np.add.at(n_valid.T, point[cells], valid.T)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                means = sums / n_valid
+            frames.append(pd.DataFrame({
+                "id": np.repeat(ids, n_dates),
+                "date": np.tile(dates, n_points),
+                "band": band,
+                "value": means.T.ravel(),
+                "n_valid": n_valid.T.ravel(),
+            }))
+        return pd.concat(frames, ignore_index=True).sort_values(["id", "band", "date"], kind="stable").reset_index(drop=True)
+
+    def export_geotiffs(self, out_dir, bands=None, dates=None, filename="{date}_res{resolution:g}_multiband.tif"):
+
+        # Write one multi-band GeoTIFF per date, for GIS users.
+        # bands: bands to write (default all), dates: dates to write (default all)
+        # filename: pattern with {date} and {resolution}
+        # Returns list of written files
+
+        bands = list(bands or self.bands)
+        dates = self.dates if dates is None else [pd.Timestamp(d).date() for d in dates]
+        written = []
+        for date in dates:
+            i = self.dates.index(date)
+            rasters = {band: self.ds.variables[band][i, :, :].astype(np.float64) for band in bands}
+            path = os.path.join(out_dir, filename.format(date=date, resolution=self.grid.resolution))
+            eot.write_multiband_geotiff(path, rasters, self.grid.transform, self.grid.crs)
+            written.append(path)
+        return written
+
+    def close(self):
+        self.ds.close()
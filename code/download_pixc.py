@@ -5,6 +5,7 @@ import xarray as xr
 import numpy as np
 import os
 import swot_download_tools as sdt
+import instrumentation as instr
 
 
 
@@ -15,6 +16,11 @@ temporal_range = ('2023-06-26 00:00:00', '2026-01-19 23:59:59')
 product_id = 'SWOT_L2_HR_PIXC_D'  # SWOT_L2_HR_PIXC_2.0 for version C, SWOT_L2_HR_PIXC_D for version D - not available on earthdata search as of Dec 1 2025 for some reason??
 classes = ['open_water','water_near_land']  # options: 'land', 'land_near_water', 'water_near_land', 'open_water', 'dark_water', 'low_coh_water_near_land', 'open_low_coh_water'
 redownload_flag = False  # set to True to redownload files even if they already exist in the download path
+n_downloads = 4  # number of concurrent downloads
+n_workers = 4  # number of processes trimming downloaded granules
+max_raw_files = 8  # max number of raw .nc files on disk at once
+instrument_flag = False  # record time, memory and counters of every stage, saved as run_report_<time>.json/.csv
+trace_memory_flag = False  # also trace the peak python/numpy memory of every stage (slower)
 
 # Paths
 shapefile_path = "C:\\Users\\safr\\Documents\\test_altimetry_project\\shapefiles\\wetland_fans_domain_37S.shp"
@@ -24,17 +30,30 @@ download_path = "C:\\Users\\safr\\Documents\\test_altimetry_project\\data\\swot\
 ########### ----------------------- Download pixc data, trim, save to folder ----------------------- ###########
 
 
-wetland_utm = gpd.read_file(shapefile_path)
-wetland_ll = wetland_utm.to_crs("EPSG:4326")
-
-auth = earthaccess.login() 
-bbox = wetland_ll.total_bounds
-results = earthaccess.search_data(short_name = product_id, 
-                                  temporal = temporal_range,
-                                   bounding_box = tuple(bbox) 
-                                  )
-
-granule_list = list(results)
-print(f"Total granules found: {len(granule_list)}")
-
-sdt.download_granule_list(granule_list, download_path, aoi=wetland_ll, classes=classes, redownload=redownload_flag)
\ No newline at end of file
+# guard needed as trim workers run in separate processes
+if __name__ == "__main__":
+    if instrument_flag:
+        instr.enable(trace_memory=trace_memory_flag)
+    wetland_utm = gpd.read_file(shapefile_path)
+    wetland_ll = wetland_utm.to_crs("EPSG:4326")
+
+    auth = earthaccess.login() 
+    bbox = wetland_ll.total_bounds
+    results = earthaccess.search_data(short_name = product_id, 
+                                      temporal = temporal_range,
+                                       bounding_box = tuple(bbox) 
+                                      )
+
+    granule_list = list(results)
+    print(f"Total granules found: {len(granule_list)}")
+
+    failed = sdt.download_granule_list(granule_list, download_path, aoi=wetland_ll, classes=classes, redownload=redownload_flag,
+                                       n_downloads=n_downloads, n_workers=n_workers, max_raw_files=max_raw_files)
+    print(f"Failed granules: {len(failed)}")
+    for filename, error in failed.items():
+        print(f"  {filename}: {error}")
+    if instrument_flag:
+        print(instr.summary().to_string())
+        print(instr.counters())
+        json_path, _ = instr.write_report(instr.report_path(download_path))
+        print(f"Saved run report: {json_path}")
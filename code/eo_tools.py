@@ -1,34 +1,109 @@
 
 import geopandas as gpd
 import os
+import re
 import datetime
+import threading
 import pandas as pd
 import shapely
 import numpy as np
 import matplotlib.pyplot as plt
 import rasterio
+from rasterio import features
+from rasterio.windows import Window
 from scipy.stats import binned_statistic_2d
-from rasterio.transform import from_origin
-
-
-
-def load_trimmed_pixc_data(trimmed_filelist):
-    gdf_pixc_all = gpd.GeoDataFrame()
-    for trimmed_file in trimmed_filelist:
-        # check file size - skip if 0 bytes
-        if os.path.getsize(trimmed_file) < 10000:  # less than 10 KB
-            print(f"Skipping empty file: {trimmed_file}")
-            continue
-
+from concurrent.futures import ThreadPoolExecutor
+from aoi_tools import AOIClipper, aoi_hash, points_to_gdf
+from grid_spec import GridSpec, bin_index
+from pixc_io import read_trimmed_pixc, trimmed_point_count
+import raster_io as rio
+import coords
+import instrumentation as instr
+
+
+
+def read_trimmed_file(trimmed_file, columns=None, geometry=True, downcast=False):
+    # trimmed_file: *_trimmed.parquet (or legacy *_trimmed.geojson) file
+    # columns: columns to read from parquet files, None for all
+    # geometry: whether to build point geometries (parquet only)
+    # downcast: float attributes to float32 and class to categorical
+    # Returns points indexed by acquisition date, None if the file is empty
+
+    # skip empty files
+    if trimmed_point_count(trimmed_file) == 0:
+        print(f"Skipping empty file: {trimmed_file}")
+        return None
+
+    if trimmed_file.endswith(".parquet"):
+        read_columns = None if columns is None else list(dict.fromkeys(list(columns) + ["time"]))
+        gdf_temp = read_trimmed_pixc(trimmed_file, columns=read_columns, geometry=geometry)
+        gdf_temp = gdf_temp.rename(columns={"time": "date"})
+    else:
         str_date = os.path.basename(trimmed_file).split("_")[-4]
         # parse yyyymmddThhmmss to datetime
         t = datetime.datetime.strptime(str_date, "%Y%m%dT%H%M%S")
-        gdf_temp = gpd.read_file(trimmed_file)
+        gdf_temp = gpd.read_file(trimmed_file, columns=columns)
         gdf_temp['date'] = t
-        # set index to date
-        gdf_temp = gdf_temp.set_index('date')
-        gdf_pixc_all = pd.concat([gdf_pixc_all, gdf_temp])
-    
+
+    if downcast:
+        for column in gdf_temp.columns:
+            if column in ("lat", "lon"):
+                continue
+            if gdf_temp[column].dtype == np.float64:
+                gdf_temp[column] = gdf_temp[column].astype(np.float32)
+        if "class" in gdf_temp:
+            gdf_temp["class"] = gdf_temp["class"].astype("category")
+
+    # set index to date
+    return gdf_temp.set_index('date')
+
+
+def iter_trimmed_pixc_data(trimmed_filelist, files_per_chunk=50, columns=None, geometry=True, downcast=False, n_threads=8,
+                           xy_crs=None):
+    # Lazily yield the points of files_per_chunk files at a time, files of a chunk are read in parallel.
+    # Keeps memory bounded for aggregates over many granules.
+    # xy_crs: also store the coordinates in this crs as x/y columns, see load_trimmed_pixc_data
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for i in range(0, len(trimmed_filelist), files_per_chunk):
+            chunk_files = trimmed_filelist[i:i + files_per_chunk]
+            frames = pool.map(lambda f: read_trimmed_file(f, columns=columns, geometry=geometry, downcast=downcast), chunk_files)
+            frames = [frame for frame in frames if frame is not None]
+            if frames:
+                gdf = _concat_frames(frames)
+                yield gdf if xy_crs is None else coords.add_xy(gdf, xy_crs)
+
+
+@instr.timed
+def load_trimmed_pixc_data(trimmed_filelist, columns=None, geometry=True, downcast=False, n_threads=8, xy_crs=None):
+    # trimmed_filelist: *_trimmed.parquet (or legacy *_trimmed.geojson) files
+    # columns: columns to read from parquet files, None for all
+    # geometry: whether to build point geometries (parquet only)
+    # downcast: float attributes to float32 and class to categorical
+    # n_threads: number of files read in parallel
+    # xy_crs: also store the coordinates in this crs (e.g. the UTM crs of the AOI) as x/y columns,
+    #         projected from lon/lat in one call; gridding and sampling in that crs then use them
+    #         and need no geometry (see coords)
+    # Files are read on a thread pool and concatenated once, in the order of trimmed_filelist.
+    # Use iter_trimmed_pixc_data to get the points in chunks instead of one frame.
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        frames = pool.map(lambda f: read_trimmed_file(f, columns=columns, geometry=geometry, downcast=downcast), trimmed_filelist)
+        frames = [frame for frame in frames if frame is not None]
+
+    if not frames:
+        return gpd.GeoDataFrame()
+    gdf = _concat_frames(frames)
+    instr.count("points.loaded", len(gdf))
+    if xy_crs is not None:
+        with instr.stage("load_trimmed_pixc_data.project"):
+            coords.add_xy(gdf, xy_crs)
+    return gdf
+
+
+def _concat_frames(frames):
+    gdf_pixc_all = pd.concat(frames)
+    if "class" in gdf_pixc_all and isinstance(frames[0]["class"].dtype, pd.CategoricalDtype):
+        # categories differ between files, concat falls back to object
+        gdf_pixc_all["class"] = gdf_pixc_all["class"].astype("category")
     return gdf_pixc_all
 
 def grid_from_shp(shapefile_utm: gpd.GeoDataFrame, grid_size: float, buffer: float = 0.0, plotFlag=False) -> gpd.GeoDataFrame:
@@ -60,7 +135,62 @@ def grid_from_shp(shapefile_utm: gpd.GeoDataFrame, grid_size: float, buffer: flo
     return x_coords_flat, y_coords_flat
 
 
-def plot_hist_map(gdf_date, field, shapefile_ll, date, outdir):
+# AOI backgrounds of plot_hist_map maps, rendered once per (AOI, extent, image shape) and reused across dates
+_map_backgrounds = {}
+
+
+def _map_background(shapefile_ll, extent, shape, color=(211, 211, 211, 255)):
+    # RGBA image of the AOI polygons (lightgrey) on a transparent background
+    key = (aoi_hash(shapefile_ll), extent, shape)
+    if key not in _map_backgrounds:
+        transform = rasterio.transform.from_bounds(*extent, width=shape[1], height=shape[0])
+        inside = features.rasterize(((g, 1) for g in shapefile_ll.geometry), out_shape=shape, transform=transform,
+                                    dtype=np.uint8)
+        image = np.zeros(shape + (4,), dtype=np.uint8)
+        image[inside == 1] = color
+        _map_backgrounds[key] = image
+    return _map_backgrounds[key]
+
+
+def render_points(x, y, values, extent, shape, vmin, vmax, cmap="viridis", background=None):
+
+    # Rasterise points straight into an RGBA image: points are binned into the image pixels,
+    # the mean value of each pixel is coloured through a 256-colour lookup table.
+    # x, y, values: point coordinates and values
+    # extent: (minx, miny, maxx, maxy) of the image
+    # shape: (rows, cols) of the image
+    # vmin, vmax: value range of the colour map
+    # background: RGBA image shown where there are no points (not modified)
+    # Returns (rows, cols, 4) uint8 image
+
+    minx, miny, maxx, maxy = extent
+    rows, cols = shape
+    with np.errstate(invalid="ignore"):
+        col = np.floor((x - minx) / (maxx - minx) * cols)
+        row = np.floor((maxy - y) / (maxy - miny) * rows)
+    inside = (col >= 0) & (col < cols) & (row >= 0) & (row < rows) & np.isfinite(values)
+    idx = row[inside].astype(np.int64) * cols + col[inside].astype(np.int64)
+    count = np.bincount(idx, minlength=rows * cols)
+    total = np.bincount(idx, weights=values[inside], minlength=rows * cols)
+    hit = count > 0
+
+    lut = (plt.get_cmap(cmap)(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+    scale = 255 / (vmax - vmin) if vmax > vmin else 0.0
+    level = np.clip((total[hit] / count[hit] - vmin) * scale, 0, 255).astype(np.uint8)
+    image = np.zeros(shape + (4,), dtype=np.uint8) if background is None else background.copy()
+    image.reshape(-1, 4)[hit] = lut[level]
+    return image
+
+
+@instr.timed
+def plot_hist_map(gdf_date, field, shapefile_ll, date, outdir, method="raster", dpi=300, point_px=None):
+
+    # Histogram of field and map of the points coloured by field, saved as {outdir}{date}.png
+    # method: 'raster' bins the points into the pixels of the map (fast, points outside the AOI
+    #         extent are not drawn), 'scatter' draws every point as a marker
+    # dpi: resolution of the saved figure
+    # point_px: size of the map bins in figure pixels, about the marker size of 'scatter', default dpi / 100
+    # Returns (density, bin edges) of the histogram
 
     fig, (ax_hist, ax_map) = plt.subplots(
         ncols=2,
@@ -68,44 +198,180 @@ def plot_hist_map(gdf_date, field, shapefile_ll, date, outdir):
         gridspec_kw={"width_ratios": [1, 1]}
     )
 
-    ax_hist.hist(
-                gdf_date[field],
-                bins=100,
-                alpha=0.4,
-                density=True,
-                label=str(date)
-            )
+    # histogram and colour range from one pass over the values
+    values = gdf_date[field].to_numpy(dtype=np.float64)
+    finite = values[np.isfinite(values)]
+    density, edges = np.histogram(finite, bins=100, density=True)
+    ax_hist.stairs(density, edges, fill=True, alpha=0.4, label=str(date))
 
     ax_hist.set_xlabel(f"{field}")
     ax_hist.set_ylabel("Probability density")
 
-    # Background
-    shapefile_ll.plot(ax=ax_map, color="lightgrey", edgecolor="none")
-
     # min and max set as 3 std away from mean
-    vmin = gdf_date[field].mean() - 3 * gdf_date[field].std()
-    vmax = gdf_date[field].mean() + 2 * gdf_date[field].std()
-
-    # Points colored by height
-    gdf_date.plot(
-        ax=ax_map,
-        column=field,
-        legend=True,
-        markersize=0.5,
-        vmin=vmin,
-        vmax=vmax
-    )
+    mean, std = finite.mean(), finite.std(ddof=1)
+    vmin = mean - 3 * std
+    vmax = mean + 2 * std
+
+    if method == "scatter":
+        # Background
+        shapefile_ll.plot(ax=ax_map, color="lightgrey", edgecolor="none")
+        if not isinstance(gdf_date, gpd.GeoDataFrame) or gdf_date.active_geometry_name is None:
+            gdf_date = points_to_gdf(gdf_date)
+
+        # Points colored by height
+        gdf_date.plot(
+            ax=ax_map,
+            column=field,
+            legend=True,
+            markersize=0.5,
+            vmin=vmin,
+            vmax=vmax
+        )
+    else:
+        fig.colorbar(plt.cm.ScalarMappable(norm=plt.Normalize(vmin, vmax), cmap="viridis"), ax=ax_map, extend="both")
+        extent = tuple(float(v) for v in shapefile_ll.total_bounds)
+        # lat/lon aspect as geopandas plots, one image pixel per point_px x point_px pixels of the map axes
+        aspect = 1 / np.cos(np.radians((extent[1] + extent[3]) / 2))
+        ratio = (extent[3] - extent[1]) * aspect / (extent[2] - extent[0])
+        box = ax_map.get_position()
+        point_px = point_px or max(dpi / 100, 1)
+        box_w = box.width * fig.get_figwidth() * dpi / point_px
+        box_h = box.height * fig.get_figheight() * dpi / point_px
+        cols = int(min(box_w, box_h / ratio))
+        shape = (max(int(cols * ratio), 1), max(cols, 1))
+
+        x, y = coords.get_xy(gdf_date, shapefile_ll.crs)
+        image = render_points(x, y, values, extent, shape, vmin, vmax,
+                              background=_map_background(shapefile_ll, extent, shape))
+        ax_map.imshow(image, extent=(extent[0], extent[2], extent[1], extent[3]), aspect=aspect,
+                      interpolation="nearest")
 
     ax_map.set_title(str(date))
     ax_map.set_axis_off()
 
-    # save figure
-    fig.savefig(outdir + f"{date}.png", dpi=300)
+    # save figure, fast png compression (the default level takes longer than drawing)
+    fig.savefig(outdir + f"{date}.png", dpi=dpi, pil_kwargs={"compress_level": 1})
 
     # close figure
     plt.close(fig)
-
-
+    return density, edges
+
+
+# statistics computed by binned_stats besides percentiles given as 'p<q>', e.g. 'p90'
+grid_statistics = ("count", "sum", "mean", "std", "min", "max", "median")
+
+
+def _percentile_q(stat):
+    # q in [0, 1] of a 'p<q>' statistic name, e.g. 'p90' -> 0.9, 'p2.5' -> 0.025
+    match = re.fullmatch(r"p(\d+(?:\.\d*)?)", stat)
+    if match is None or float(match.group(1)) > 100:
+        raise ValueError(f"Unknown statistic {stat!r}, use any of {grid_statistics} or a percentile 'p<q>' "
+                         f"with 0 <= q <= 100, e.g. 'p90'")
+    return float(match.group(1)) / 100
+
+
+def grouped_stats(idx, z, n_bins, stats=("count", "median"), ignore_nan=False):
+
+    # Statistics of z per bin for all bins in one pass, no Python loop over bins.
+    # idx: bin index of each value (-1 values are ignored), from bin_index
+    # z: values
+    # n_bins: number of bins
+    # stats: names from grid_statistics and/or percentiles as 'p<q>' (e.g. 'p10', 'p90')
+    # ignore_nan: min, max, median and percentiles ignore NaN values, as np.nanmedian/np.nanpercentile
+    #             (NaN for bins without values)
+    # Returns dict of {stat: 1-D float64 array of length n_bins}
+    # Empty bins are NaN (0 for count and sum). Without ignore_nan, NaN values are handled as scipy's
+    # binned_statistic: count includes them, sum, mean, std and max are NaN for bins with NaN, min and
+    # median take the values of the bin sorted with NaN last. Percentiles are NaN for bins with NaN,
+    # as np.percentile.
+
+    percentiles = {s: _percentile_q(s) for s in stats if s not in grid_statistics}
+    keep = idx >= 0
+    idx = idx[keep]
+    z = z[keep]
+
+    count = np.bincount(idx, minlength=n_bins)
+    empty = count == 0
+
+    out = {}
+    if "count" in stats:
+        out["count"] = count.astype(np.float64)
+
+    if any(s in stats for s in ("sum", "mean", "std")):
+        total = np.bincount(idx, weights=z, minlength=n_bins)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total / count
+        if "sum" in stats:
+            out["sum"] = total
+        if "mean" in stats:
+            out["mean"] = np.where(empty, np.nan, mean)
+        if "std" in stats:
+            var = np.bincount(idx, weights=(z - mean[idx]) ** 2, minlength=n_bins) / np.maximum(count, 1)
+            out["std"] = np.where(empty, np.nan, np.sqrt(var))
+
+    order_stats = [s for s in stats if s in ("min", "max", "median") or s in percentiles]
+    if order_stats:
+        nan = np.isnan(z)
+        has_nan = np.bincount(idx[nan], minlength=n_bins) > 0
+        if ignore_nan and nan.any():
+            idx = idx[~nan]
+            z = z[~nan]
+            count = np.bincount(idx, minlength=n_bins)
+            empty = count == 0
+            has_nan[:] = False
+        # group values by bin and sort them within each bin (same order as np.lexsort((z, idx)))
+        # with one integer sort: values are replaced by their global rank so bin * n + rank is an exact key
+        n = len(z)
+        value_order = np.argsort(z)
+        rank = np.empty(n, dtype=np.int64)
+        rank[value_order] = np.arange(n)
+        key = idx.astype(np.int64) * n + rank
+        key.sort()
+        z_sorted = z[value_order][key % max(n, 1)]
+        start = np.concatenate(([0], np.cumsum(count)[:-1]))
+        last = start + np.maximum(count, 1) - 1
+        n_sorted = max(len(z_sorted), 1)
+        z_sorted = z_sorted if len(z_sorted) else np.zeros(1, dtype=z.dtype)
+
+        def take(i):
+            return z_sorted[np.minimum(i, n_sorted - 1)].astype(np.float64)
+
+        for s in order_stats:
+            if s == "min":
+                value = take(start)
+            elif s == "max":
+                value = take(last)
+            elif s == "median":
+                lo = start + (np.maximum(count, 1) - 1) // 2
+                hi = start + np.maximum(count, 1) // 2
+                # mean of the two middle values in the input dtype, as np.median does
+                value = ((z_sorted[np.minimum(lo, n_sorted - 1)] + z_sorted[np.minimum(hi, n_sorted - 1)]) / 2).astype(np.float64)
+            else:
+                # linear interpolation between closest ranks, as np.percentile
+                q = percentiles[s]
+                pos = (np.maximum(count, 1) - 1) * q
+                lo = np.floor(pos).astype(np.int64)
+                frac = pos - lo
+                hi = np.minimum(lo + 1, np.maximum(count, 1) - 1)
+                a = take(start + lo)
+                b = take(start + hi)
+                value = np.where(has_nan, np.nan, a + (b - a) * frac)
+            out[s] = np.where(empty, np.nan, value)
+
+    return out
+
+
+def binned_stats(x, y, z, x_edges, y_edges, stats=("count", "median"), ignore_nan=False):
+    # 2-D version of grouped_stats on grid edges, arrays of shape (ny, nx) with row 0 = lowest y
+    # (the orientation of binned_statistic_2d, flip with np.flipud for north-up rasters)
+    nx = len(x_edges) - 1
+    ny = len(y_edges) - 1
+    idx = bin_index(x, y, x_edges, y_edges)
+    values = grouped_stats(idx, z, nx * ny, stats=stats, ignore_nan=ignore_nan)
+    return {s: v.reshape(ny, nx) for s, v in values.items()}
+
+
+@instr.timed
 def grid_sampling(shapefile_utm: gpd.GeoDataFrame, 
                   gdf_points: gpd.GeoDataFrame, 
                   buffer: float = 0.0, 
@@ -115,74 +381,69 @@ def grid_sampling(shapefile_utm: gpd.GeoDataFrame,
                   filedate: str = ' ', 
                   plotFlag=False, 
                   countFlag=False,
+                  clipFlag=False,
                   writeGeoTIFF=False,
-                  swot_raster_dir: str = "./") -> np.ndarray:
+                  swot_raster_dir: str = "./",
+                  encoding: str = 'float64') -> np.ndarray:
     
     # Function that grids point data to specified resolution over shapefile extent
     # shapefile_utm: input shapefile to cover with grid in UTM coordinates
-    # gdf_points: input geopandas dataframe with point data to grid
+    # gdf_points: input geopandas dataframe with point data to grid (any crs), or a DataFrame with lon/lat
+    #             or stored x/y columns (see coords.get_xy), no geometry is built
     # buffer: buffer around shapefile extent in meters
     # field: field in gdf_points to grid
-    # stat_method: statistic to compute in each grid cell ('median', 'mean', etc.)
+    # stat_method: statistic to compute in each grid cell ('median', 'mean', 'p90', etc., see grid_statistics)
     # grid_resolution: size of grid cells in meters
     # filedate: string to append to output filename - e.g., date or 'all_dates'
     # plotFlag: whether to plot the gridded result
+    # clipFlag: whether to drop points outside the shapefile polygons (not just outside the grid)
     # writeGeoTIFF: whether to write the gridded result to GeoTIFF
     # swot_raster_dir: directory to save GeoTIFF if writeGeoTIFF is True
+    # encoding: GeoTIFF band encoding, 'float64' (the gridded statistics as computed), 'float32' or 'int16' (scaled), see raster_io
 
 
-    x_grid, y_grid = grid_from_shp(shapefile_utm, grid_size=grid_resolution, buffer=buffer, plotFlag=plotFlag)
-
-    # convert gdf_pixc_all to UTM
-    gdf_points = gdf_points.to_crs(shapefile_utm.crs)
+    # grid definition computed once per shapefile/resolution/buffer and shared by all products
+    grid = GridSpec.from_shapefile(shapefile_utm, grid_resolution, buffer=buffer)
+    x_edges, y_edges = grid.x_edges, grid.y_edges
+    if plotFlag:
+        grid_from_shp(shapefile_utm, grid_size=grid_resolution, buffer=buffer, plotFlag=plotFlag)
 
-    # Extract swot pixc arrays
-    x = gdf_points.geometry.x.to_numpy()
-    y = gdf_points.geometry.y.to_numpy()
+    # Extract swot pixc arrays in UTM, stored x/y columns are used as they are
+    x, y = coords.get_xy(gdf_points, shapefile_utm.crs)
     z = gdf_points[field].to_numpy()
 
-    # Grid resolution
-    dx = dy = grid_resolution
-
-    # Grid extent (match your defined grid)
-    xmin = x_grid.min()
-    xmax = x_grid.max()
-    ymin = y_grid.min()
-    ymax = y_grid.max()
-
-    # Number of cells
-    nx = int(np.ceil((xmax - xmin) / dx))
-    ny = int(np.ceil((ymax - ymin) / dy))
-
-    # Pure scipy method (fast)
-    x_edges = xmin + dx * np.arange(nx + 1)
-    y_edges = ymin + dy * np.arange(ny + 1)
-
-    # create 2D binned statistic for median
-    stat_raster, _, _, _ = binned_statistic_2d(
-        y, x, z,
-        statistic=stat_method,
-        bins=[y_edges, x_edges]
-    )
-
-    count_raster, _, _, _ = binned_statistic_2d(
-        y, x, None,
-        statistic="count",
-        bins=[y_edges, x_edges]
-    )
+    if clipFlag:
+        in_aoi = AOIClipper(shapefile_utm).mask(x, y)
+        x, y, z = x[in_aoi], y[in_aoi], z[in_aoi]
+    instr.count("grid.points_in", len(x))
+
+    if stat_method in grid_statistics or (isinstance(stat_method, str) and stat_method.startswith("p")):
+        # bin index computed once, statistic and count from the same pass
+        rasters = binned_stats(x, y, z, x_edges, y_edges, stats=("count", stat_method))
+        stat_raster = rasters[stat_method]
+        count_raster = rasters["count"]
+    else:
+        # other scipy statistics (e.g. callables)
+        stat_raster, _, _, _ = binned_statistic_2d(
+            y, x, z,
+            statistic=stat_method,
+            bins=[y_edges, x_edges]
+        )
+
+        count_raster, _, _, _ = binned_statistic_2d(
+            y, x, None,
+            statistic="count",
+            bins=[y_edges, x_edges]
+        )
 
     stat_raster = np.flipud(stat_raster)
     count_raster = np.flipud(count_raster)
 
-    transform = from_origin(
-        xmin,
-        ymax,
-        dx,
-        dy
-    )
+    transform = grid.transform
 
     if plotFlag:
         # Plot results
+        xmin, ymin, xmax, ymax = grid.bounds
         fig, (ax1, ax2) = plt.subplots(ncols=2, figsize=(12, 6))
         c1 = ax1.imshow(stat_raster, cmap="viridis", extent=(xmin, xmax, ymin, ymax))
         ax1.set_title(f"{stat_method.capitalize()} {field}")
@@ -191,33 +452,290 @@ def grid_sampling(shapefile_utm: gpd.GeoDataFrame,
 
     # Write to geotiff
     if writeGeoTIFF:
-        with rasterio.open(
-            swot_raster_dir+f"{filedate}_{field}.tif",
-            "w",
-            driver="GTiff",
-            height=stat_raster.shape[0],
-            width=stat_raster.shape[1],
-            count=1,
-            dtype=stat_raster.dtype,
-            crs=shapefile_utm.crs,
-            transform=transform,
-            nodata=np.nan
-        ) as dst:
-            dst.write(stat_raster, 1)
+        rio.write_raster(swot_raster_dir+f"{filedate}_{field}.tif", {field: stat_raster},
+                         transform, shapefile_utm.crs, encoding=encoding)
 
         if countFlag:
-            with rasterio.open(
-                swot_raster_dir+f"{filedate}_count.tif",
-                "w",
-                driver="GTiff",
-                height=count_raster.shape[0],
-                width=count_raster.shape[1],
-                count=1,
-                dtype=count_raster.dtype,
-                crs=shapefile_utm.crs,
-                transform=transform,
-                nodata=np.nan
-            ) as dst:
-                dst.write(count_raster, 1)
-
-    return stat_raster
\ No newline at end of file
+            rio.write_raster(swot_raster_dir+f"{filedate}_count.tif", {"count": count_raster},
+                             transform, shapefile_utm.crs, encoding=encoding)
+
+    return stat_raster
+
+
+@instr.timed
+def grid_sampling_multi(shapefile_utm: gpd.GeoDataFrame,
+                        gdf_points: gpd.GeoDataFrame,
+                        fields=('heightEGM', 'water_frac', 'phase_noise_std', 'sig0'),
+                        stat_methods=('median',),
+                        buffer: float = 0.0,
+                        grid_resolution: float = 100,
+                        filedate: str = ' ',
+                        clipFlag=False,
+                        writeGeoTIFF=False,
+                        swot_raster_dir: str = "./",
+                        grid: GridSpec = None,
+                        clipper: AOIClipper = None,
+                        encoding: str = 'float64') -> dict:
+
+    # Grids several fields with several statistics in one pass: points are projected once,
+    # assigned to cells once, and every field/statistic is computed from that bin assignment.
+    # fields: fields in gdf_points to grid
+    # stat_methods: statistics computed for every field (see grid_statistics, 'p<q>' for percentiles)
+    # writeGeoTIFF: write all products to one multi-band GeoTIFF {filedate}_multiband.tif,
+    #               bands are named '{field}_{stat}' plus a final 'count' band
+    # grid: GridSpec to grid on, GridSpec.from_shapefile(shapefile_utm, grid_resolution, buffer) if None
+    # clipper: AOIClipper in the shapefile crs used when clipFlag is set (built from shapefile_utm if None)
+    # encoding: GeoTIFF band encoding, see raster_io
+    # other arguments as in grid_sampling
+    # Returns dict of {band name: north-up raster}, including 'count'
+
+    if grid is None:
+        grid = GridSpec.from_shapefile(shapefile_utm, grid_resolution, buffer=buffer)
+    nx, ny = grid.nx, grid.ny
+
+    x, y = coords.get_xy(gdf_points, shapefile_utm.crs)
+    keep = np.ones(len(x), dtype=bool)
+    if clipFlag:
+        keep = (clipper or AOIClipper(shapefile_utm)).mask(x, y)
+
+    idx = grid.cell_index(x[keep], y[keep])
+    instr.count("grid.points_in", len(idx))
+
+    bands = {}
+    for field in fields:
+        values = grouped_stats(idx, gdf_points[field].to_numpy()[keep], nx * ny, stats=tuple(stat_methods))
+        for stat in stat_methods:
+            bands[f"{field}_{stat}"] = np.flipud(values[stat].reshape(ny, nx))
+    bands["count"] = np.flipud(np.bincount(idx[idx >= 0], minlength=nx * ny).astype(np.float64).reshape(ny, nx))
+
+    if writeGeoTIFF:
+        write_multiband_geotiff(swot_raster_dir+f"{filedate}_multiband.tif", bands, grid.transform, grid.crs,
+                                encoding=encoding)
+
+    return bands
+
+
+def write_multiband_geotiff(path, bands: dict, transform, crs, encoding="float64", **kwargs):
+    # bands: {band name: north-up raster}, written in order as one COG with bands named by description
+    # encoding, kwargs: band encoding and other options of raster_io.write_raster
+    rio.write_raster(path, bands, transform, crs, encoding=encoding, **kwargs)
+
+
+def read_band(raster_file, name, masked=False):
+    # read a band of a multi-band GeoTIFF by its description (e.g. 'heightEGM_median')
+    with rasterio.open(raster_file) as src:
+        if name not in src.descriptions:
+            raise KeyError(f"No band '{name}' in {raster_file}, bands: {src.descriptions}")
+        values = rio.read_scaled(src, src.descriptions.index(name) + 1, dtype=np.float64)
+    return np.ma.masked_invalid(values) if masked else values
+
+
+@instr.timed
+def extract_points_from_rasters(points: gpd.GeoDataFrame, raster_files, buffer: float = 0.0, band=1, id_field=None,
+                                circular=False, n_threads=8, max_block_cells=4_000_000) -> pd.DataFrame:
+
+    # Mean raster value around every point for every raster, each raster opened once.
+    # points: point locations (e.g. height_TS_locations.shp), any crs
+    # raster_files: rasters to sample, e.g. per-date or weekly products. The date of each raster is
+    #               the first YYYY-MM-DD in its file name (NaT if none)
+    # buffer: half-width in metres of the window averaged around each point, as buffer_size of the
+    #         notebooks' extract_raster_height_from_latlon, 0 for the pixel value
+    # band: band number, or band description of multi-band products (e.g. 'heightEGM_median')
+    # id_field: column of points used as point id, default the points index
+    # circular: average the cells within a radius of buffer instead of the square window
+    # n_threads: number of rasters read in parallel
+    # max_block_cells: read the bounding box of all windows at once when it is at most this many cells,
+    #                  otherwise read one window per point
+    # Returns tidy DataFrame (id, date, raster, value, n_valid) sorted by id and date, value is the
+    # mean of the valid (not nodata) cells of the window, NaN if there are none
+
+    ids = points.index.to_numpy() if id_field is None else points[id_field].to_numpy()
+    n_points = len(points)
+    # windows and their read blocks only depend on the raster grid, computed once per distinct grid
+    windows = {}
+    windows_lock = threading.Lock()
+
+    def grid_windows(src):
+        key = (tuple(src.transform), src.width, src.height, src.crs.to_wkt())
+        with windows_lock:
+            if key not in windows:
+                grid = GridSpec.from_dataset(src)
+                x, y = coords.get_xy(points, src.crs)
+                point, rows, cols = grid.window_cells(x, y, buffer=buffer, circular=circular)
+                # one block covering all windows if small enough, otherwise one block per point
+                if rows.size and (np.ptp(rows) + 1) * (np.ptp(cols) + 1) <= max_block_cells:
+                    blocks = [np.arange(rows.size)]
+                else:
+                    blocks = np.split(np.arange(rows.size), np.flatnonzero(np.diff(point)) + 1) if rows.size else []
+                windows[key] = point, rows, cols, blocks
+            return windows[key]
+
+    def sample(raster_file):
+        with rasterio.open(raster_file) as src:
+            point, rows, cols, blocks = grid_windows(src)
+            band_index = band if isinstance(band, int) else src.descriptions.index(band) + 1
+            values = np.empty(rows.size)
+            for cells in blocks:
+                r, c = rows[cells], cols[cells]
+                r0, c0 = r.min(), c.min()
+                block = rio.read_scaled(src, band_index, window=Window(c0, r0, c.max() - c0 + 1, r.max() - r0 + 1),
+                                        dtype=np.float64)
+                values[cells] = block[r - r0, c - c0]
+
+        valid = ~np.isnan(values)
+        n_valid = np.bincount(point[valid], minlength=n_points)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.bincount(point[valid], weights=values[valid], minlength=n_points) / n_valid
+        return means, n_valid
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        results = list(pool.map(sample, raster_files))
+
+    dates = raster_dates(raster_files)
+    df = pd.DataFrame({
+        "id": np.tile(ids, len(raster_files)),
+        "date": np.repeat(dates, n_points),
+        "raster": np.repeat(list(raster_files), n_points),
+        "value": np.concatenate([r[0] for r in results]) if results else np.zeros(0),
+        "n_valid": np.concatenate([r[1] for r in results]) if results else np.zeros(0, dtype=np.int64),
+    })
+    return df.sort_values(["id", "date"], kind="stable").reset_index(drop=True)
+
+
+def raster_dates(raster_files):
+    # date of every raster, the first YYYY-MM-DD in its file name (NaT if none)
+    dates = [re.search(r"\d{4}-\d{2}-\d{2}", os.path.basename(f)) for f in raster_files]
+    return pd.to_datetime([d.group(0) if d else None for d in dates])
+
+
+# per-pixel reductions of reduce_rasters
+raster_reductions = ("occurrence", "count", "mean", "min", "max", "first_date", "last_date")
+
+
+@instr.timed
+def reduce_rasters(raster_files, reductions=("occurrence", "mean", "count"), band=1, dates=None, threshold=None,
+                   block_size=512, n_threads=4, out_path=None, encoding="float32"):
+
+    # Per-pixel reductions and per-raster scalars of a raster time series in one streaming pass.
+    # Rasters are read window by window and every window is reduced over all rasters before it is
+    # written out, windows run on a thread pool. Memory is the output rasters plus a few arrays per
+    # window in flight, whatever the number of rasters. Every worker thread opens each raster once.
+    # raster_files: rasters on the same grid, e.g. the per-date or monthly products
+    # reductions: per-pixel outputs, any of raster_reductions
+    #     occurrence: fraction of the rasters in which the pixel is present (water occurrence)
+    #     count: number of rasters with a valid value; mean, min, max: of the valid values
+    #     first_date, last_date: first and last date the pixel is present, in days since 1970-01-01
+    # band: band number, or band description of multi-band products (e.g. 'heightEGM_median')
+    # dates: date of every raster, default from the file names (see raster_dates)
+    # threshold: a pixel is present where its value is valid and >= threshold (e.g. on a water_frac band),
+    #            None for every valid value
+    # block_size: window edge in pixels
+    # n_threads: number of windows processed in parallel
+    # out_path: also write the reductions to one multi-band COG, bands named by reduction
+    # encoding: band encoding of out_path, see raster_io
+    # Returns (dict of {reduction: north-up raster}, DataFrame with one row per raster: raster, date,
+    # valid_pixels, present_pixels, flooded_area_m2 (present pixels x pixel area), mean of the valid values)
+
+    unknown = [r for r in reductions if r not in raster_reductions]
+    if unknown:
+        raise ValueError(f"Unknown reductions {unknown}, use any of {raster_reductions}")
+    raster_files = list(raster_files)
+    if not raster_files:
+        raise FileNotFoundError("No rasters provided.")
+    dates = raster_dates(raster_files) if dates is None else pd.to_datetime(list(dates))
+    days = ((dates - pd.Timestamp("1970-01-01")) / pd.Timedelta(days=1)).to_numpy(dtype=np.float64)
+    reductions = list(reductions)
+    n = len(raster_files)
+
+    # grid check in one pass over the headers, the windows then only read
+    for i, raster_file in enumerate(raster_files):
+        with rasterio.open(raster_file) as src:
+            if i == 0:
+                height, width = src.height, src.width
+                transform, crs = src.transform, src.crs
+                band_index = band if isinstance(band, int) else src.descriptions.index(band) + 1
+            elif (src.height, src.width) != (height, width) or src.transform != transform:
+                raise ValueError(f"{os.path.basename(raster_file)} is not on the grid of "
+                                 f"{os.path.basename(raster_files[0])}")
+    need_count = "count" in reductions or "mean" in reductions
+    need_dates = "first_date" in reductions or "last_date" in reductions
+    datasets = rio.ThreadDatasets(raster_files)
+
+    def process(window):
+        # window accumulators of the requested reductions only
+        shape = (window.height, window.width)
+        count = np.zeros(shape, dtype=np.int32) if need_count else None
+        present = np.zeros(shape, dtype=np.int32) if "occurrence" in reductions else None
+        total = np.zeros(shape) if "mean" in reductions else None
+        low = np.full(shape, np.nan) if "min" in reductions else None
+        high = np.full(shape, np.nan) if "max" in reductions else None
+        first = np.full(shape, np.nan) if need_dates else None
+        last = np.full(shape, np.nan) if need_dates else None
+        # valid pixels, present pixels and sum of the valid values of every raster in this window
+        per_raster = np.zeros((n, 3))
+        for i, src in enumerate(datasets.get()):
+            values = rio.read_scaled(src, band_index, window=window, dtype=np.float64)
+            valid = ~np.isnan(values)
+            is_present = valid if threshold is None else valid & (values >= threshold)
+            valid_values = np.where(valid, values, 0.0)
+            per_raster[i] = valid.sum(), is_present.sum(), valid_values.sum()
+            if count is not None:
+                count += valid
+            if present is not None:
+                present += is_present
+            if total is not None:
+                total += valid_values
+            if low is not None:
+                np.fmin(low, values, out=low)
+            if high is not None:
+                np.fmax(high, values, out=high)
+            if need_dates:
+                day = np.where(is_present, days[i], np.nan)
+                np.fmin(first, day, out=first)
+                np.fmax(last, day, out=last)
+
+        products = {}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for r in reductions:
+                if r == "occurrence":
+                    products[r] = present / n
+                elif r == "count":
+                    products[r] = count
+                elif r == "mean":
+                    products[r] = total / count
+                else:
+                    products[r] = {"min": low, "max": high, "first_date": first, "last_date": last}[r]
+        return window, products, per_raster
+
+    rasters = {r: np.full((height, width), np.nan, dtype=np.float32) for r in reductions}
+    totals = np.zeros((n, 3))
+
+    def write(result):
+        nonlocal totals
+        window, products, per_raster = result
+        rows = slice(window.row_off, window.row_off + window.height)
+        cols = slice(window.col_off, window.col_off + window.width)
+        for r, values in products.items():
+            rasters[r][rows, cols] = values
+        totals += per_raster
+
+    try:
+        rio.run_blocks(rio.block_windows(height, width, block_size), process, write, n_threads)
+    finally:
+        datasets.close()
+    instr.count("rasters.reduced", n)
+
+    pixel_area = abs(transform.a * transform.e)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        table = pd.DataFrame({
+            "raster": raster_files,
+            "date": dates,
+            "valid_pixels": totals[:, 0].astype(np.int64),
+            "present_pixels": totals[:, 1].astype(np.int64),
+            "flooded_area_m2": totals[:, 1] * pixel_area,
+            "mean": totals[:, 2] / totals[:, 0],
+        })
+
+    if out_path is not None:
+        rio.write_raster(out_path, rasters, transform, crs, encoding=encoding)
+    return rasters, table
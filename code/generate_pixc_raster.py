@@ -1,19 +1,29 @@
 
-import glob
 import os
 import sys
-import datetime
-from tqdm import tqdm
 import geopandas as gpd
-import eo_tools as eot
+import raster_pipeline as rp
+import temporal_aggregation as ta
+from pixc_io import PixcIndex, trimmed_files
+import instrumentation as instr
 
 # loop though daily trimmed files, plot histograms for each, create rasters for each at specified resolution
 
 
 ########### ----------------------- USER INPUT ----------------------- ###########
-selField = 'water_frac'  # or 'heightEGM', 'phase_noise_std', 'dheight_dphase'
-selMetric = 'median'  # or 'mean', 'max', etc.
-trimmed_filelist = glob.glob("C:\\Users\\safr\\Documents\\test_altimetry_project\\data\\swot\\PIXC\\*_trimmed.geojson")
+selFields = ['water_frac', 'heightEGM', 'phase_noise_std', 'sig0']  # gridded together in one pass, histogram of the first
+selMetrics = ['median']  # or 'mean', 'std', 'max', 'p90', etc., all bands go to one {date}_res{grid_size}_multiband.tif
+pixc_dir = "C:\\Users\\safr\\Documents\\test_altimetry_project\\data\\swot\\PIXC\\"
+start_date = None  # e.g. '2024-01-01', None for all dates
+end_date = None
+n_workers = 4  # number of dates processed in parallel
+datacube_flag = True  # also append every date to datacube_res{grid_size}.nc (time series / map reads without per-date files)
+raster_encoding = 'float64'  # GeoTIFF bands (tiled COG with overviews), 'float32' halves the files (~1e-4 m on heights), 'int16' scaled per band
+per_field_flag = False  # also write one {date}_res{grid_size}_{field}.tif per field as before the multi-band files (read by view_pixc.ipynb)
+aggregate_freqs = []  # roll the datacube up to these levels after each run, e.g. ['W-MON', 'MS', 'QS-DEC', 'YS-OCT'], only new dates are re-aggregated
+index_existing_flag = False  # set to True once to index trimmed files written before the index existed
+instrument_flag = False  # record time, memory and counters of every stage, saved as run_report_<time>.json/.csv
+trace_memory_flag = False  # also trace the peak python/numpy memory of every stage (slower)
 
 outdir = "C:\\Users\\safr\\Documents\\test_altimetry_project\\data\\swot\\processed\\"
 if not os.path.exists(outdir):
@@ -29,62 +39,56 @@ if not os.path.exists(hist_dir):
 ########### ----------------------- Process pixc data to gridded raster ----------------------- ###########
 
 
-wetland_utm = gpd.read_file("C:\\Users\\safr\\Documents\\test_altimetry_project\\shapefiles\\wetland_fans_domain_37S.shp")
-wetland_ll = wetland_utm.to_crs("EPSG:4326")
-
-grid_size = 100  # in meters
-
-# delete files from os that are less than 10 KB
-for file in trimmed_filelist:
-    if os.path.getsize(file) < 10000:
-        print(f"file size: {os.path.getsize(file)} bytes")
-        os.remove(file)
-        print(f"Deleted empty file: {file}")
-
-unique_dates = set()
-for trimmed_file in trimmed_filelist:
-    # check file size - skip if 0 bytes
-    if os.path.getsize(trimmed_file) < 10000:  # less than 10 KB
-        print(f"Skipping empty file: {trimmed_file}")
-        continue
-
-    str_date = os.path.basename(trimmed_file).split("_")[-4]
-
-    # check if raster has already been processed for this date
-    raster_date = str_date[0:4] + "-" + str_date[4:6] + "-" + str_date[6:8]
-    raster_filename = swot_raster_dir+f"{raster_date}_res{grid_size}_{selField}.tif"
-    if os.path.exists(raster_filename):
-        print(f"Raster already exists for date {raster_date}, skipping processing.")
-        continue
-
-    # parse yyyymmddThhmmss to datetime
-    t = datetime.datetime.strptime(str_date, "%Y%m%dT%H%M%S")
-    unique_dates.add(t.date())
-
-for date in tqdm(sorted(unique_dates), desc="Processing dates"):
-    # Print current date being processed, with tqdm progress bar
-    tqdm.write(f"Processing date: {date.strftime('%Y-%m-%d')}")
-
-    ########### Load data for this date
-    filenames_for_date = [f for f in trimmed_filelist if date.strftime("%Y%m%d") in f]
-    gdf_date = eot.load_trimmed_pixc_data(filenames_for_date)
-    # for raster creation
-    gdf_date_utm = gdf_date.to_crs(wetland_utm.crs)
-
-    ########## Plot histogram of heights for this date and plot location map, save to file
-    eot.plot_hist_map(gdf_date, field=selField, shapefile_ll=wetland_ll, date=date, outdir=hist_dir)
-
-    ########### Create raster for this date at specified resolution
-    stat_raster = eot.grid_sampling(
+# guard needed as dates are processed in separate processes
+if __name__ == "__main__":
+    if instrument_flag:
+        instr.enable(trace_memory=trace_memory_flag)
+    wetland_utm = gpd.read_file("C:\\Users\\safr\\Documents\\test_altimetry_project\\shapefiles\\wetland_fans_domain_37S.shp")
+    wetland_ll = wetland_utm.to_crs("EPSG:4326")
+
+    grid_size = 100  # in meters
+
+    # index of trimmed files kept up to date by the downloader, empty files are left out of queries
+    with PixcIndex(pixc_dir + "pixc_index.sqlite") as pixc_index:
+        if index_existing_flag:
+            # GeoParquet files and legacy GeoJSON files not converted yet
+            pixc_index.add_files(trimmed_files(pixc_dir))
+        files_by_date = pixc_index.files_by_date(start=start_date, end=end_date, bbox=tuple(wetland_ll.total_bounds))
+
+    todo = {}
+    for date, filenames_for_date in files_by_date.items():
+        # check if raster has already been processed for this date
+        if os.path.exists(rp.raster_filename(swot_raster_dir, date, grid_size)):
+            print(f"Raster already exists for date {date}, skipping processing.")
+            continue
+        todo[date] = filenames_for_date
+
+    # each date is processed on a worker process: load files, plot histogram/map, write multi-band raster
+    results, failed = rp.generate_rasters(
+        todo,
         shapefile_utm=wetland_utm,
-        gdf_points=gdf_date_utm,
+        swot_raster_dir=swot_raster_dir,
+        hist_dir=hist_dir,
+        fields=selFields,
+        stat_methods=selMetrics,
+        grid_size=grid_size,
         buffer=0.01,
-        field=selField,
-        stat_method=selMetric,
-        grid_resolution=grid_size,
-        filedate=str(date)+'_res'+str(grid_size),
-        plotFlag=False,
-        countFlag=False,
-        writeGeoTIFF=True,
-        swot_raster_dir=swot_raster_dir
-    )
\ No newline at end of file
+        n_workers=n_workers,
+        datacube_path=outdir+f"datacube_res{grid_size}.nc" if datacube_flag else None,
+        encoding=raster_encoding,
+        per_field=per_field_flag,
+    )
+    print(f"Processed {len(results)} dates, {len(failed)} failed")
+    for date, error in failed.items():
+        print(f"{date}: {error}")
+
+    # weekly/monthly/seasonal/hydrological-year levels cached in aggregates\level_{freq}.nc, coarser ones built from finer ones
+    if datacube_flag and aggregate_freqs and os.path.exists(outdir+f"datacube_res{grid_size}.nc"):
+        aggregator = ta.TemporalAggregator(outdir+f"datacube_res{grid_size}.nc", outdir+"aggregates\\")
+        aggregator.aggregate_levels(aggregate_freqs)
+        aggregator.close()
+    if instrument_flag:
+        print(instr.summary().to_string())
+        print(instr.counters())
+        json_path, _ = instr.write_report(instr.report_path(outdir))
+        print(f"Saved run report: {json_path}")
@@ -0,0 +1,340 @@
+import json
+import numpy as np
+import geopandas as gpd
+import eo_tools as eot
+import coords
+from aoi_tools import AOIClipper
+from grid_spec import GridSpec
+
+# Streaming (out-of-core) gridding: points are added one batch at a time and reduced to
+# per-cell accumulators, so memory is O(grid cells) whatever the number of points. A batch
+# only updates the cells it touches, so adding needs O(batch points) on top of the accumulators.
+# count, sum, sum of squares, min and max are exact (min/max are kept as float32, the dtype
+# of the trimmed PIXC attributes, see pixc_io). Medians and percentiles come from
+# per-cell histograms with a common bin width per field (sparse, only occupied bins are
+# stored), accurate to the bin width and clamped to the exact min/max. When a field averages
+# more than max_bins_per_cell bins per occupied cell its bin width is doubled, so the
+# histograms stay O(grid cells) too.
+# Accumulators of the same grid merge exactly (monthly -> seasonal -> annual) and are
+# saved to / loaded from .npz files, so merging never re-reads points.
+
+# histogram bin width per field, in field units (fields not listed use default_bin_width)
+default_bin_widths = {"height": 0.01, "heightEGM": 0.01, "water_frac": 0.005, "phase_noise_std": 0.0005,
+                      "dheight_dphase": 0.01, "sig0": 0.05}
+default_bin_width = 0.01
+
+# sparse histogram keys are cell * 2**32 + (bin + 2**31)
+_bin_offset = 2**31
+_max_cells = 2**32
+
+
+def _hist_key(cell, bins):
+    return cell.astype(np.uint64) << np.uint64(32) | (bins + _bin_offset).astype(np.uint64)
+
+
+def _hist_key_bins(keys):
+    return (keys & np.uint64(0xFFFFFFFF)).astype(np.int64) - _bin_offset
+
+
+def _coarsen_keys(keys, steps):
+    # keys of the same cells with bins 2**steps times wider (floor division keeps negative bins right)
+    cell = (keys >> np.uint64(32)).astype(np.int64)
+    return _hist_key(cell, _hist_key_bins(keys) >> steps)
+
+
+def _sum_sorted(keys, counts):
+    # unique keys and summed counts of sorted keys (coarsening keeps sorted keys sorted), without a sort
+    if keys.size == 0:
+        return keys, counts
+    first = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[first], np.add.reduceat(counts, first)
+
+
+class GridAccumulator:
+
+    def __init__(self, grid: GridSpec, fields=('heightEGM',), bin_widths: dict | None = None, sketch=True,
+                 max_bins_per_cell: int = 32):
+
+        # grid: grid the points are accumulated on
+        # fields: point attributes accumulated per cell
+        # bin_widths: initial histogram bin width per field, overrides default_bin_widths
+        # max_bins_per_cell: average number of histogram bins per occupied cell before bins are doubled
+        # sketch: keep per-cell histograms for median/percentiles, False for moments and min/max only
+
+        self.grid = grid
+        self.crs = grid.crs
+        self.fields = list(fields)
+        self.nx = grid.nx
+        self.ny = grid.ny
+        n_cells = self.nx * self.ny
+        if n_cells > _max_cells:
+            raise ValueError(f"Grid of {n_cells} cells is too large for the histogram keys ({_max_cells} cells at most)")
+        widths = {**default_bin_widths, **(bin_widths or {})}
+        self.bin_widths = {f: float(widths.get(f, default_bin_width)) for f in self.fields}
+        self.sketch = sketch
+        self.max_bins_per_cell = max_bins_per_cell
+        # bins are bin_widths[f] * 2**hist_level[f] wide
+        self.hist_level = {f: 0 for f in self.fields}
+
+        # points per cell, and per field the number of non-NaN values
+        self.count = np.zeros(n_cells, dtype=np.int64)
+        self.n = {f: np.zeros(n_cells, dtype=np.int64) for f in self.fields}
+        # sums are taken about a per-field shift (first value seen) to keep sum of squares precise
+        self.shift = {f: np.nan for f in self.fields}
+        self.sum = {f: np.zeros(n_cells) for f in self.fields}
+        self.sumsq = {f: np.zeros(n_cells) for f in self.fields}
+        self.min = {f: np.full(n_cells, np.nan, dtype=np.float32) for f in self.fields}
+        self.max = {f: np.full(n_cells, np.nan, dtype=np.float32) for f in self.fields}
+        # sparse histograms: sorted unique keys and their counts
+        self.hist_keys = {f: np.zeros(0, dtype=np.uint64) for f in self.fields}
+        self.hist_counts = {f: np.zeros(0, dtype=np.int64) for f in self.fields}
+
+
+    @classmethod
+    def from_shapefile(cls, shapefile_utm: gpd.GeoDataFrame, grid_resolution: float, buffer: float = 0.0, **kwargs):
+        # accumulator on the same grid as eo_tools.grid_sampling for this shapefile
+        return cls(GridSpec.from_shapefile(shapefile_utm, grid_resolution, buffer=buffer), **kwargs)
+
+    def add_xy(self, x, y, values: dict):
+
+        # x, y: point coordinates in the grid crs
+        # values: {field: array} for every accumulated field
+
+        idx = self.grid.cell_index(x, y)
+        keep = idx >= 0
+        idx = idx[keep]
+        # occupied cells of the batch, the dense accumulators are only indexed there
+        cells, inverse = np.unique(idx, return_inverse=True)
+        self.count[cells] += np.bincount(inverse, minlength=cells.size)
+
+        for f in self.fields:
+            z = np.asarray(values[f])[keep]
+            valid = ~np.isnan(z)
+            cell = idx[valid]
+            cell_inverse = inverse[valid]
+            z = z[valid]
+            if z.size == 0:
+                continue
+            if np.isnan(self.shift[f]):
+                self.shift[f] = float(z[0])
+            z = z.astype(np.float64)
+            zs = z - self.shift[f]
+            self.n[f][cells] += np.bincount(cell_inverse, minlength=cells.size)
+            self.sum[f][cells] += np.bincount(cell_inverse, weights=zs, minlength=cells.size)
+            self.sumsq[f][cells] += np.bincount(cell_inverse, weights=zs * zs, minlength=cells.size)
+            np.fmin.at(self.min[f], cell, z.astype(np.float32))
+            np.fmax.at(self.max[f], cell, z.astype(np.float32))
+
+            if self.sketch:
+                bins = np.floor(z / self._width(f))
+                if bins.min() < -_bin_offset or bins.max() >= _bin_offset:
+                    raise ValueError(f"{f} values {z.min()}..{z.max()} overflow the 32-bit histogram bins of width "
+                                     f"{self._width(f)}, use a larger bin width")
+                bins = bins.astype(np.int64)
+                keys, counts = np.unique(_hist_key(cell, bins), return_counts=True)
+                self._merge_hist(f, keys, counts)
+
+    def add(self, gdf_points, clipper: AOIClipper = None):
+
+        # gdf_points: points with the accumulated fields, either a GeoDataFrame (any crs) or a
+        #             DataFrame with lon/lat columns (e.g. read with geometry=False), see coords.get_xy
+        # clipper: only add points inside this AOI (in the grid crs)
+
+        x, y = coords.get_xy(gdf_points, self.crs)
+        values = {f: gdf_points[f].to_numpy() for f in self.fields}
+        if clipper is not None:
+            keep = clipper.mask(x, y)
+            x, y = x[keep], y[keep]
+            values = {f: v[keep] for f, v in values.items()}
+        self.add_xy(x, y, values)
+
+    def _width(self, f):
+        return self.bin_widths[f] * 2 ** self.hist_level[f]
+
+    def _merge_hist(self, f, keys, counts, level=None):
+        # add histogram entries at bin level (default: current level) and coarsen if over budget
+        if level is not None and level > self.hist_level[f]:
+            self._coarsen(f, level - self.hist_level[f])
+        if level is not None and level < self.hist_level[f]:
+            keys, counts = _sum_sorted(_coarsen_keys(keys, self.hist_level[f] - level), counts)
+        # keys are sorted and unique: add the counts of existing bins in place, insert the new bins
+        pos = np.searchsorted(self.hist_keys[f], keys)
+        found = pos < self.hist_keys[f].size
+        found[found] = self.hist_keys[f][pos[found]] == keys[found]
+        self.hist_counts[f][pos[found]] += counts[found]
+        new = ~found
+        self.hist_keys[f] = np.insert(self.hist_keys[f], pos[new], keys[new])
+        self.hist_counts[f] = np.insert(self.hist_counts[f], pos[new], counts[new])
+
+        budget = self.max_bins_per_cell * max(1, np.count_nonzero(self.n[f]))
+        while self.hist_keys[f].size > budget:
+            self._coarsen(f, 1)
+
+    def _coarsen(self, f, steps):
+        # merge pairs of adjacent bins steps times
+        self.hist_keys[f], self.hist_counts[f] = _sum_sorted(_coarsen_keys(self.hist_keys[f], steps), self.hist_counts[f])
+        self.hist_level[f] += steps
+
+    def _check_compatible(self, other):
+        if not self.grid.same_grid(other.grid):
+            raise ValueError("Accumulators are on different grids")
+        if self.fields != other.fields or self.bin_widths != other.bin_widths or self.sketch != other.sketch:
+            raise ValueError("Accumulators have different fields, bin widths or sketch settings")
+
+    def merge(self, other):
+        # add the accumulated points of other (same grid and fields) to this accumulator
+        self._check_compatible(other)
+        self.count += other.count
+        for f in self.fields:
+            if np.isnan(other.shift[f]):
+                continue
+            if np.isnan(self.shift[f]):
+                self.shift[f] = other.shift[f]
+            # re-centre the other sums on this shift: sum(z - s) = sum(z - s') + n (s' - s)
+            d = other.shift[f] - self.shift[f]
+            self.n[f] += other.n[f]
+            self.sumsq[f] += other.sumsq[f] + 2 * d * other.sum[f] + other.n[f] * d * d
+            self.sum[f] += other.sum[f] + other.n[f] * d
+            self.min[f] = np.fmin(self.min[f], other.min[f])
+            self.max[f] = np.fmax(self.max[f], other.max[f])
+            if self.sketch:
+                self._merge_hist(f, other.hist_keys[f], other.hist_counts[f], level=other.hist_level[f])
+        return self
+
+    @classmethod
+    def merged(cls, accumulators):
+        # new accumulator holding the points of all accumulators (e.g. monthly -> annual)
+        accumulators = list(accumulators)
+        first = accumulators[0]
+        out = cls(first.grid, fields=first.fields, bin_widths=first.bin_widths, sketch=first.sketch,
+                  max_bins_per_cell=first.max_bins_per_cell)
+        for acc in accumulators:
+            out.merge(acc)
+        return out
+
+    def statistic(self, field, stat):
+
+        # per-cell statistic as a north-up (ny, nx) float64 raster, NaN where the cell has no values
+        # stat: 'count' (points per cell), 'n', 'sum', 'mean', 'std', 'min', 'max', 'median' or 'p<q>'
+
+        if stat == "count":
+            values = self.count.astype(np.float64)
+        else:
+            n = self.n[field]
+            empty = n == 0
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean_shifted = self.sum[field] / n
+            if stat == "n":
+                values = n.astype(np.float64)
+            elif stat == "sum":
+                values = self.sum[field] + n * self.shift[field] if not np.isnan(self.shift[field]) else np.zeros(n.size)
+            elif stat == "mean":
+                values = np.where(empty, np.nan, mean_shifted + self.shift[field])
+            elif stat == "std":
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    var = np.maximum(self.sumsq[field] / n - mean_shifted ** 2, 0)
+                values = np.where(empty, np.nan, np.sqrt(var))
+            elif stat == "min":
+                values = self.min[field].astype(np.float64)
+            elif stat == "max":
+                values = self.max[field].astype(np.float64)
+            elif stat == "median":
+                values = self._percentile(field, 50)
+            elif stat.startswith("p"):
+                values = self._percentile(field, float(stat[1:]))
+            else:
+                raise ValueError(f"Unknown statistic: {stat}")
+        return np.flipud(values.reshape(self.ny, self.nx))
+
+    def _percentile(self, field, q):
+        # percentile from the sparse histogram, linear interpolation between closest ranks as np.percentile
+        # with values spread uniformly within each bin, clamped to the exact cell min/max
+        if not self.sketch:
+            raise ValueError("Percentiles need sketch=True")
+        out = np.full(self.nx * self.ny, np.nan)
+        keys = self.hist_keys[field]
+        if keys.size == 0:
+            return out
+        counts = self.hist_counts[field]
+        bins = _hist_key_bins(keys)
+        width = self._width(field)
+
+        cum = np.cumsum(counts)
+        n = self.n[field]
+        cells = np.flatnonzero(n)
+        cell_start = np.concatenate(([0], np.cumsum(n)[:-1]))[cells]
+        pos = (n[cells] - 1) * q / 100
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, n[cells] - 1)
+
+        def value_at(rank):
+            # k-th value of each cell: its bin, placed at (k + 0.5) / count within the bin
+            i = np.searchsorted(cum, cell_start + rank, side="right")
+            before = cum[i] - counts[i]
+            return (bins[i] + (cell_start + rank - before + 0.5) / counts[i]) * width
+
+        a = value_at(lo)
+        value = a + (value_at(hi) - a) * (pos - lo)
+        out[cells] = np.clip(value, self.min[field][cells], self.max[field][cells])
+        return out
+
+    def rasters(self, stats=('median',)):
+        # {'{field}_{stat}': raster} for all fields and stats plus 'count', as eo_tools.grid_sampling_multi
+        bands = {f"{f}_{s}": self.statistic(f, s) for f in self.fields for s in stats}
+        bands["count"] = self.statistic(None, "count")
+        return bands
+
+    def write_geotiff(self, path, stats=('median',)):
+        eot.write_multiband_geotiff(path, self.rasters(stats), self.grid.transform, self.crs)
+
+    def nbytes(self):
+        # memory held by the accumulators
+        arrays = [self.count] + [a[f] for a in (self.n, self.sum, self.sumsq, self.min, self.max, self.hist_keys, self.hist_counts)
+                                 for f in self.fields]
+        return sum(a.nbytes for a in arrays)
+
+    def save(self, path):
+        # write the accumulators to an .npz file (load with GridAccumulator.load)
+        arrays = {"grid": np.array(json.dumps(self.grid.to_dict())),
+                  "fields": np.array(self.fields), "sketch": np.array(self.sketch), "count": self.count,
+                  "bin_widths": np.array([self.bin_widths[f] for f in self.fields]),
+                  "hist_level": np.array([self.hist_level[f] for f in self.fields]),
+                  "max_bins_per_cell": np.array(self.max_bins_per_cell),
+                  "shift": np.array([self.shift[f] for f in self.fields])}
+        for f in self.fields:
+            for name in ("n", "sum", "sumsq", "min", "max", "hist_keys", "hist_counts"):
+                arrays[f"{name}/{f}"] = getattr(self, name)[f]
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            fields = [str(f) for f in data["fields"]]
+            acc = cls(GridSpec(**json.loads(str(data["grid"]))), fields=fields,
+                      bin_widths=dict(zip(fields, data["bin_widths"].tolist())), sketch=bool(data["sketch"]),
+                      max_bins_per_cell=int(data["max_bins_per_cell"]))
+            acc.hist_level = dict(zip(fields, data["hist_level"].tolist()))
+            acc.count = data["count"]
+            acc.shift = dict(zip(fields, data["shift"].tolist()))
+            for f in fields:
+                for name in ("n", "sum", "sumsq", "min", "max", "hist_keys", "hist_counts"):
+                    getattr(acc, name)[f] = data[f"{name}/{f}"]
+        return acc
+
+
+def grid_trimmed_files(trimmed_filelist, shapefile_utm: gpd.GeoDataFrame, fields=('heightEGM',), grid_resolution: float = 100,
+                       buffer: float = 0.0, clipFlag=False, files_per_chunk=20, accumulator: GridAccumulator = None, **kwargs):
+
+    # Grid any number of trimmed files with bounded memory: files_per_chunk files are read at a time
+    # (only lon/lat and the gridded fields) and added to the accumulator.
+    # accumulator: existing accumulator to add to, a new one on the shapefile grid if None
+    # kwargs: bin_widths / sketch / max_bins_per_cell of a new accumulator
+    # Returns the GridAccumulator, use .rasters() / .write_geotiff() / .save()
+
+    if accumulator is None:
+        accumulator = GridAccumulator.from_shapefile(shapefile_utm, grid_resolution, buffer=buffer, fields=fields, **kwargs)
+    clipper = AOIClipper(shapefile_utm) if clipFlag else None
+    columns = list(dict.fromkeys(["lon", "lat"] + list(accumulator.fields)))
+    for chunk in eot.iter_trimmed_pixc_data(trimmed_filelist, files_per_chunk=files_per_chunk, columns=columns, geometry=False):
+        accumulator.add(chunk, clipper=clipper)
+    return accumulator
@@ -0,0 +1,227 @@
+import os
+import json
+import zlib
+import base64
+import numpy as np
+import geopandas as gpd
+import shapely
+import rasterio
+from rasterio import features
+from rasterio.transform import from_origin
+from pyproj import CRS
+from aoi_tools import aoi_hash
+
+# Grid definition shared by gridding, raster writing and point extraction: west/south edge,
+# resolution, shape and crs, from which bin edges and the affine transform are derived.
+# Built once per (AOI, resolution, buffer) in O(1) memory and memoised, so every product at
+# a resolution is on the same pixels. Can be saved to / loaded from JSON.
+
+
+# GridSpec.from_shapefile cache, keyed by (aoi_hash, resolution, buffer)
+_grid_cache = {}
+
+
+class GridSpec:
+
+    def __init__(self, x0: float, y0: float, resolution: float, nx: int, ny: int, crs, aoi_mask: np.ndarray = None):
+
+        # x0, y0: west and south edge of the grid
+        # resolution: cell size in crs units
+        # nx, ny: number of columns and rows
+        # crs: crs of the grid
+        # aoi_mask: optional north-up (ny, nx) boolean mask of cells touching the AOI
+
+        self.x0 = float(x0)
+        self.y0 = float(y0)
+        self.resolution = float(resolution)
+        self.nx = int(nx)
+        self.ny = int(ny)
+        self.crs = CRS.from_user_input(crs)
+        self.aoi_mask = aoi_mask
+
+    @classmethod
+    def from_shapefile(cls, shapefile_utm: gpd.GeoDataFrame, resolution: float, buffer: float = 0.0, aoi_mask=False, cache_dir=None):
+
+        # Grid of grid_sampling over the shapefile extent, same edges as the previous
+        # grid_from_shp based computation (first and last cell centres of the buffered extent
+        # become the grid edges).
+        # aoi_mask: also rasterise the AOI into a cell mask (all cells touched by the AOI)
+        # cache_dir: folder where specs are saved and reused between runs, None for in-memory only
+
+        key = (aoi_hash(shapefile_utm), float(resolution), float(buffer))
+        grid = _grid_cache.get(key)
+        path = None
+        if grid is None and cache_dir is not None:
+            path = os.path.join(cache_dir, f"grid_{key[0][:16]}_res{key[1]:g}_buf{key[2]:g}.json")
+            if os.path.exists(path):
+                grid = cls.load(path)
+
+        if grid is None:
+            minx, miny, maxx, maxy = shapely.geometry.box(*shapefile_utm.total_bounds).buffer(buffer).bounds
+            half = resolution / 2
+            x0, x_last = _arange_ends(minx + half, maxx - half, resolution)
+            y0, y_last = _arange_ends(miny + half, maxy - half, resolution)
+            nx = int(np.ceil((x_last - x0) / resolution))
+            ny = int(np.ceil((y_last - y0) / resolution))
+            grid = cls(x0, y0, resolution, nx, ny, shapefile_utm.crs)
+
+        if aoi_mask and grid.aoi_mask is None:
+            grid.aoi_mask = grid.rasterise(shapefile_utm)
+        if path is not None and not os.path.exists(path):
+            grid.save(path)
+        _grid_cache[key] = grid
+        return grid
+
+    @classmethod
+    def from_raster(cls, raster_file):
+        # grid of an existing north-up raster
+        with rasterio.open(raster_file) as src:
+            return cls.from_dataset(src)
+
+    @classmethod
+    def from_dataset(cls, src):
+        # grid of an open rasterio dataset
+        t = src.transform
+        return cls(t.c, t.f + t.e * src.height, t.a, src.width, src.height, src.crs)
+
+    @property
+    def shape(self):
+        return (self.ny, self.nx)
+
+    @property
+    def bounds(self):
+        # (minx, miny, maxx, maxy) of the cell edges
+        return (self.x0, self.y0, self.x0 + self.nx * self.resolution, self.y0 + self.ny * self.resolution)
+
+    @property
+    def x_edges(self):
+        return self.x0 + self.resolution * np.arange(self.nx + 1)
+
+    @property
+    def y_edges(self):
+        # increasing, row 0 of binned statistics is the southern row
+        return self.y0 + self.resolution * np.arange(self.ny + 1)
+
+    @property
+    def transform(self):
+        # affine transform of north-up rasters on this grid
+        return from_origin(self.x0, self.y_edges[-1], self.resolution, self.resolution)
+
+    def cell_centres(self):
+        # x and y of the cell centres of north-up rasters, 1-D arrays of length nx and ny
+        x = self.x0 + self.resolution * (np.arange(self.nx) + 0.5)
+        y = self.y_edges[-1] - self.resolution * (np.arange(self.ny) + 0.5)
+        return x, y
+
+    def cell_index(self, x, y):
+        # flat index (row * nx + col, row 0 = southern row) of points, -1 outside the grid
+        return bin_index(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), self.x_edges, self.y_edges)
+
+    def rowcol(self, x, y):
+        # row and column of points in north-up rasters on this grid, -1 outside the grid
+        idx = self.cell_index(x, y)
+        row = np.where(idx >= 0, self.ny - 1 - idx // self.nx, -1)
+        col = np.where(idx >= 0, idx % self.nx, -1)
+        return row, col
+
+    def window_cells(self, x, y, buffer: float = 0.0, circular=False):
+
+        # Cells around each point, for buffer averages.
+        # buffer: half-width in crs units, the window is int(buffer / resolution) pixels on each side
+        #         of the point's pixel, 0 for the pixel only
+        # circular: keep only the window cells whose centre is within buffer of the point's pixel centre
+        # Returns (point, row, col) arrays of north-up raster cells, points outside the grid have none
+        # and cells are clipped to the grid
+
+        row, col = self.rowcol(x, y)
+        half = int(buffer / self.resolution)
+        dr, dc = np.meshgrid(np.arange(-half, half + 1), np.arange(-half, half + 1), indexing="ij")
+        dr, dc = dr.ravel(), dc.ravel()
+        if circular:
+            keep = (dr ** 2 + dc ** 2) * self.resolution ** 2 <= buffer ** 2
+            dr, dc = dr[keep], dc[keep]
+
+        points = np.flatnonzero(row >= 0)
+        point = np.repeat(points, dr.size)
+        rows = (row[points][:, None] + dr).ravel()
+        cols = (col[points][:, None] + dc).ravel()
+        inside = (rows >= 0) & (rows < self.ny) & (cols >= 0) & (cols < self.nx)
+        return point[inside], rows[inside], cols[inside]
+
+    def rasterise(self, shapefile: gpd.GeoDataFrame, all_touched=True):
+        # north-up boolean mask of the cells covered (or touched) by the shapefile polygons
+        shapes = shapefile.to_crs(self.crs).geometry
+        return features.rasterize(((g, 1) for g in shapes), out_shape=self.shape, transform=self.transform,
+                                  all_touched=all_touched, dtype=np.uint8).astype(bool)
+
+    def same_grid(self, other):
+        return (self.x0, self.y0, self.resolution, self.nx, self.ny) == (other.x0, other.y0, other.resolution, other.nx, other.ny) \
+            and self.crs == other.crs
+
+    def to_dict(self):
+        return {"x0": self.x0, "y0": self.y0, "resolution": self.resolution, "nx": self.nx, "ny": self.ny,
+                "crs": self.crs.to_wkt()}
+
+    def save(self, path):
+        # JSON with the grid definition, the AOI mask (if any) as compressed packed bits
+        spec = self.to_dict()
+        if self.aoi_mask is not None:
+            spec["aoi_mask"] = base64.b64encode(zlib.compress(np.packbits(self.aoi_mask).tobytes())).decode()
+        tmp_path = path + ".part"
+        with open(tmp_path, "w") as f:
+            json.dump(spec, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            spec = json.load(f)
+        packed = spec.pop("aoi_mask", None)
+        grid = cls(**spec)
+        if packed is not None:
+            bits = np.frombuffer(zlib.decompress(base64.b64decode(packed)), dtype=np.uint8)
+            grid.aoi_mask = np.unpackbits(bits, count=grid.nx * grid.ny).astype(bool).reshape(grid.shape)
+        return grid
+
+    def __repr__(self):
+        return f"GridSpec(x0={self.x0}, y0={self.y0}, resolution={self.resolution}, nx={self.nx}, ny={self.ny}, crs={self.crs.to_string()})"
+
+
+def _edge_bin(v, edges):
+    # bin number of each value like scipy's binned_statistic: 1..n inside the edges, 0 below, n+1 above,
+    # values on the rightmost edge (to the same rounding precision as scipy) go into the last bin.
+    # Bins are guessed arithmetically from the mean spacing and corrected against the edges,
+    # which gives the same result as np.digitize at a fraction of the cost.
+    n = len(edges) - 1
+    ext = np.concatenate(([-np.inf], edges, [np.inf]))
+    with np.errstate(invalid="ignore"):
+        guess = np.floor((v - edges[0]) / ((edges[-1] - edges[0]) / n)) + 1
+    b = np.clip(np.nan_to_num(guess, nan=n + 1), 0, n + 1).astype(np.int64)
+    b -= v < ext[b]
+    b += v >= ext[b + 1]
+    b[np.isnan(v)] = n + 1
+
+    decimal = int(-np.log10(np.diff(edges).min())) + 6
+    candidates = np.flatnonzero(v >= edges[-1])
+    on_edge = candidates[np.around(v[candidates], decimal) == np.around(edges[-1], decimal)]
+    b[on_edge] -= 1
+    return b
+
+
+def bin_index(x, y, x_edges, y_edges):
+    # flat cell index (row * nx + col) of each point, in the orientation of
+    # binned_statistic_2d(y, x, bins=[y_edges, x_edges]) (row 0 = lowest y), -1 outside the grid
+    nx = len(x_edges) - 1
+    ny = len(y_edges) - 1
+    bx = _edge_bin(x, x_edges)
+    by = _edge_bin(y, y_edges)
+    inside = (bx >= 1) & (bx <= nx) & (by >= 1) & (by <= ny)
+    return np.where(inside, (by - 1) * nx + (bx - 1), -1)
+
+
+def _arange_ends(start, stop, step):
+    # first and last value of np.arange(start, stop, step) without building it
+    # (numpy fills arange as start + i * ((start + step) - start))
+    n = int(np.ceil((stop - start) / step))
+    delta = (start + step) - start
+    return start, start + (n - 1) * delta
@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import time
+import datetime
+import platform
+import threading
+import functools
+import contextlib
+import tracemalloc
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Stage timing, memory and counters of the PIXC and S2 pipelines.
+# Code is instrumented with `with stage("name"):` blocks, the @timed decorator and count("name", n).
+# Nothing is recorded until enable() is called; while disabled a stage is one flag check returning
+# a shared no-op context manager and count() returns at once, so the hooks stay in the code.
+# Every finished stage records wall and CPU seconds, the RSS of the process and, with
+# enable(trace_memory=True), the tracemalloc peak of the stage (numpy buffers included) above the
+# memory traced when it started. tracemalloc peaks and CPU time are per process, so stages running
+# at the same time on several threads see each other's allocations.
+# Worker processes record into their own copy: run their calls through run_in_worker and merge()
+# the returned records in the main process. write_report() saves a run as JSON and CSV.
+
+_enabled = False
+_trace_memory = False
+_started_tracemalloc = False
+_records = []
+_counters = {}
+_lock = threading.Lock()
+_local = threading.local()
+_process = None
+
+
+def enable(trace_memory=False):
+    # start recording, trace_memory also starts tracemalloc (slows allocation heavy code down)
+    global _enabled, _trace_memory, _started_tracemalloc
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    _trace_memory = trace_memory
+    _enabled = True
+
+
+def disable():
+    global _enabled, _trace_memory, _started_tracemalloc
+    _enabled = False
+    _trace_memory = False
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    # drop all records and counters
+    with _lock:
+        _records.clear()
+        _counters.clear()
+
+
+def _rss_mb():
+    # current and peak (high-water mark since process start) resident set size in MB, None where unknown
+    global _process
+    current = peak = None
+    if psutil is not None:
+        if _process is None or _process.pid != os.getpid():
+            # made again in forked workers
+            _process = psutil.Process()
+        info = _process.memory_info()
+        current = info.rss / 2**20
+        if hasattr(info, "peak_wset"):
+            peak = info.peak_wset / 2**20
+    elif sys.platform.startswith("linux"):
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+    return current, peak
+
+
+class _Stage:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack else None
+        self.child_peak = 0
+        if _trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak is reset for this stage, the enclosing stage keeps its peak so far
+            if self.parent is not None:
+                self.parent.child_peak = max(self.parent.child_peak, peak)
+            tracemalloc.reset_peak()
+            self.traced_start = current
+        stack.append(self)
+        self.start = time.time()
+        self.cpu0 = time.process_time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.t0
+        cpu_s = time.process_time() - self.cpu0
+        _local.stack.pop()
+        rss, rss_peak = _rss_mb()
+        record = {
+            "stage": self.name,
+            "parent": None if self.parent is None else self.parent.name,
+            "start": self.start,
+            "seconds": seconds,
+            "cpu_s": cpu_s,
+            "rss_mb": rss,
+            "rss_peak_mb": rss_peak,
+            "traced_peak_mb": None,
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            "error": None if exc_type is None else exc_type.__name__,
+        }
+        if _trace_memory and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            record["traced_peak_mb"] = max(peak - getattr(self, "traced_start", 0), 0) / 2**20
+            if self.parent is not None:
+                self.parent.child_peak = max(self.parent.child_peak, peak)
+        with _lock:
+            _records.append(record)
+        return False
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+def stage(name):
+    # context manager timing the enclosed block as stage name, a shared no-op while disabled
+    if not _enabled:
+        return _NO_STAGE
+    return _Stage(name)
+
+
+def timed(name=None):
+    # decorator recording every call as a stage, named after the function if name is None
+    # usable as @timed, @timed() or @timed("name")
+    def decorate(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    if callable(name):
+        func, name = name, None
+        return decorate(func)
+    return decorate
+
+
+def count(name, n=1):
+    # add n to counter name, e.g. count("pixc.points_read", len(points))
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def collect():
+    # take the records and counters recorded so far (they are removed), for merge() in another process
+    with _lock:
+        data = {"records": list(_records), "counters": dict(_counters)}
+        _records.clear()
+        _counters.clear()
+    return data
+
+
+def merge(data):
+    # add records and counters from collect() of a worker process
+    if not data:
+        return
+    with _lock:
+        _records.extend(data["records"])
+        for name, n in data["counters"].items():
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def worker_settings():
+    # settings to send with tasks to worker processes, None while disabled
+    if not _enabled:
+        return None
+    return {"pid": os.getpid(), "trace_memory": _trace_memory}
+
+
+def run_in_worker(settings, func, *args, **kwargs):
+
+    # Call func in a worker process, instrumented like the main process.
+    # settings: worker_settings() of the main process
+    # Returns (result, records of the call to merge() in the main process); records are None
+    # when disabled or when called in the main process itself (serial runs record directly)
+
+    if settings is None or os.getpid() == settings["pid"]:
+        return func(*args, **kwargs), None
+    if not _enabled:
+        enable(trace_memory=settings["trace_memory"])
+    collect()  # left over from a failed call
+    result = func(*args, **kwargs)
+    return result, collect()
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def records():
+    # one row per finished stage
+    with _lock:
+        rows = list(_records)
+    return pd.DataFrame(rows, columns=["stage", "parent", "start", "seconds", "cpu_s", "rss_mb", "rss_peak_mb",
+                                       "traced_peak_mb", "pid", "thread", "error"])
+
+
+def summary():
+    # per stage, in order of the first call: calls, errors, total/mean/max seconds, CPU seconds,
+    # max RSS and max traced peak (MB)
+    df = records()
+    if df.empty:
+        return pd.DataFrame(columns=["calls", "errors", "total_s", "mean_s", "max_s", "cpu_s", "rss_peak_mb",
+                                     "traced_peak_mb"])
+    df["failed"] = df["error"].notna()
+    table = df.groupby("stage").agg(
+        calls=("seconds", "size"), errors=("failed", "sum"), total_s=("seconds", "sum"), mean_s=("seconds", "mean"),
+        max_s=("seconds", "max"), cpu_s=("cpu_s", "sum"), rss_peak_mb=("rss_peak_mb", "max"),
+        traced_peak_mb=("traced_peak_mb", "max"), first=("start", "min"))
+    return table.sort_values("first").drop(columns="first")
+
+
+def write_report(path, **info):
+
+    # Save the run to {path}.json (run info, per-stage summary, counters and every stage record)
+    # and {path}.csv (per-stage summary rows followed by one row per counter).
+    # path: report path without extension, e.g. outdir + 'run_report_20240101T120000'
+    # info: extra run information stored in the JSON, e.g. script settings
+    # Returns (json path, csv path)
+
+    table = summary()
+    run = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "argv": sys.argv,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "trace_memory": _trace_memory,
+        **info,
+    }
+    report = {
+        "run": run,
+        # through to_json so missing values are null
+        "summary": json.loads(table.reset_index().to_json(orient="records")),
+        "counters": counters(),
+        "records": json.loads(records().to_json(orient="records")),
+    }
+    with open(path + ".json", "w") as f:
+        json.dump(report, f, indent=1, default=str)
+
+    rows = table.reset_index().rename(columns={"stage": "name"})
+    rows.insert(0, "kind", "stage")
+    counter_rows = pd.DataFrame({"kind": "counter", "name": list(report["counters"]),
+                                 "value": list(report["counters"].values())})
+    table = pd.concat([rows, counter_rows], ignore_index=True).astype({"calls": "Int64", "errors": "Int64"})
+    table.to_csv(path + ".csv", index=False)
+    return path + ".json", path + ".csv"
+
+
+def report_path(folder, prefix="run_report"):
+    # timestamped report path (without extension) in folder, one per run
+    return os.path.join(folder, f"{prefix}_{datetime.datetime.now():%Y%m%dT%H%M%S}")
@@ -0,0 +1,265 @@
+import os
+import re
+import glob
+import json
+import sqlite3
+import datetime
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow.parquet as pq
+from pyproj import CRS
+
+# Storage of trimmed pixel cloud data as GeoParquet.
+# Attributes are stored as float32 (heights to ~0.1 mm at 1000 m), lat/lon and geometry stay float64.
+# Rows are sorted by latitude and written in row groups, so the row group statistics on
+# lat/lon/class/time let reads skip data outside a bbox, class list or time range.
+
+
+wgs84 = CRS.from_epsg(4326)
+
+# attribute columns stored as float32
+float32_columns = ["height", "heightEGM", "geoid", "solid_earth_tide", "load_tide", "pole_tide",
+                   "water_frac", "phase_noise_std", "dheight_dphase", "sig0"]
+
+# SWOT_L2_HR_PIXC_{cycle}_{pass}_{tile}_{start}_{end}_{crid}_{counter}
+pixc_filename_pattern = re.compile(
+    r"SWOT_L2_HR_PIXC_(?P<cycle>\d+)_(?P<pass>\d+)_(?P<tile>\w+?)_(?P<start>\d{8}T\d{6})_(?P<end>\d{8}T\d{6})_(?P<crid>\w+?)_(?P<counter>\d+)"
+)
+
+
+def parse_pixc_filename(path):
+    # cycle, pass, tile and start/end time of a (trimmed) PIXC granule from its file name
+    match = pixc_filename_pattern.search(os.path.basename(path))
+    if match is None:
+        raise ValueError(f"Not a SWOT PIXC file name: {path}")
+    info = match.groupdict()
+    info["cycle"] = int(info["cycle"])
+    info["pass"] = int(info["pass"])
+    info["start"] = datetime.datetime.strptime(info["start"], "%Y%m%dT%H%M%S")
+    info["end"] = datetime.datetime.strptime(info["end"], "%Y%m%dT%H%M%S")
+    return info
+
+
+def write_trimmed_pixc(gdf: gpd.GeoDataFrame, path, time=None, row_group_size=100000):
+
+    # gdf: trimmed pixel cloud points (output of readPIXC)
+    # path: output .parquet file
+    # time: acquisition time stored as a column, parsed from the file name if not given
+    # row_group_size: number of points per row group
+
+    if time is None:
+        time = parse_pixc_filename(path)["start"]
+
+    gdf = gdf.sort_values("lat").reset_index(drop=True)
+    for column in float32_columns:
+        if column in gdf:
+            gdf[column] = gdf[column].astype(np.float32)
+    if "class" in gdf:
+        gdf["class"] = gdf["class"].astype(np.int8)
+    gdf["time"] = pd.Timestamp(time)
+
+    gdf.to_parquet(path, index=False, compression="zstd", row_group_size=row_group_size)
+
+
+def read_trimmed_pixc(path, columns=None, bbox=None, classes=None, time_range=None, geometry=True):
+
+    # path: trimmed .parquet file (or list of files)
+    # columns: columns to read, None for all
+    # bbox: (minx, miny, maxx, maxy) in lon/lat, rows outside are filtered on read
+    # classes: integer class codes to keep
+    # time_range: (start, end) acquisition times to keep
+    # geometry: whether to build point geometries, set False to get a plain DataFrame
+
+    filters = []
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        filters += [("lon", ">=", minx), ("lon", "<=", maxx), ("lat", ">=", miny), ("lat", "<=", maxy)]
+    if classes is not None:
+        filters.append(("class", "in", list(classes)))
+    if time_range is not None:
+        filters += [("time", ">=", pd.Timestamp(time_range[0])), ("time", "<=", pd.Timestamp(time_range[1]))]
+    filters = filters or None
+
+    if columns is None:
+        schema = pq.read_schema(path if isinstance(path, str) else path[0])
+        columns = schema.names
+    read_columns = [c for c in columns if c != "geometry"]
+    if geometry:
+        read_columns = list(dict.fromkeys(read_columns + ["lon", "lat"]))
+
+    df = pq.read_table(path, columns=read_columns, filters=filters).to_pandas()
+    if not geometry:
+        return df
+
+    # points are rebuilt from lon/lat, much faster than decoding the stored WKB and crs metadata per file
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df["lon"].to_numpy(), df["lat"].to_numpy()), crs=wgs84)
+
+
+def trimmed_point_count(path):
+    # number of points in a trimmed file, from the parquet footer without reading data
+    if path.endswith(".parquet"):
+        return pq.read_metadata(path).num_rows
+    # GeoJSON has no cheap count, keep the old heuristic: files under 10 KB are empty
+    return 0 if os.path.getsize(path) < 10000 else None
+
+
+def convert_geojson_archive(trimmed_filelist, remove_geojson=False):
+
+    # One-shot conversion of *_trimmed.geojson files to *_trimmed.parquet next to them.
+    # Existing parquet files are kept. Each file is written to a temporary file and renamed.
+    # Returns list of written parquet files
+
+    written = []
+    for geojson_path in trimmed_filelist:
+        parquet_path = geojson_path.replace(".geojson", ".parquet")
+        if not os.path.exists(parquet_path):
+            gdf = gpd.read_file(geojson_path)
+            tmp_path = parquet_path + ".part"
+            write_trimmed_pixc(gdf, tmp_path, time=parse_pixc_filename(geojson_path)["start"])
+            os.replace(tmp_path, parquet_path)
+            written.append(parquet_path)
+            print(f"Converted {os.path.basename(geojson_path)} ({len(gdf)} points)")
+
+        if remove_geojson:
+            os.remove(geojson_path)
+
+    return written
+
+
+def trimmed_stats(gdf):
+    # index statistics of trimmed points: lon/lat bbox, point count and class histogram
+    if len(gdf) == 0:
+        return {"minx": None, "miny": None, "maxx": None, "maxy": None, "n_points": 0, "class_hist": "{}"}
+    classes, counts = np.unique(gdf["class"].to_numpy(), return_counts=True)
+    return {
+        "minx": float(gdf["lon"].min()),
+        "miny": float(gdf["lat"].min()),
+        "maxx": float(gdf["lon"].max()),
+        "maxy": float(gdf["lat"].max()),
+        "n_points": int(len(gdf)),
+        "class_hist": json.dumps({str(int(c)): int(n) for c, n in zip(classes, counts)}),
+    }
+
+
+def trimmed_files(folder):
+    # trimmed files of an archive folder: *_trimmed.parquet, and legacy *_trimmed.geojson files
+    # that have no converted parquet next to them
+    parquet = glob.glob(os.path.join(folder, "*_trimmed.parquet"))
+    geojson = [f for f in glob.glob(os.path.join(folder, "*_trimmed.geojson"))
+               if not os.path.exists(f.replace(".geojson", ".parquet"))]
+    return sorted(parquet + geojson)
+
+
+class PixcIndex:
+    # Persistent SQLite index of the trimmed PIXC archive: one row per trimmed file with
+    # acquisition time, date, cycle, pass, tile, lon/lat bbox, point count and class histogram.
+    # Queries by date range / bbox / cycle / pass are answered from the index without listing
+    # directories or opening files. The downloader adds rows as it writes trimmed files.
+    # The archive is not partitioned on disk: files stay flat in one folder under their granule
+    # names, and date and cycle/pass are indexed columns of one table instead of a directory
+    # layout, so existing paths, the manifest and notebook globs keep working.
+    # Usable as a context manager, closed on exit.
+
+    columns = ["path", "granule_id", "date", "time_start", "time_end", "cycle", "pass", "tile",
+               "minx", "miny", "maxx", "maxy", "n_points", "class_hist"]
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.con = sqlite3.connect(index_path)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, granule_id TEXT, date TEXT, time_start TEXT, time_end TEXT, cycle INTEGER, "
+            "pass INTEGER, tile TEXT, minx REAL, miny REAL, maxx REAL, maxy REAL, n_points INTEGER, class_hist TEXT)"
+        )
+        self.con.execute("CREATE INDEX IF NOT EXISTS files_date ON files (date)")
+        self.con.execute("CREATE INDEX IF NOT EXISTS files_cycle_pass ON files (cycle, pass)")
+        self.con.commit()
+
+    def add(self, path, stats):
+        # stats: output of trimmed_stats for the points in path
+        info = parse_pixc_filename(path)
+        row = {
+            "path": path,
+            "granule_id": os.path.basename(path).split("_trimmed")[0],
+            "date": info["start"].strftime("%Y-%m-%d"),
+            "time_start": info["start"].isoformat(),
+            "time_end": info["end"].isoformat(),
+            "cycle": info["cycle"],
+            "pass": info["pass"],
+            "tile": info["tile"],
+            **stats,
+        }
+        self.con.execute(
+            f"INSERT OR REPLACE INTO files ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))})",
+            [row[c] for c in self.columns]
+        )
+        self.con.commit()
+
+    def add_files(self, trimmed_filelist, reindex=False):
+        # index existing trimmed files (e.g. an archive from before the index), skipping indexed paths
+        indexed = set(r[0] for r in self.con.execute("SELECT path FROM files"))
+        for path in trimmed_filelist:
+            if path in indexed and not reindex:
+                continue
+            if path.endswith(".parquet"):
+                gdf = read_trimmed_pixc(path, columns=["lon", "lat", "class"], geometry=False)
+            else:
+                gdf = gpd.read_file(path, columns=["lon", "lat", "class"])
+            self.add(path, trimmed_stats(gdf))
+
+    def remove(self, path):
+        self.con.execute("DELETE FROM files WHERE path = ?", (path,))
+        self.con.commit()
+
+    def query(self, start=None, end=None, bbox=None, cycles=None, passes=None, classes=None, min_points=1):
+
+        # start, end: acquisition date range (inclusive), anything pd.Timestamp accepts
+        # bbox: (minx, miny, maxx, maxy) lon/lat, files whose bbox intersects it
+        # cycles, passes: lists of cycle / pass numbers
+        # classes: integer class codes, files containing at least one of them
+        # min_points: drop files with fewer points (default drops empty files)
+        # Returns DataFrame of index rows sorted by acquisition time
+
+        where = ["n_points >= ?"]
+        args = [min_points]
+        if start is not None:
+            where.append("date >= ?")
+            args.append(pd.Timestamp(start).strftime("%Y-%m-%d"))
+        if end is not None:
+            where.append("date <= ?")
+            args.append(pd.Timestamp(end).strftime("%Y-%m-%d"))
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            where += ["minx <= ?", "maxx >= ?", "miny <= ?", "maxy >= ?"]
+            args += [maxx, minx, maxy, miny]
+        for column, values in (("cycle", cycles), ("pass", passes)):
+            if values is not None:
+                values = list(values)
+                where.append(f"{column} IN ({', '.join('?' * len(values))})")
+                args += values
+
+        df = pd.read_sql_query(
+            f"SELECT * FROM files WHERE {' AND '.join(where)} ORDER BY time_start", self.con, params=args
+        )
+        if classes is not None:
+            wanted = [str(int(c)) for c in classes]
+            has_class = [any(json.loads(h).get(c, 0) > 0 for c in wanted) for h in df["class_hist"]]
+            df = df.loc[has_class].copy()
+        df["date"] = pd.to_datetime(df["date"])
+        return df.reset_index(drop=True)
+
+    def files_by_date(self, **query_kwargs):
+        # {date: [paths]} for the files matching query(**query_kwargs)
+        df = self.query(**query_kwargs)
+        return {date.date(): list(group["path"]) for date, group in df.groupby("date")}
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,227 @@
+import os
+import tempfile
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+import instrumentation as instr
+
+# Shared GeoTIFF writer of the gridded products and composites: tiled, compressed Cloud-Optimised
+# GeoTIFFs with internal overviews, so quick looks and QGIS only read the overview level they need.
+# Bands are stored as float32, float64 or int16 with a per-band scale and offset
+# (value = stored * scale + offset, -32768 is nodata) that GDAL/QGIS apply on read.
+# Rasters are written block by block into a local temporary GeoTIFF, and the COG (layout,
+# overviews, compression) is made from it in one copy, so the output folder only sees the final file.
+
+ENCODINGS = ("float32", "float64", "int16")
+INT16_NODATA = -32768
+
+
+def int16_scale(data):
+    # scale and offset mapping the finite range of data onto -32767..32767
+    finite = data[np.isfinite(data)]
+    if finite.size == 0:
+        return 1.0, 0.0
+    lo, hi = float(finite.min()), float(finite.max())
+    if hi == lo:
+        return 1.0, lo
+    return (hi - lo) / 65534, (hi + lo) / 2
+
+
+def encode(data, encoding="float32", scale=1.0, offset=0.0):
+    # band values in the stored dtype, NaN becomes the nodata value of int16
+    if encoding == "int16":
+        with np.errstate(invalid="ignore"):
+            stored = np.clip(np.rint((data - offset) / scale), -32767, 32767)
+        stored[~np.isfinite(data)] = INT16_NODATA
+        return stored.astype(np.int16)
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding!r}, use one of {ENCODINGS}")
+    return data.astype(encoding)
+
+
+class CogWriter:
+
+    def __init__(self, path, height, width, count, crs, transform, encoding="float32", scales=None, offsets=None,
+                 descriptions=None, blocksize=512, compress="deflate", overview_resampling="average", tmp_dir=None,
+                 tags=None):
+
+        # path: output COG
+        # height, width, count, crs, transform: raster definition
+        # encoding: 'float32', 'float64' or 'int16' (scaled, nodata -32768)
+        # scales, offsets: per-band scale and offset of int16 bands (sequence of count values), 1 and 0 if None
+        # descriptions: band names, e.g. ['heightEGM_median', ..., 'count']
+        # blocksize: tile edge in pixels (multiple of 16)
+        # compress: COG compression, e.g. 'deflate', 'lzw', 'zstd'
+        # overview_resampling: resampling of the overview levels, 'average' or 'nearest' for classes
+        # tmp_dir: folder of the uncompressed temporary GeoTIFF, default the system temp folder
+        # tags: dataset metadata tags, {name: string}
+
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding {encoding!r}, use one of {ENCODINGS}")
+        self.path = path
+        self.encoding = encoding
+        self.scales = [1.0] * count if scales is None else [float(s) for s in scales]
+        self.offsets = [0.0] * count if offsets is None else [float(o) for o in offsets]
+        self.descriptions = descriptions
+        self.tags = tags
+        self.blocksize = blocksize
+        self.compress = compress
+        self.overview_resampling = overview_resampling
+        fd, self.tmp_path = tempfile.mkstemp(suffix=".tif", dir=tmp_dir)
+        os.close(fd)
+        self._dst = rasterio.open(self.tmp_path, "w", driver="GTiff", height=height, width=width, count=count,
+                                  dtype=encoding, crs=crs, transform=transform,
+                                  nodata=INT16_NODATA if encoding == "int16" else np.nan,
+                                  tiled=True, blockxsize=blocksize, blockysize=blocksize)
+
+    def write(self, data, window=None):
+        # data: (count, rows, cols) values of all bands, or (rows, cols) of a single-band raster
+        data = np.asarray(data)
+        if data.ndim == 2:
+            data = data[None]
+        stored = np.stack([encode(band, self.encoding, s, o) for band, s, o in zip(data, self.scales, self.offsets)])
+        self._dst.write(stored, window=window)
+
+    def close(self):
+        part_path = self.path + ".part"
+        try:
+            if self.encoding == "int16":
+                self._dst.scales = self.scales
+                self._dst.offsets = self.offsets
+            if self.descriptions is not None:
+                for i, name in enumerate(self.descriptions, start=1):
+                    self._dst.set_band_description(i, name)
+            if self.tags:
+                self._dst.update_tags(**self.tags)
+            self._dst.close()
+            predictor = 2 if self.encoding == "int16" else 3
+            with instr.stage("cog.translate"):
+                rasterio.shutil.copy(self.tmp_path, part_path, driver="COG", BLOCKSIZE=self.blocksize,
+                                     COMPRESS=self.compress.upper(), PREDICTOR=predictor, OVERVIEWS="AUTO",
+                                     OVERVIEW_RESAMPLING=self.overview_resampling.upper())
+            os.replace(part_path, self.path)
+        finally:
+            # the temporary GeoTIFF, and a partial COG if the copy failed
+            self._dst.close()
+            for path in (self.tmp_path, part_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        instr.count("raster.files_written")
+        instr.count("raster.bytes_written", os.path.getsize(self.path))
+
+    def abort(self):
+        self._dst.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_raster(path, bands: dict, transform, crs, encoding="float32", scales=None, offsets=None, **kwargs):
+
+    # Write in-memory north-up rasters to one COG.
+    # bands: {band name: 2-D raster}, written in order and named by description
+    # encoding: see CogWriter, int16 bands without scales/offsets are scaled to their own range
+    # scales, offsets: {band name: value} for int16 bands
+    # kwargs: other CogWriter arguments (blocksize, compress, ...)
+
+    names = list(bands)
+    height, width = bands[names[0]].shape
+    if encoding == "int16":
+        auto = {n: int16_scale(bands[n]) for n in names if scales is None or n not in scales}
+        scales = [scales[n] if n not in auto else auto[n][0] for n in names]
+        offsets = [(offsets or {}).get(n, 0.0) if n not in auto else auto[n][1] for n in names]
+    else:
+        scales = offsets = None
+    with CogWriter(path, height, width, len(names), crs, transform, encoding=encoding, scales=scales,
+                   offsets=offsets, descriptions=names, **kwargs) as dst:
+        dst.write(np.stack([bands[n] for n in names]))
+
+
+def read_scaled(src, indexes=None, window=None, out_shape=None, resampling=Resampling.average, dtype=np.float32):
+
+    # Band values with scale/offset applied and nodata as NaN.
+    # src: open rasterio dataset
+    # indexes: band number or list of band numbers, all bands if None
+    # window: rasterio Window to read
+    # out_shape: (rows, cols) to read at, smaller shapes are read from the matching overview level
+    # resampling: resampling when reading at out_shape
+
+    if indexes is None:
+        indexes = list(src.indexes)
+    single = isinstance(indexes, int)
+    band_list = [indexes] if single else list(indexes)
+    shape = None if out_shape is None else (len(band_list), *out_shape)
+    data = src.read(band_list, window=window, out_shape=shape, resampling=resampling, masked=True)
+    values = data.astype(dtype).filled(np.nan)
+    for k, i in enumerate(band_list):
+        scale, offset = src.scales[i - 1], src.offsets[i - 1]
+        if scale != 1 or offset != 0:
+            values[k] = values[k] * scale + offset
+    return values[0] if single else values
+
+
+def block_windows(height, width, block_size):
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield Window(col, row, min(block_size, width - col), min(block_size, height - row))
+
+
+def run_blocks(windows, process, write, n_threads):
+    # process(window) on a thread pool, write(result) on the calling thread as blocks finish,
+    # at most 2 blocks per thread in flight so finished blocks do not pile up in memory
+    # (all-NaN pixels give NaN, the warning filter is process wide so it is set here for all threads)
+    with warnings.catch_warnings(), ThreadPoolExecutor(max_workers=n_threads) as pool:
+        warnings.simplefilter("ignore", RuntimeWarning)
+        pending = set()
+        for window in windows:
+            if len(pending) >= 2 * n_threads:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write(future.result())
+            pending.add(pool.submit(process, window))
+        for future in pending:
+            write(future.result())
+
+
+class ThreadDatasets:
+    # open datasets of a list of rasters for the worker threads of run_blocks: every thread opens
+    # each file once on first use and keeps it for all its blocks (rasterio datasets are not shared
+    # between threads), close() closes them all
+
+    def __init__(self, files):
+        self.files = list(files)
+        self.local = threading.local()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        # datasets of the calling thread, in the order of files
+        if not hasattr(self.local, "datasets"):
+            datasets = []
+            try:
+                for f in self.files:
+                    datasets.append(rasterio.open(f))
+            except BaseException:
+                for src in datasets:
+                    src.close()
+                raise
+            self.local.datasets = datasets
+            with self.lock:
+                self.opened.extend(datasets)
+        return self.local.datasets
+
+    def close(self):
+        for src in self.opened:
+            src.close()
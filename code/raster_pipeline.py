@@ -0,0 +1,177 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import geopandas as gpd
+from tqdm import tqdm
+import eo_tools as eot
+import raster_io as rio
+from aoi_tools import AOIClipper
+from grid_spec import GridSpec
+from datacube import RasterCube
+import instrumentation as instr
+
+# Per-date raster generation (load trimmed files, histogram/map plot, multi-band GeoTIFF)
+# run on a process pool. Dates are independent, so each date is one task.
+# The AOI and grid definition are sent once to each worker by the pool initializer,
+# tasks only carry the date and its file list.
+
+
+# per-process state set by _init_worker
+_worker = {}
+
+
+def _init_worker(shapefile_utm: gpd.GeoDataFrame, settings: dict):
+    # runs once in every worker process (and in the main process for serial runs)
+    import matplotlib
+    matplotlib.use("Agg")
+
+    _worker.clear()
+    _worker.update(settings)
+    _worker["shapefile_utm"] = shapefile_utm
+    _worker["shapefile_ll"] = shapefile_utm.to_crs("EPSG:4326")
+    _worker["grid"] = GridSpec.from_shapefile(shapefile_utm, settings["grid_size"], buffer=settings["buffer"])
+    _worker["clipper"] = AOIClipper(shapefile_utm) if settings["clipFlag"] else None
+
+
+def raster_filename(swot_raster_dir, date, grid_size):
+    return swot_raster_dir + f"{date}_res{grid_size}_multiband.tif"
+
+
+def per_field_filename(swot_raster_dir, date, grid_size, band):
+    # single-band raster of the per_field export, {date}_res{grid_size}_{band}.tif as before the multi-band files
+    return swot_raster_dir + f"{date}_res{grid_size}_{band}.tif"
+
+
+@instr.timed
+def process_date(date, filenames_for_date):
+
+    # Full pipeline for one date using the worker state, returns a summary dict
+
+    settings = _worker
+    # points without geometry objects, lon/lat projected once to x/y columns of the raster crs
+    gdf_date = eot.load_trimmed_pixc_data(filenames_for_date, geometry=False, xy_crs=settings["shapefile_utm"].crs)
+
+    if settings["hist_dir"] is not None:
+        eot.plot_hist_map(gdf_date, field=settings["fields"][0], shapefile_ll=settings["shapefile_ll"],
+                          date=date, outdir=settings["hist_dir"])
+
+    bands = eot.grid_sampling_multi(
+        shapefile_utm=settings["shapefile_utm"],
+        gdf_points=gdf_date,
+        fields=settings["fields"],
+        stat_methods=settings["stat_methods"],
+        buffer=settings["buffer"],
+        grid_resolution=settings["grid_size"],
+        filedate=str(date)+'_res'+str(settings["grid_size"]),
+        clipFlag=settings["clipFlag"],
+        writeGeoTIFF=True,
+        swot_raster_dir=settings["swot_raster_dir"],
+        grid=settings["grid"],
+        clipper=settings["clipper"],
+        encoding=settings["encoding"],
+    )
+
+    if settings["per_field"]:
+        # one statistic: bands named by field as the single-band rasters used to be (e.g. _heightEGM.tif)
+        for field in settings["fields"]:
+            for stat in settings["stat_methods"]:
+                name = field if len(settings["stat_methods"]) == 1 else f"{field}_{stat}"
+                rio.write_raster(per_field_filename(settings["swot_raster_dir"], date, settings["grid_size"], name),
+                                 {name: bands[f"{field}_{stat}"]}, settings["grid"].transform, settings["grid"].crs,
+                                 encoding=settings["encoding"])
+
+    return {
+        "date": date,
+        "n_files": len(filenames_for_date),
+        "n_points": len(gdf_date),
+        "n_cells": int((bands["count"] > 0).sum()),
+        "raster": raster_filename(settings["swot_raster_dir"], date, settings["grid_size"]),
+    }
+
+
+def generate_rasters(files_by_date: dict,
+                     shapefile_utm: gpd.GeoDataFrame,
+                     swot_raster_dir: str,
+                     hist_dir: str | None = None,
+                     fields=('water_frac', 'heightEGM', 'phase_noise_std', 'sig0'),
+                     stat_methods=('median',),
+                     grid_size: float = 100,
+                     buffer: float = 0.01,
+                     clipFlag=False,
+                     n_workers: int = 1,
+                     datacube_path: str | None = None,
+                     encoding: str = 'float64',
+                     per_field=False):
+
+    # files_by_date: {date: [trimmed files]}, e.g. PixcIndex.files_by_date()
+    # shapefile_utm: AOI in the projected crs of the rasters
+    # swot_raster_dir: output folder of {date}_res{grid_size}_multiband.tif
+    # hist_dir: output folder of the histogram/map plots, None to skip plotting
+    # fields, stat_methods, grid_size, buffer, clipFlag: as in eo_tools.grid_sampling_multi
+    # n_workers: number of worker processes, 1 runs in this process
+    # datacube_path: also append every processed date to this datacube (datacube.RasterCube, created if missing)
+    # encoding: band encoding of the GeoTIFFs, 'float32', 'float64' or 'int16' (scaled per band), see raster_io
+    # per_field: also write every field as a single-band {date}_res{grid_size}_{field}.tif ({field}_{stat} with
+    #            several stat_methods), the per-date files of the scripts before the multi-band output
+    # Returns (list of per-date summaries sorted by date, {date: exception} of failed dates)
+
+    settings = {
+        "swot_raster_dir": swot_raster_dir,
+        "hist_dir": hist_dir,
+        "fields": list(fields),
+        "stat_methods": list(stat_methods),
+        "grid_size": grid_size,
+        "buffer": buffer,
+        "clipFlag": clipFlag,
+        "encoding": encoding,
+        "per_field": per_field,
+    }
+    dates = sorted(files_by_date)
+    results = []
+    failed = {}
+
+    if n_workers <= 1:
+        _init_worker(shapefile_utm, settings)
+        for date in tqdm(dates, desc="Processing dates"):
+            try:
+                results.append(process_date(date, files_by_date[date]))
+            except Exception as e:
+                failed[date] = e
+                tqdm.write(f"Failed processing date {date}: {e}")
+    else:
+        results, failed = _run_pool(dates, files_by_date, shapefile_utm, settings, n_workers)
+
+    if datacube_path is not None and results:
+        # single writer: the cube is appended from this process, in date order
+        grid = GridSpec.from_shapefile(shapefile_utm, grid_size, buffer=buffer)
+        bands = [f"{f}_{s}" for f in fields for s in stat_methods] + ["count"]
+        cube = RasterCube.open(datacube_path, grid=grid, bands=bands)
+        try:
+            for result in results:
+                with instr.stage("datacube.append"):
+                    cube.append_geotiff(result["raster"], result["date"])
+        finally:
+            cube.close()
+
+    return results, failed
+
+
+def _run_pool(dates, files_by_date, shapefile_utm, settings, n_workers):
+    results = []
+    failed = {}
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(shapefile_utm, settings)) as pool:
+        instrument = instr.worker_settings()
+        futures = {pool.submit(instr.run_in_worker, instrument, process_date, date, files_by_date[date]): date
+                   for date in dates}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing dates"):
+            date = futures[future]
+            try:
+                result, worker_records = future.result()
+                results.append(result)
+                instr.merge(worker_records)
+            except Exception as e:
+                failed[date] = e
+                tqdm.write(f"Failed processing date {date}: {e}")
+
+    # completion order depends on scheduling, report in date order
+    results.sort(key=lambda r: r["date"])
+    return results, dict(sorted(failed.items()))
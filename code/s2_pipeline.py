@@ -0,0 +1,208 @@
+import os
+import glob
+from datetime import datetime
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+import rasterio
+from PIL import Image, ImageSequence
+import composite_tools as ct
+import raster_io as rio
+import animation_tools as at
+from task_scheduler import Task
+import instrumentation as instr
+
+# Sentinel-2 export pipeline as tasks for task_scheduler.run_tasks. Folder layout per box:
+#   {base_path}/{box}/tif/S2_RGB_YYYY-MM-DD_{box}.tif      exported scenes
+#   {base_path}/{box}/{scene}.png                            per-scene previews
+#   {base_path}/{box}/monthly/S2_RGB_YYYY-MM_{reducer}_{box}.tif/.png   monthly composites
+#   {base_path}/{box}/monthly/{box}_monthly.gif              timeline of the monthly pngs (and .mp4/.webp)
+# Tasks: 'png' per scene, 'composite' per box and month, 'composite_png' per composite
+# (after its composite) and 'gif' per box (after all composite pngs of the box).
+
+
+def scene_year_month(fname):
+    """
+    Extract YYYY, MM from filenames like:
+    S2_RGB_2021-01-28_b3.tif
+    """
+    try:
+        date_str = fname.split('_')[2]  # '2021-01-28'
+        dt = datetime.strptime(date_str, "%Y-%m-%d")
+        return dt.year, dt.month
+    except Exception:
+        return None, None
+
+
+def composite_year_month(fname):
+    # YYYY, MM from monthly composite names like S2_RGB_2021-01_median_b3.png
+    for part in fname.split('_'):
+        try:
+            dt = datetime.strptime(part, "%Y-%m")
+            return dt.year, dt.month
+        except ValueError:
+            continue
+    return None, None
+
+
+@instr.timed
+def scene_to_png(tif, png, size=(600, 500)):
+    # first page of an exported scene as a resized png
+    im = Image.open(tif)
+    page = next(ImageSequence.Iterator(im))
+    page.resize(size).save(png, "png", quality=100)
+    instr.count("png.bytes_written", os.path.getsize(png))
+    return png
+
+
+@instr.timed
+def composite_to_png(tif, png, size=(600, 500)):
+    if not os.path.exists(tif):
+        # month without readable scenes
+        return None
+    with rasterio.open(tif) as src:
+        # read at png size, GDAL takes the matching overview level of the COG instead of full resolution
+        # pixels cloudy in every scene of the month are NaN, show them black
+        rgb = np.nan_to_num(rio.read_scaled(src, [1, 2, 3], out_shape=(size[1], size[0])))
+
+    # Normalize to 0–255 for PNG
+    rgb = np.clip(rgb, 0, np.percentile(rgb, 99))
+    rgb = (rgb / rgb.max() * 255).astype(np.uint8)
+
+    Image.fromarray(np.transpose(rgb, (1, 2, 0))).save(png, "PNG")
+    instr.count("png.bytes_written", os.path.getsize(png))
+    return png
+
+
+@instr.timed
+def composite_month(files, out_tif, reducer="median", block_size=512, n_threads=1, encoding="float32", scale=1.0):
+    # monthly composite recomputed from all its scenes, see composite_tools.composite_scenes
+    used = ct.composite_scenes(files, out_tif, reducer=reducer, block_size=block_size, n_threads=n_threads,
+                               encoding=encoding, scale=scale)
+    return {"scenes": len(used)}
+
+
+def composite_up_to_date(files, out_tif):
+    # the composite was made from exactly these scenes, unchanged since (see composite_tools.recorded_scenes),
+    # composites without the record: newer than all scenes
+    if not os.path.exists(out_tif):
+        return False
+    scenes = ct.recorded_scenes(out_tif)
+    if scenes is None:
+        return all(os.path.getmtime(f) <= os.path.getmtime(out_tif) for f in files if os.path.exists(f))
+    return set(scenes) == set(files) and all(ct.scene_signature(f) == scenes[f] for f in files)
+
+
+@instr.timed
+def timeline_gif(monthly_path, gif_path, start_date, end_date, font_path, font_size=48, frame_size=(600, 500),
+                 duration=600, video_formats=()):
+
+    # monthly_path: folder of the monthly pngs
+    # gif_path: output gif, one frame per month from start_date to end_date, NO DATA frames for missing months
+    # font_path, font_size: font of the date labels
+    # frame_size: frame size, must match the png export
+    # duration: frame duration in ms
+    # video_formats: extra outputs next to the gif written with a local ffmpeg, e.g. ('mp4', 'webp')
+
+    pngs = glob.glob(os.path.join(monthly_path, "*.png"))
+    if len(pngs) == 0:
+        print(f"No monthly PNGs found in {monthly_path}, skipping.")
+        return None
+
+    # Build lookup: (year, month) → png
+    png_lookup = {}
+    for p in pngs:
+        y, m = composite_year_month(os.path.basename(p))
+        if y is not None:
+            png_lookup[(y, m)] = p
+
+    timeline = pd.date_range(start=start_date, end=end_date, freq="MS")
+    frame_size = tuple(frame_size)
+    no_data = at.no_data_frame(frame_size, font_path)
+    used = [png_lookup[(dt.year, dt.month)] for dt in timeline if (dt.year, dt.month) in png_lookup]
+    palette = at.shared_palette(used + [no_data])
+
+    def frames():
+        for dt in timeline:
+            ym = (dt.year, dt.month)
+            if ym in png_lookup:
+                with Image.open(png_lookup[ym]) as img:
+                    img = img.convert("RGB").resize(frame_size)
+            else:
+                img = no_data
+            yield at.draw_date_label(img, dt.strftime("%Y-%m"), font_path, font_size)
+
+    paths = [gif_path] + [os.path.splitext(gif_path)[0] + "." + ext.lstrip(".") for ext in video_formats]
+    n_frames, seconds = at.write_animation(frames(), paths, frame_size, duration=duration, palette=palette)
+    print(f"{os.path.basename(gif_path)}: {n_frames} frames in {seconds:.2f} s ({n_frames / seconds:.1f} frames/s)")
+    return gif_path
+
+
+def build_tasks(base_path, boxes, png_flag=False, composite_flag=True, gif_flag=False, years=(2020, 2025),
+                composite_reducer="median", block_size=512, composite_threads=1, composite_encoding="float32",
+                composite_scale=1.0, png_size=(600, 500),
+                gif_kwargs=None):
+
+    # base_path: folder with one sub-folder per box (layout above)
+    # boxes: box names, e.g. ['b1', ..., 'b8']
+    # png_flag: per-scene pngs, composite_flag: monthly composites and their pngs, gif_flag: one gif per box
+    # years: (first, last) year of the scenes composited
+    # composite_reducer, block_size, composite_threads: see composite_tools.composite_scenes
+    #   (composite_threads are threads within each task, tasks already run in parallel)
+    # composite_encoding, composite_scale: composite COG band encoding, 'float32' or 'int16' as value / scale
+    # gif_kwargs: font_path, ... of timeline_gif, start_date/end_date default to the months of years
+    # Returns list of task_scheduler.Task
+
+    if gif_flag:
+        # checked here rather than when the gif tasks run, after all the composites
+        gif_kwargs = {"start_date": f"{years[0]}-01-01", "end_date": f"{years[1]}-12-01", **(gif_kwargs or {})}
+        if "font_path" not in gif_kwargs:
+            raise ValueError("gif_flag needs gif_kwargs['font_path'] (font of the timeline_gif date labels)")
+
+    tasks = []
+    for b in boxes:
+        box_path = os.path.join(base_path, b)
+        scenes = sorted(glob.glob(os.path.join(box_path, "tif", "*.tif")))
+        monthly_path = os.path.join(box_path, "monthly")
+
+        if png_flag:
+            for tif in scenes:
+                png = os.path.join(box_path, os.path.splitext(os.path.basename(tif))[0] + ".png")
+                tasks.append(Task(f"png {b} {os.path.basename(tif)}", "png", scene_to_png, (tif, png, png_size),
+                                  inputs=[tif], outputs=[png]))
+
+        composite_pngs = []
+        if composite_flag:
+            os.makedirs(monthly_path, exist_ok=True)
+            # Group files by (year, month)
+            monthly_files = defaultdict(list)
+            for tif in scenes:
+                year, month = scene_year_month(os.path.basename(tif))
+                if year is not None and years[0] <= year <= years[1]:
+                    monthly_files[(year, month)].append(tif)
+
+            composites = {}
+            for (year, month), files in sorted(monthly_files.items()):
+                out_tif = os.path.join(monthly_path, f"S2_RGB_{year}-{month:02d}_{composite_reducer}_{b}.tif")
+                name = f"composite {b} {year}-{month:02d}"
+                kwargs = {"reducer": composite_reducer, "block_size": block_size, "n_threads": composite_threads,
+                          "encoding": composite_encoding, "scale": composite_scale}
+                tasks.append(Task(name, "composite", composite_month, (files, out_tif), kwargs, inputs=files,
+                                  outputs=[out_tif], up_to_date=lambda f=files, o=out_tif: composite_up_to_date(f, o)))
+                composites[out_tif] = [name]
+            # composites made earlier (e.g. other reducers) get their pngs too
+            for out_tif in glob.glob(os.path.join(monthly_path, "*.tif")):
+                composites.setdefault(out_tif, [])
+
+            for out_tif, deps in sorted(composites.items()):
+                png = os.path.splitext(out_tif)[0] + ".png"
+                tasks.append(Task(f"composite_png {b} {os.path.basename(out_tif)}", "composite_png", composite_to_png,
+                                  (out_tif, png, png_size), inputs=[out_tif], outputs=[png], deps=deps))
+                composite_pngs.append(tasks[-1])
+
+        if gif_flag:
+            gif_path = os.path.join(monthly_path, f"{b}_monthly.gif")
+            inputs = sorted({t.outputs[0] for t in composite_pngs} | set(glob.glob(os.path.join(monthly_path, "*.png"))))
+            tasks.append(Task(f"gif {b}", "gif", timeline_gif, (monthly_path, gif_path), gif_kwargs,
+                              inputs=inputs, outputs=[gif_path], deps=[t.name for t in composite_pngs]))
+    return tasks
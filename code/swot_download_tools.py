@@ -4,7 +4,15 @@ import pandas as pd
 import xarray as xr
 import numpy as np
 import earthaccess
+from aoi_tools import AOIClipper, points_to_gdf, aoi_hash
+from pixc_io import write_trimmed_pixc, parse_pixc_filename, trimmed_point_count, trimmed_stats, PixcIndex
+import instrumentation as instr
 import os
+import datetime
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 
 
@@ -22,85 +30,419 @@ def translateClass(flag_meanings):
     flag_values = [class_dict[flag_meaning] for flag_meaning in flag_meanings]
 
     return flag_values
-def readPIXC(filename: str, aoi: gpd.GeoDataFrame = None, classes=['open_water'], engine="netcdf4"):
-    
-    # If no centerline buffer to trim to, set gdf_buffered = []
-    with xr.open_mfdataset(filename, group="pixel_cloud", engine=engine) as nc:
-        
-        # Set crs of nc file
-        nc = nc.rio.write_crs("EPSG:4326", inplace=True)
-
-        # select based on desired classification
-        class_flat = nc.classification.values.ravel()
-        flag_values = translateClass(classes)
-        class_condition = np.isin(class_flat, flag_values)
-
-        # Set the nc to a geopandas dataset
-        class_flat = class_flat[class_condition]
-        lon_flat = nc.longitude.values.ravel()[class_condition]
-        lat_flat = nc.latitude.values.ravel()[class_condition]
-        height = nc.height.values.ravel()[class_condition]
-        geoid = nc.geoid.values.ravel()[class_condition]
-        solid_earth_tide = nc.solid_earth_tide.values.ravel()[class_condition]
-        load_tide = nc.load_tide_fes.values.ravel()[class_condition]
-        pole_tide = nc.pole_tide.values.ravel()[class_condition]
-        water_frac = nc.water_frac.values.ravel()[class_condition]
-        phase_noise_std = nc.phase_noise_std.values.ravel()[class_condition]
-        dheight_dphase = nc.dheight_dphase.values.ravel()[class_condition]
-        sig0 = nc.sig0.values.ravel()[class_condition]
-
-        # correction for solid earth/load/pole tide effects (e.g., see SWOT User Handbook, section 3.1.25)
-        heightEGM = height - geoid - solid_earth_tide - load_tide - pole_tide
-
-        # create geodataframe
-        data = {
-            "height": height,
-            "heightEGM": heightEGM,
-            "lat": lat_flat,
-            "lon": lon_flat,
-            "geoid": geoid,
-            "solid_earth_tide":solid_earth_tide,
-            "load_tide":load_tide,
-            "pole_tide":pole_tide,
-            "class": class_flat,
-            "water_frac": water_frac,
-            "phase_noise_std": phase_noise_std,
-            "dheight_dphase": dheight_dphase,
-            "sig0": sig0,
-        }
-        gdf = gpd.GeoDataFrame(
-            pd.DataFrame(data), geometry=gpd.points_from_xy(lon_flat, lat_flat)
-        )
-        gdf.set_crs(epsg=4326, inplace=True)
 
-        ## Trim data to buffer around imported centerline
-        if aoi is not None:
-            gdf = gpd.clip(gdf, aoi)
+
+# pixel cloud variables read into the trimmed data, besides latitude/longitude/classification
+pixc_variables = ["height", "geoid", "solid_earth_tide", "load_tide_fes", "pole_tide",
+                  "water_frac", "phase_noise_std", "dheight_dphase", "sig0"]
+
+
+def pixcIndexRuns(idx, max_gap=100000):
+    # split sorted point indices into contiguous (start, stop) read ranges,
+    # starting a new range where consecutive kept points are more than max_gap apart
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) > max_gap)
+    starts = np.concatenate(([idx[0]], idx[breaks + 1]))
+    stops = np.concatenate((idx[breaks] + 1, [idx[-1] + 1]))
+    return list(zip(starts, stops))
+
+
+@instr.timed
+def readPIXC(filename: str, aoi=None, classes=('open_water',), engine="netcdf4", max_gap=100000):
+
+    # Reads latitude/longitude/classification first, cuts them to the class mask and AOI,
+    # then reads only the index ranges of the remaining variables that contain kept points.
+    # The pixel cloud is never fully materialised and geometries are only built for kept points.
+    # aoi: GeoDataFrame or AOIClipper (build one clipper when reading many files)
+    # max_gap: gap (in points) between kept points above which separate ranges are read
+
+    if aoi is not None and not isinstance(aoi, AOIClipper):
+        aoi = AOIClipper(aoi, crs="EPSG:4326")
+
+    with xr.open_dataset(filename, group="pixel_cloud", engine=engine) as nc:
+
+        with instr.stage("readPIXC.filter"):
+            # select based on desired classification
+            class_flat = nc.classification.values.ravel()
+            instr.count("pixc.points_read", class_flat.size)
+            flag_values = translateClass(classes)
+            idx = np.flatnonzero(np.isin(class_flat, flag_values))
+            instr.count("pixc.points_kept_class", idx.size)
+
+            lat_flat = nc.latitude.values.ravel()[idx]
+            lon_flat = nc.longitude.values.ravel()[idx]
+            class_flat = class_flat[idx]
+
+            ## Trim data to the AOI before reading anything else
+            if aoi is not None:
+                in_aoi = aoi.mask(lon_flat, lat_flat)
+                idx = idx[in_aoi]
+                lat_flat = lat_flat[in_aoi]
+                lon_flat = lon_flat[in_aoi]
+                class_flat = class_flat[in_aoi]
+            instr.count("pixc.points_kept_aoi", idx.size)
+
+        runs = pixcIndexRuns(idx, max_gap=max_gap)
+
+        # read kept ranges of the remaining variables
+        values = {}
+        with instr.stage("readPIXC.variables"):
+            for var in pixc_variables:
+                parts = []
+                for start, stop in runs:
+                    block = nc[var][start:stop].values.ravel()
+                    run_idx = idx[np.searchsorted(idx, start):np.searchsorted(idx, stop)]
+                    parts.append(block[run_idx - start])
+                values[var] = np.concatenate(parts) if parts else np.array([], dtype=nc[var].dtype)
+
+    height = values["height"]
+    geoid = values["geoid"]
+    solid_earth_tide = values["solid_earth_tide"]
+    load_tide = values["load_tide_fes"]
+    pole_tide = values["pole_tide"]
+
+    # correction for solid earth/load/pole tide effects (e.g., see SWOT User Handbook, section 3.1.25)
+    heightEGM = height - geoid - solid_earth_tide - load_tide - pole_tide
+
+    # create geodataframe
+    data = {
+        "height": height,
+        "heightEGM": heightEGM,
+        "lat": lat_flat,
+        "lon": lon_flat,
+        "geoid": geoid,
+        "solid_earth_tide":solid_earth_tide,
+        "load_tide":load_tide,
+        "pole_tide":pole_tide,
+        "class": class_flat,
+        "water_frac": values["water_frac"],
+        "phase_noise_std": values["phase_noise_std"],
+        "dheight_dphase": values["dheight_dphase"],
+        "sig0": values["sig0"],
+    }
+    gdf = points_to_gdf(pd.DataFrame(data), x="lon", y="lat", crs="EPSG:4326")
 
     return gdf
 
-def download_granule_list(granule_list, download_path, aoi: gpd.GeoDataFrame = None, classes=['open_water'], redownload=False):
+class GranuleManifest:
+    # On-disk record of processed granules, keyed by granule ID (file name without .nc).
+    # Stores status, byte sizes, output checksum, the classes and AOI hash used and the
+    # output path, so reruns can skip finished work without re-deriving it from CMR results.
+
+    columns = ["granule_id", "status", "raw_bytes", "output_bytes", "output_sha256",
+               "classes", "aoi_hash", "output_path", "n_points", "error", "updated"]
+
+    # classes of adopted trimmed files, from runs before the manifest
+    legacy_classes = "open_water"
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.con = sqlite3.connect(manifest_path)
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS granules ("
+            "granule_id TEXT PRIMARY KEY, status TEXT, raw_bytes INTEGER, output_bytes INTEGER, "
+            "output_sha256 TEXT, classes TEXT, aoi_hash TEXT, output_path TEXT, n_points INTEGER, "
+            "error TEXT, updated TEXT)"
+        )
+        self.con.commit()
+
+    def get(self, granule_id):
+        row = self.con.execute("SELECT * FROM granules WHERE granule_id = ?", (granule_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(self.columns, row))
+
+    def update(self, granule_id, **fields):
+        fields["updated"] = datetime.datetime.now().isoformat(timespec="seconds")
+        record = self.get(granule_id) or {"granule_id": granule_id}
+        record.update(fields)
+        values = [record.get(c) for c in self.columns]
+        self.con.execute(
+            f"INSERT OR REPLACE INTO granules ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))})",
+            values
+        )
+        self.con.commit()
+
+    def is_done(self, granule_id, classes_key, aoi_hash, output_path):
+        # finished with the same settings and output still on disk as recorded (size and checksum)
+        record = self.get(granule_id)
+        if record is None or record["status"] != "done":
+            return False
+        # adopted trimmed files (classes None) count as trimmed with the default classes
+        classes = self.legacy_classes if record["classes"] is None else record["classes"]
+        return (
+            classes == classes_key
+            and record["aoi_hash"] == aoi_hash
+            and record["output_path"] == output_path
+            and os.path.exists(output_path)
+            and os.path.getsize(output_path) == record["output_bytes"]
+            and fileChecksum(output_path) == record["output_sha256"]
+        )
+
+    def to_dataframe(self):
+        return pd.read_sql_query("SELECT * FROM granules", self.con)
+
+    def close(self):
+        self.con.close()
+
+
+def fileChecksum(path, blocksize=2**20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def granuleFilename(granule):
+    # file name of the granule netCDF, taken from its data links
+    links = granule.data_links() if callable(granule.data_links) else granule.data_links
+    for link in links:
+        filename = link.rstrip("/").split("/")[-1]
+        if filename.endswith(".nc"):
+            return filename
+    raise ValueError(f"No netCDF data link found for granule: {links}")
+
+
+@instr.timed
+def trimGranule(filepath, savepath, aoi=None, classes=('open_water',)):
+    # Process a downloaded granule to the AOI, save trimmed data and remove the raw file.
+    # Module level so it can be shipped to a process pool.
+    # The output is written to a temporary file and renamed, so a crash never leaves
+    # a file that looks complete.
+    #
+    # Returns dict of raw/output byte sizes, output checksum, number of points and
+    # the index statistics of the trimmed points
+
+    tmp_savepath = savepath + ".part"
+    try:
+        raw_bytes = os.path.getsize(filepath)
+        gdf_pixc = readPIXC(filepath, aoi=aoi, classes=classes)
+        with instr.stage("trimGranule.write"):
+            if savepath.endswith(".parquet"):
+                write_trimmed_pixc(gdf_pixc, tmp_savepath, time=parse_pixc_filename(filepath)["start"])
+            else:
+                gdf_pixc.to_file(tmp_savepath, driver="GeoJSON")
+        instr.count("pixc.bytes_written", os.path.getsize(tmp_savepath))
+        checksum = fileChecksum(tmp_savepath)
+        os.replace(tmp_savepath, savepath)
+    finally:
+        if os.path.exists(tmp_savepath):
+            os.remove(tmp_savepath)
+        # remove raw file to save space, also on failure so it does not hold a download slot
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    return {
+        "raw_bytes": raw_bytes,
+        "output_bytes": os.path.getsize(savepath),
+        "output_sha256": checksum,
+        "n_points": len(gdf_pixc),
+        "stats": trimmed_stats(gdf_pixc),
+    }
+
+
+def download_granule_list(granule_list, download_path, aoi: gpd.GeoDataFrame = None, classes=('open_water',), redownload=False,
+                          n_downloads=1, n_workers=1, max_raw_files=None, download_func=None, manifest_path=None,
+                          output_format="parquet", index_path=None):
+
+    # granule_list: earthaccess granules to download and trim
+    # download_path: folder to download raw .nc files to and save trimmed files in
+    # aoi: area of interest to trim the pixel cloud to (EPSG:4326)
+    # classes: pixel cloud classes to keep
+    # redownload: reprocess granules even if they are recorded as done in the manifest
+    # n_downloads: number of concurrent downloads
+    # n_workers: number of processes trimming downloaded granules
+    # max_raw_files: max number of raw .nc files on disk at once (default n_downloads + n_workers)
+    # download_func: function(granule, download_path) fetching a granule, defaults to earthaccess.download
+    # manifest_path: SQLite manifest of processed granules (default pixc_manifest.sqlite in download_path)
+    # output_format: 'parquet' (GeoParquet, see pixc_io) or 'geojson' for the trimmed files
+    # index_path: PixcIndex of the trimmed files, updated as granules finish (default pixc_index.sqlite in download_path)
+    #
+    # Granules are skipped when the manifest records them as done with the same classes
+    # and AOI and their trimmed file is unchanged (size and checksum). Failed, partial,
+    # stale or changed granules are reprocessed. Trimmed files without a manifest record
+    # (older runs) are adopted as trimmed with the default classes and the AOI passed.
+    #
+    # Returns dict of {filename: exception} for granules that failed
+
+    if download_func is None:
+        download_func = earthaccess.download
+    if manifest_path is None:
+        manifest_path = os.path.join(download_path, "pixc_manifest.sqlite")
+
+    if index_path is None:
+        index_path = os.path.join(download_path, "pixc_index.sqlite")
+
+    manifest = GranuleManifest(manifest_path)
+    pixc_index = PixcIndex(index_path)
+    classes_key = ",".join(sorted(classes))
+    aoi_key = aoi_hash(aoi)
+    clipper = AOIClipper(aoi, crs="EPSG:4326") if aoi is not None else None
+    settings = {"classes": classes_key, "aoi_hash": aoi_key}
+
+    todo = []
+    n_skipped = 0
     for granule in granule_list:
 
-        # # check if already downloaded
-        filename = str(granule.data_links).split("['https://archive.swot.podaac.earthdata.nasa.gov/podaac-swot-ops-cumulus-protected/SWOT_L2_HR_PIXC_D/")[1].split("']")[0]
-        
-        # check if trimmed data exists
-        savepath = os.path.join(download_path, filename.replace(".nc", "_trimmed.geojson"))
-        if os.path.exists(savepath) and redownload==False:
-            print(f"Trimmed file {savepath} already exists, skipping download and processing.")
+        filename = granuleFilename(granule)
+        granule_id = filename.replace(".nc", "")
+        savepath = os.path.join(download_path, filename.replace(".nc", f"_trimmed.{output_format}"))
+
+        record = manifest.get(granule_id)
+        if (record is None or record["output_path"] != savepath) and os.path.exists(savepath):
+            # trimmed file not recorded in the manifest (older run or converted archive): it is adopted as done,
+            # trimmed with the default classes and this AOI, and only reprocessed for other classes or redownload
+            try:
+                n_points = trimmed_point_count(savepath) if output_format == "parquet" else len(gpd.read_file(savepath))
+                manifest.update(granule_id, status="done", output_bytes=os.path.getsize(savepath),
+                                output_sha256=fileChecksum(savepath), output_path=savepath, n_points=n_points,
+                                classes=None, aoi_hash=aoi_key, error=None)
+                pixc_index.add_files([savepath])
+                print(f"Existing trimmed file {os.path.basename(savepath)} has no manifest record, adopted.")
+            except Exception:
+                print(f"Existing trimmed file {savepath} is unreadable, reprocessing.")
+
+        # check if trimmed data exists for these settings
+        if manifest.is_done(granule_id, classes_key, aoi_key, savepath) and not redownload:
+            n_skipped += 1
             continue
 
         filepath = os.path.join(download_path, filename)
-        if not os.path.exists(filepath):
-            earthaccess.download(granule, download_path)
+        todo.append((granule, filepath, savepath))
 
+    print(f"Skipping {n_skipped} granules already processed, processing {len(todo)} granules.")
 
-        # Once downloaded, process to AOI and save trimmed data
-        gdf_pixc = readPIXC(filepath, aoi=aoi, classes=classes)
+    def record_result(filepath, savepath, result=None, error=None):
+        filename = os.path.basename(filepath)
+        if error is not None:
+            manifest.update(filename.replace(".nc", ""), status="failed", error=repr(error), **settings)
+        else:
+            result = dict(result)
+            pixc_index.add(savepath, result.pop("stats"))
+            manifest.update(filename.replace(".nc", ""), status="done", output_path=savepath, error=None,
+                            **settings, **result)
+
+    try:
+        if n_downloads <= 1 and n_workers <= 1:
+            failed = {}
+            for granule, filepath, savepath in todo:
+                try:
+                    _fetchGranule(granule, filepath, download_path, download_func)
+
+                    # Once downloaded, process to AOI and save trimmed data
+                    result = trimGranule(filepath, savepath, aoi=clipper, classes=classes)
+                except Exception as e:
+                    print(f"Failed processing {os.path.basename(filepath)}: {e}")
+                    failed[os.path.basename(filepath)] = e
+                    record_result(filepath, savepath, error=e)
+                    continue
+                record_result(filepath, savepath, result=result)
+            return failed
+
+        return _pipelineGranules(todo, download_path, clipper, classes, n_downloads, n_workers, max_raw_files,
+                                 download_func, record_result)
+    finally:
+        manifest.close()
+        pixc_index.close()
+
+
+def _fetchGranule(granule, filepath, download_path, download_func):
+    # download granule unless the raw file is already on disk
+    if os.path.exists(filepath):
+        return filepath
+
+    try:
+        with instr.stage("download"):
+            download_func(granule, download_path)
+    except BaseException:
+        # do not leave partial downloads behind
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        raise
+
+    # earthaccess logs failed downloads instead of raising
+    if not os.path.exists(filepath):
+        raise FileNotFoundError(f"Download did not produce {filepath}")
+
+    instr.count("pixc.granules_downloaded")
+    instr.count("pixc.bytes_downloaded", os.path.getsize(filepath))
+    return filepath
+
+
+def _pipelineGranules(todo, download_path, aoi, classes, n_downloads, n_workers, max_raw_files, download_func, record_result):
+
+    # Downloads run on a thread pool and feed a process pool of trim workers.
+    # A raw file slot is taken before each download and given back once the
+    # trim worker has removed the raw file, so at most max_raw_files .nc files
+    # are ever on disk. Results are recorded from the main thread only.
+    if max_raw_files is None:
+        max_raw_files = n_downloads + n_workers
+    raw_slots = threading.BoundedSemaphore(max(1, max_raw_files))
+
+    def fetch(granule, filepath):
+        raw_slots.acquire()
+        try:
+            return _fetchGranule(granule, filepath, download_path, download_func)
+        except BaseException:
+            raw_slots.release()
+            raise
+
+    def release(trim_future, filepath):
+        # a worker that died (BrokenProcessPool) never removed its raw file, remove it before
+        # its slot is given back
+        if trim_future.exception() is not None and os.path.exists(filepath):
+            os.remove(filepath)
+        raw_slots.release()
+
+    failed = {}
+    n_done = 0
+    instrument = instr.worker_settings()
+    with ThreadPoolExecutor(max_workers=max(1, n_downloads)) as download_pool, \
+            ProcessPoolExecutor(max_workers=max(1, n_workers)) as trim_pool:
+
+        fetches = {download_pool.submit(fetch, granule, filepath): (filepath, savepath) for granule, filepath, savepath in todo}
+        trims = {}
+        for fetch_future in as_completed(fetches):
+            filepath, savepath = fetches[fetch_future]
+            filename = os.path.basename(filepath)
+            try:
+                fetch_future.result()
+            except Exception as e:
+                print(f"Failed downloading {filename}: {e}")
+                failed[filename] = e
+                record_result(filepath, savepath, error=e)
+                continue
+
+            try:
+                trim_future = trim_pool.submit(instr.run_in_worker, instrument, trimGranule, filepath, savepath, aoi,
+                                               classes)
+            except Exception as e:
+                # the raw file never reaches a worker (e.g. the pool broke), remove it and give its slot back
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                raw_slots.release()
+                print(f"Failed processing {filename}: {e}")
+                failed[filename] = e
+                record_result(filepath, savepath, error=e)
+                continue
+            trim_future.add_done_callback(lambda future, filepath=filepath: release(future, filepath))
+            trims[trim_future] = (filepath, savepath)
 
-        # save to geojson
-        gdf_pixc.to_file(savepath)
+        for trim_future in as_completed(trims):
+            filepath, savepath = trims[trim_future]
+            filename = os.path.basename(filepath)
+            try:
+                result, worker_records = trim_future.result()
+            except Exception as e:
+                print(f"Failed processing {filename}: {e}")
+                failed[filename] = e
+                record_result(filepath, savepath, error=e)
+                continue
+            instr.merge(worker_records)
+            record_result(filepath, savepath, result=result)
+            n_done += 1
+            print(f"Processed {filename} ({result['n_points']} points) [{n_done}/{len(todo)}]")
 
-        # close file and remove to save space
-        os.remove(filepath)
\ No newline at end of file
+    return failed
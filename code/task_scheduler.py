@@ -0,0 +1,172 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+from tqdm import tqdm
+import instrumentation as instr
+
+# Small dependency-aware task runner for the file pipelines (e.g. S2 composites -> pngs -> gifs).
+# Every task is one function call with the files it reads and writes; a task starts once the
+# tasks it depends on are done, and is skipped when its outputs are newer than its inputs.
+# Tasks run on a process pool, at most n_workers at a time, and tasks unlocked by a finished
+# task go first so each chain (e.g. one box) completes early. A failed task blocks its dependents.
+
+
+class Task:
+
+    def __init__(self, name, stage, func, args=(), kwargs=None, inputs=(), outputs=(), deps=(), up_to_date=None):
+
+        # name: unique task name, e.g. 'composite b1 2024-03'
+        # stage: stage name used in the progress/timing report, e.g. 'composite'
+        # func, args, kwargs: the call, func must be importable (module level) to run on a process pool
+        # inputs, outputs: files read and written, for the default up-to-date check
+        # deps: names of the tasks that must be done first
+        # up_to_date: function() -> bool replacing the default check (all outputs exist and are
+        #             newer than all existing inputs; tasks without outputs always run)
+
+        self.name = name
+        self.stage = stage
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self._up_to_date = up_to_date
+
+    def up_to_date(self):
+        if self._up_to_date is not None:
+            return self._up_to_date()
+        if not self.outputs or not all(os.path.exists(f) for f in self.outputs):
+            return False
+        inputs = [os.path.getmtime(f) for f in self.inputs if os.path.exists(f)]
+        return not inputs or min(os.path.getmtime(f) for f in self.outputs) >= max(inputs)
+
+    def __repr__(self):
+        return f"Task({self.name!r}, stage={self.stage!r}, deps={len(self.deps)})"
+
+
+def _timed_call(stage, func, args, kwargs):
+    # runs in the worker: result and duration of one task, recorded as stage task.{stage} when instrumented
+    t0 = time.perf_counter()
+    with instr.stage(f"task.{stage}"):
+        result = func(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def _done_future(func, *args):
+    # run now and wrap the outcome like a pool future (serial runs)
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def run_tasks(tasks, n_workers=4, force=False):
+
+    # tasks: list of Task, dependencies must be in the list
+    # n_workers: number of worker processes, 1 runs every task in this process
+    # force: run tasks even if their outputs are up to date
+    # Returns DataFrame with one row per task: name, stage, status ('done', 'skipped', 'failed',
+    # 'blocked' when a dependency failed), seconds, start, end (seconds since the run started),
+    # result and error
+
+    by_name = {task.name: task for task in tasks}
+    if len(by_name) != len(tasks):
+        raise ValueError("Task names must be unique")
+    dependents = {name: [] for name in by_name}
+    waiting = {}
+    for task in tasks:
+        missing = [d for d in task.deps if d not in by_name]
+        if missing:
+            raise ValueError(f"{task.name} depends on unknown tasks: {missing}")
+        for d in task.deps:
+            dependents[d].append(task.name)
+        waiting[task.name] = len(task.deps)
+
+    ready = deque(name for name in by_name if waiting[name] == 0)
+    records = {}
+    stage_left = {}
+    for task in tasks:
+        stage_left[task.stage] = stage_left.get(task.stage, 0) + 1
+    t_run = time.perf_counter()
+    instrument = instr.worker_settings()
+    pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    progress = tqdm(total=len(tasks), desc="Tasks")
+
+    def finish(name, status, **record):
+        stage = by_name[name].stage
+        records[name] = {"name": name, "stage": stage, "status": status, **record}
+        progress.update()
+        stage_left[stage] -= 1
+        if stage_left[stage] == 0:
+            done = [r for r in records.values() if r["stage"] == stage]
+            statuses = pd.Series([r["status"] for r in done]).value_counts()
+            first = min((r["start"] for r in done if "start" in r), default=None)
+            wall = "" if first is None else f" in {time.perf_counter() - t_run - first:.1f} s"
+            tqdm.write(f"Stage {stage} finished{wall}: " + ", ".join(f"{n} {s}" for s, n in statuses.items()))
+        if status in ("failed", "blocked"):
+            # dependents of a failed task never become ready
+            for d in dependents[name]:
+                if d not in records:
+                    finish(d, "blocked", error=f"dependency {name} {status}")
+            return
+        for d in dependents[name]:
+            waiting[d] -= 1
+            if waiting[d] == 0:
+                # unlocked tasks go first
+                ready.appendleft(d)
+
+    running = {}
+    try:
+        while ready or running:
+            while ready and len(running) < max(n_workers, 1):
+                name = ready.popleft()
+                if name in records:
+                    continue
+                task = by_name[name]
+                if not force and task.up_to_date():
+                    finish(name, "skipped")
+                    continue
+                start = time.perf_counter() - t_run
+                submit = pool.submit if pool is not None else _done_future
+                running[submit(instr.run_in_worker, instrument, _timed_call, task.stage, task.func, task.args,
+                               task.kwargs)] = (name, start)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, start = running.pop(future)
+                end = time.perf_counter() - t_run
+                try:
+                    (result, seconds), worker_records = future.result()
+                except Exception as e:
+                    tqdm.write(f"Failed {name}: {e!r}")
+                    finish(name, "failed", start=start, end=end, error=repr(e))
+                else:
+                    instr.merge(worker_records)
+                    finish(name, "done", seconds=seconds, start=start, end=end, result=result)
+    finally:
+        progress.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    for name in by_name:
+        if name not in records:
+            records[name] = {"name": name, "stage": by_name[name].stage, "status": "blocked",
+                             "error": "dependency cycle"}
+
+    report = pd.DataFrame([records[task.name] for task in tasks],
+                          columns=["name", "stage", "status", "seconds", "start", "end", "result", "error"])
+    return report
+
+
+def stage_summary(report):
+    # per stage: number of tasks by status, summed task time, and wall time from first start to last end
+    counts = report.pivot_table(index="stage", columns="status", values="name", aggfunc="count", fill_value=0)
+    timing = report.groupby("stage").agg(task_s=("seconds", "sum"), first_start=("start", "min"), last_end=("end", "max"))
+    timing["wall_s"] = timing["last_end"] - timing["first_start"]
+    order = list(dict.fromkeys(report["stage"]))
+    return counts.join(timing[["task_s", "wall_s"]]).reindex(order).fillna({"task_s": 0, "wall_s": 0})
@@ -0,0 +1,244 @@
+import os
+import glob
+import hashlib
+import numpy as np
+import pandas as pd
+import rasterio
+import eo_tools as eot
+import raster_io as rio
+import instrumentation as instr
+from datacube import RasterCube
+from grid_spec import GridSpec
+
+# Temporal roll-up of the per-date gridded products to any pandas frequency: weekly ('W-MON', '7D'),
+# monthly ('MS'), seasonal ('QS-DEC': DJF, MAM, JJA, SON), hydrological year ('YS-OCT'), ...
+# Every band is aggregated as the count-weighted mean of the per-date values (weights from the count
+# band), counts are summed and an n_dates band counts the dates with points in each cell.
+# Each level is cached as a RasterCube (one time step per period, dated by its start) in cache_dir.
+# A level is built from the coarsest cached level whose periods nest in it (e.g. seasons and
+# hydrological years from months), and from the per-date products otherwise (e.g. weeks or months).
+# Weighted means of weighted means with summed counts are the same as from the dates, so chained
+# levels match levels built from the per-date products (up to float32 storage), as long as bands
+# are finite wherever count > 0. Every period stores a key of the dates it was built from; periods
+# whose dates changed (e.g. new dates appended to the datacube) are rebuilt, the others are kept.
+
+
+def period_edges(freq, first, last):
+    # start dates of the periods of freq covering first..last, followed by the start of the next period
+    # Tick frequencies ('7D', '10D') are aligned to 1970-01-01, anchored ones ('W-MON', 'MS') to their anchor
+    offset = pd.tseries.frequencies.to_offset(freq)
+    first = pd.Timestamp(first).normalize()
+    if isinstance(offset, pd.offsets.Tick):
+        start = first.floor(offset)
+    else:
+        start = offset.rollback(first)
+    edges = pd.date_range(start, pd.Timestamp(last).normalize() + offset, freq=offset)
+    return edges[:np.searchsorted(edges, pd.Timestamp(last), side="right") + 1]
+
+
+def _period_index(edges, dates):
+    return np.searchsorted(edges, pd.DatetimeIndex(dates), side="right") - 1
+
+
+def _dates_key(dates):
+    return hashlib.sha1(",".join(sorted(str(d) for d in dates)).encode()).hexdigest()
+
+
+class _DateSource:
+    # per-date products read one map at a time, from a RasterCube or per-date multi-band GeoTIFFs
+
+    def __init__(self, source):
+        if isinstance(source, str):
+            self.cube = RasterCube(source)
+            self.grid = self.cube.grid
+            self.bands = list(self.cube.bands)
+            self.dates = pd.DatetimeIndex(self.cube.dates)
+        else:
+            self.cube = None
+            files = list(source)
+            self.grid = GridSpec.from_raster(files[0])
+            with rasterio.open(files[0]) as src:
+                self.bands = list(src.descriptions)
+            self.files = dict(zip(eot.raster_dates(files), files))
+            self.dates = pd.DatetimeIndex(sorted(self.files))
+
+    def read(self, bands, date):
+        instr.count("aggregate.maps_read")
+        if self.cube is not None:
+            return {band: self.cube.read_map(band, date) for band in bands}
+        with rasterio.open(self.files[pd.Timestamp(date)]) as src:
+            return {band: rio.read_scaled(src, src.descriptions.index(band) + 1, dtype=np.float64) for band in bands}
+
+    def close(self):
+        if self.cube is not None:
+            self.cube.close()
+
+
+class TemporalAggregator:
+
+    def __init__(self, source, cache_dir, bands=None, count_band="count"):
+
+        # source: per-date products, a RasterCube path (e.g. datacube_res100.nc of generate_pixc_raster.py)
+        #         or a list of per-date multi-band GeoTIFFs (date from the file name, see eo_tools.raster_dates)
+        # cache_dir: folder of the cached levels, level_{freq}.nc
+        # bands: bands to aggregate, default every band of the source but the count band
+        # count_band: band holding the number of points per cell, the weights of the means
+
+        self.source = _DateSource(source)
+        if count_band not in self.source.bands:
+            raise ValueError(f"Source has no {count_band!r} band to weight by, bands are {self.source.bands}")
+        self.count_band = count_band
+        self.bands = [b for b in (bands or self.source.bands) if b not in (count_band, "n_dates")]
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def level_path(self, freq):
+        return os.path.join(self.cache_dir, f"level_{freq}.nc")
+
+    def cached_levels(self):
+        # {freq: path} of the cached levels on the source grid holding all aggregated bands
+        levels = {}
+        for path in glob.glob(os.path.join(self.cache_dir, "level_*.nc")):
+            cube = RasterCube(path)
+            try:
+                if cube.grid.same_grid(self.source.grid) and set(self.bands) <= set(cube.bands):
+                    levels[cube.ds.freq] = path
+            finally:
+                cube.close()
+        return levels
+
+    def _nests(self, fine, coarse, first, last):
+        # every period of fine lies within one period of coarse (over first..last) and fine is finer
+        fine_edges = period_edges(fine, first, last)
+        coarse_edges = period_edges(coarse, fine_edges[0], fine_edges[-1])
+        if len(fine_edges) <= len(coarse_edges):
+            return False
+        starts = _period_index(coarse_edges, fine_edges[:-1])
+        ends = _period_index(coarse_edges, fine_edges[1:] - pd.Timedelta(days=1))
+        return bool(np.all(starts == ends))
+
+    @instr.timed
+    def aggregate(self, freq, start=None, end=None, force=False):
+
+        # Build or update the level of freq, returns the path of its RasterCube.
+        # freq: pandas frequency, e.g. 'W-MON', 'MS', 'QS-DEC', 'YS-OCT'
+        # start, end: only periods overlapping these dates, default all dates of the source
+        # force: rebuild the periods even if their dates did not change
+
+        dates = self.source.dates
+        if start is not None:
+            dates = dates[dates >= pd.Timestamp(start)]
+        if end is not None:
+            dates = dates[dates <= pd.Timestamp(end)]
+        if len(dates) == 0:
+            raise ValueError("No dates to aggregate")
+        edges = period_edges(freq, dates.min(), dates.max())
+        # all source dates of the overlapping periods, not only those within start..end
+        all_dates = self.source.dates
+        all_dates = all_dates[(all_dates >= edges[0]) & (all_dates < edges[-1])]
+        period = _period_index(edges, all_dates)
+
+        path = self.level_path(freq)
+        cube = self._open_level(path, freq)
+        keys = self._keys(cube)
+        cube.close()
+        todo = []
+        for i in np.unique(period):
+            key = _dates_key(d.date() for d in all_dates[period == i])
+            if force or keys.get(edges[i].date()) != key:
+                todo.append((edges[i], edges[i + 1], key))
+        if not todo:
+            return path
+
+        # the source level is updated first, with this level closed
+        source, source_freq = self._source_level(freq, edges[0], edges[-1] - pd.Timedelta(days=1), force)
+        print(f"Aggregating {len(todo)} {freq} periods from {source_freq}")
+        cube = self._open_level(path, freq)
+        try:
+            for period_start, period_end, key in todo:
+                self._build_period(cube, source, period_start, period_end, key)
+        finally:
+            cube.close()
+            if source is not self.source:
+                source.close()
+        return path
+
+    def aggregate_levels(self, freqs, **kwargs):
+        # build levels in order, finest first so coarser ones can be built from them
+        # Returns {freq: path}
+        return {freq: self.aggregate(freq, **kwargs) for freq in freqs}
+
+    def _source_level(self, freq, first, last, force):
+        # coarsest cached level nesting in freq, brought up to date over first..last, else the per-date products
+        candidates = []
+        for level_freq in self.cached_levels():
+            if level_freq != freq and self._nests(level_freq, freq, first, last):
+                candidates.append((len(period_edges(level_freq, first, last)), level_freq))
+        if not candidates:
+            return self.source, "dates"
+        _, level_freq = min(candidates)
+        self.aggregate(level_freq, start=first, end=last, force=force)
+        return _DateSource(self.level_path(level_freq)), level_freq
+
+    def _build_period(self, cube, source, period_start, period_end, key):
+        # count-weighted means of one period from the dates (or finer periods) of the source
+        dates = source.dates[(source.dates >= period_start) & (source.dates < period_end)]
+        is_level = "n_dates" in source.bands
+        shape = self.source.grid.shape
+        sums = {band: np.zeros(shape) for band in self.bands}
+        weights = {band: np.zeros(shape) for band in self.bands}
+        count = np.zeros(shape)
+        n_dates = np.zeros(shape)
+        for date in dates:
+            maps = source.read(self.bands + [self.count_band] + (["n_dates"] if is_level else []), date)
+            c = np.nan_to_num(maps[self.count_band])
+            count += c
+            n_dates += np.nan_to_num(maps["n_dates"]) if is_level else (c > 0)
+            for band in self.bands:
+                values = maps[band]
+                w = np.where(np.isfinite(values), c, 0.0)
+                sums[band] += np.where(w > 0, values, 0.0) * w
+                weights[band] += w
+        with np.errstate(invalid="ignore", divide="ignore"):
+            bands = {band: sums[band] / weights[band] for band in self.bands}
+        bands[self.count_band] = count
+        bands["n_dates"] = n_dates
+        cube.append(period_start, bands)
+        i = cube.dates.index(period_start.date())
+        cube.ds.variables["dates_key"][i] = key
+        instr.count("aggregate.periods_built")
+
+    def _open_level(self, path, freq):
+        # one period per chunk: periods are written and read as whole maps
+        cube = RasterCube.open(path, grid=self.source.grid, bands=self.bands + [self.count_band, "n_dates"],
+                               time_chunk=1)
+        if "dates_key" not in cube.ds.variables:
+            cube.ds.freq = freq
+            cube.ds.count_band = self.count_band
+            cube.ds.aggregation = "count-weighted mean"
+            cube.ds.createVariable("dates_key", str, ("time",))
+        elif set(self.bands) - set(cube.bands):
+            cube.close()
+            raise ValueError(f"{path} does not hold all bands {self.bands}, remove it to rebuild")
+        return cube
+
+    @staticmethod
+    def _keys(cube):
+        # {period start: key of the dates it was built from}
+        keys = cube.ds.variables["dates_key"]
+        return {date: keys[i] for i, date in enumerate(cube.dates)}
+
+    def level(self, freq):
+        # cached level of freq as an open RasterCube (read_map, time_series, export_geotiffs), build it first
+        return RasterCube(self.level_path(freq))
+
+    def export_geotiffs(self, freq, out_dir, bands=None):
+        # one multi-band GeoTIFF per period, named {freq}_{period start}_res{resolution}.tif
+        cube = self.level(freq)
+        try:
+            return cube.export_geotiffs(out_dir, bands=bands, filename=f"{freq}_{{date}}_res{{resolution:g}}.tif")
+        finally:
+            cube.close()
+
+    def close(self):
+        self.source.close()
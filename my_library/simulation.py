@@ -1,10 +1,16 @@
 """The simulation module"""
 
+import os
+
 import numpy as np
 
+# SWOT PIXC classification codes, in the order of swot_download_tools.translateClass
+PIXC_CLASSES = ("land", "land_near_water", "water_near_land", "open_water", "dark_water",
+                "low_coh_water_near_land", "open_low_coh_water")
+
 
 class Simulator:
-    def __init__(self, name: str, low: float = 0.0, high: float = 1.0) -> None:
+    def __init__(self, name: str, low: float = 0.0, high: float = 1.0, seed: int | None = None) -> None:
         """Create a new simulator
 
         Parameters
@@ -15,6 +21,8 @@ class Simulator:
             lower bound
         high: float, optional
             upper bound
+        seed: int, optional
+            seed of the random generator, None for a random seed
 
         Examples
         --------
@@ -23,6 +31,7 @@ class Simulator:
         self._name = name
         self._low = low
         self._high = high
+        self._rng = np.random.default_rng(seed)
 
     def simulate(self, n_samples: int = 1) -> np.ndarray:
         """Sample random numbers
@@ -36,4 +45,140 @@ class Simulator:
         -------
         np.ndarray
         """
-        return np.random.uniform(low=self._low, high=self._high, size=n_samples)
+        return self._rng.uniform(low=self._low, high=self._high, size=n_samples)
+
+    def pixc_granule(self, path: str, bounds: tuple, n_lines: int = 2000, n_pixels: int = 1000,
+                     water_fraction: float = 0.2, aoi_overlap: float = 0.3, tile_length: float = 0.6,
+                     swath_width: float = 0.55) -> str:
+        """Write a synthetic SWOT L2 HR PIXC granule
+
+        The netCDF has a ``pixel_cloud`` group with the variables read by
+        ``readPIXC`` and classification codes 1-7 as in ``translateClass``.
+        Points are ordered along-track, line by line, like a PIXC tile.
+
+        Parameters
+        ----------
+        path: str
+            output netCDF file
+        bounds: tuple
+            (minx, miny, maxx, maxy) lon/lat bounding box of the AOI
+        n_lines: int, optional
+            number of along-track lines
+        n_pixels: int, optional
+            number of cross-track pixels per line
+        water_fraction: float, optional
+            fraction of points classified as water (classes 3-7), the rest is land (1-2)
+        aoi_overlap: float, optional
+            fraction of the lines inside the AOI bounding box, the rest lies north of it
+        tile_length: float, optional
+            along-track extent in degrees (0.6 is about 64 km)
+        swath_width: float, optional
+            cross-track extent in degrees, centred on the AOI
+
+        Returns
+        -------
+        str
+            path
+        """
+        import xarray as xr
+
+        rng = self._rng
+        minx, _, maxx, maxy = bounds
+        line_lat = maxy + (1 - aoi_overlap) * tile_length - np.arange(n_lines) * tile_length / n_lines
+        pixel_lon = (minx + maxx) / 2 - swath_width / 2 + np.arange(n_pixels) * swath_width / n_pixels
+        lat = np.repeat(line_lat, n_pixels)
+        lon = np.tile(pixel_lon, n_lines)
+        n = lat.size
+
+        is_water = rng.random(n) < water_fraction
+        classification = np.where(is_water, rng.choice([3, 4, 5, 6, 7], n, p=[0.2, 0.5, 0.1, 0.1, 0.1]),
+                                  rng.choice([1, 2], n)).astype(np.int8)
+
+        def noise(loc, scale):
+            return rng.normal(loc, scale, n).astype(np.float32)
+
+        variables = {
+            "latitude": lat,
+            "longitude": lon,
+            "classification": classification,
+            "height": noise(1030, 2),
+            "geoid": noise(-15, 0.1),
+            "solid_earth_tide": noise(0, 0.1),
+            "load_tide_fes": noise(0, 0.01),
+            "pole_tide": noise(0, 0.001),
+            "water_frac": np.clip(noise(0.8, 0.3), 0, 1.5),
+            "phase_noise_std": np.abs(noise(0.05, 0.02)),
+            "dheight_dphase": noise(10, 2),
+            "sig0": np.abs(noise(20, 10)),
+        }
+        ds = xr.Dataset({k: ("points", v) for k, v in variables.items()})
+        ds.classification.attrs["flag_meanings"] = " ".join(PIXC_CLASSES)
+        ds.classification.attrs["flag_values"] = np.arange(1, len(PIXC_CLASSES) + 1, dtype=np.int8)
+        encoding = {k: {"zlib": True, "complevel": 1, "chunksizes": (min(n, 50000),)} for k in variables}
+
+        xr.Dataset(attrs={"title": f"synthetic SWOT L2 HR PIXC ({self._name})"}).to_netcdf(path, mode="w")
+        ds.to_netcdf(path, mode="a", group="pixel_cloud", encoding=encoding)
+        return path
+
+    def s2_stack(self, folder: str, n_scenes: int = 20, height: int = 2000, width: int = 2000,
+                 cloud_fraction: float = 0.3, compress: str | None = None, year: int = 2024, month: int = 3) -> list:
+        """Write a stack of synthetic Sentinel-2 RGB GeoTIFFs
+
+        Scenes are 3-band float32 GeoTIFFs on the same 10 m UTM 37S grid, named like
+        the exports (``S2_RGB_YYYY-MM-DD_{i}.tif``), all in one month. Every scene is
+        the same smooth surface plus noise, with cloud patches set to NaN. Existing
+        files are kept.
+
+        Parameters
+        ----------
+        folder: str
+            output folder, created if missing
+        n_scenes: int, optional
+            number of scenes
+        height, width: int, optional
+            scene size in pixels
+        cloud_fraction: float, optional
+            mean fraction of each scene covered by cloud
+        compress: str, optional
+            GeoTIFF compression, None for uncompressed tiles
+        year, month: int, optional
+            month of the scenes
+
+        Returns
+        -------
+        list
+            paths of the scenes
+        """
+        import rasterio  # type: ignore[import-untyped]
+        import rasterio.transform  # type: ignore[import-untyped]
+
+        os.makedirs(folder, exist_ok=True)
+        rng = self._rng
+        transform = rasterio.transform.from_origin(700000, 9100000, 10, 10)
+        # surface shared by all scenes, varying over ~500 m
+        surface = self._smooth_field((3, height, width), 50, 1000, 300)
+        paths = []
+        for i in range(n_scenes):
+            path = os.path.join(folder, f"S2_RGB_{year}-{month:02d}-{i % 28 + 1:02d}_{i:03d}.tif")
+            paths.append(path)
+            if os.path.exists(path):
+                continue
+            data = surface + rng.normal(0, 50, (3, height, width)).astype(np.float32)
+            clouds = self._smooth_field((height, width), 100, 0, 1)
+            data[:, clouds > np.quantile(clouds, 1 - cloud_fraction)] = np.nan
+            with rasterio.open(path, "w", driver="GTiff", height=height, width=width, count=3, dtype="float32",
+                               crs="EPSG:32737", transform=transform, tiled=True, compress=compress) as dst:
+                dst.write(data)
+        return paths
+
+    def _smooth_field(self, shape: tuple, cell: int, loc: float, scale: float) -> np.ndarray:
+        # normal values on a grid of cell x cell pixel cells, bilinearly interpolated to shape (last two axes)
+        rows, cols = shape[-2:]
+        coarse = self._rng.normal(loc, scale, shape[:-2] + (rows // cell + 2, cols // cell + 2)).astype(np.float32)
+        r = np.arange(rows, dtype=np.float32) / cell
+        c = np.arange(cols, dtype=np.float32) / cell
+        r0, c0 = r.astype(int), c.astype(int)
+        fr, fc = (r - r0)[:, None], (c - c0)[None, :]
+        top = coarse[..., r0, :][..., c0] * (1 - fc) + coarse[..., r0, :][..., c0 + 1] * fc
+        bottom = coarse[..., r0 + 1, :][..., c0] * (1 - fc) + coarse[..., r0 + 1, :][..., c0 + 1] * fc
+        return top * (1 - fr) + bottom * fr
@@ -0,0 +1,100 @@
+"""Offline throughput and peak memory benchmarks of the processing chain
+
+Synthetic SWOT PIXC granules and Sentinel-2 stacks from ``my_library.Simulator``
+are trimmed, loaded, gridded, composited and animated at every scale of
+``conftest.SCALES``. Run with pytest-benchmark, e.g.
+
+    python -m pytest tests/benchmarks/bench_pipeline.py --benchmark-autosave
+    python -m pytest tests/benchmarks/bench_pipeline.py --benchmark-compare --benchmark-compare-fail=mean:20%
+"""
+
+import os
+
+import composite_tools as ct
+import eo_tools as eot
+import numpy as np
+import pandas as pd
+import pixc_io
+import pytest
+import s2_pipeline as s2p
+import swot_download_tools as sdt
+
+
+@pytest.fixture(scope="session")
+def granule(simulator, aoi_ll, sizes, data_dir):
+    n_lines, n_pixels = sizes["pixc"]
+    return simulator.pixc_granule(str(data_dir / "pixc.nc"), tuple(aoi_ll.total_bounds), n_lines=n_lines,
+                                  n_pixels=n_pixels)
+
+
+@pytest.fixture(scope="session")
+def trimmed_files(granule, aoi_ll, sizes, data_dir):
+    gdf = sdt.readPIXC(granule, aoi_ll, classes=["open_water", "water_near_land"])
+    paths = []
+    for i in range(sizes["trimmed_files"]):
+        date = pd.Timestamp("2024-01-01") + pd.Timedelta(days=i)
+        path = str(data_dir / f"SWOT_L2_HR_PIXC_010_{i:03d}_100L_{date:%Y%m%d}T000000_{date:%Y%m%d}T000010_PID0_01_trimmed.parquet")
+        pixc_io.write_trimmed_pixc(gdf, path)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture(scope="session")
+def points_utm(trimmed_files, aoi_utm):
+    return eot.load_trimmed_pixc_data(trimmed_files).to_crs(aoi_utm.crs)
+
+
+@pytest.fixture(scope="session")
+def scenes(simulator, sizes, data_dir):
+    return simulator.s2_stack(str(data_dir / "s2"), n_scenes=sizes["scenes"], height=sizes["scene_size"],
+                              width=sizes["scene_size"])
+
+
+@pytest.fixture(scope="session")
+def monthly_pngs(sizes, data_dir):
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    folder = data_dir / "monthly"
+    folder.mkdir()
+    for dt in pd.date_range("2020-01-01", periods=sizes["frames"], freq="MS"):
+        if rng.random() < 0.3:
+            continue  # month without scenes
+        coarse = rng.integers(0, 255, (25, 30, 3), dtype=np.uint8)
+        Image.fromarray(coarse).resize((600, 500), Image.Resampling.BILINEAR).save(folder / f"S2_RGB_{dt:%Y-%m}_median_b1.png")
+    return str(folder)
+
+
+def test_trim(benchmark, check_memory, granule, aoi_ll):
+    check_memory("trim", sdt.readPIXC, granule, aoi_ll)
+    gdf = benchmark(sdt.readPIXC, granule, aoi_ll)
+    assert len(gdf) > 0
+
+
+def test_load(benchmark, check_memory, trimmed_files):
+    check_memory("load", eot.load_trimmed_pixc_data, trimmed_files)
+    gdf = benchmark(eot.load_trimmed_pixc_data, trimmed_files)
+    benchmark.extra_info["points"] = len(gdf)
+
+
+def test_grid(benchmark, check_memory, points_utm, aoi_utm):
+    fields = ("heightEGM", "water_frac")
+    check_memory("grid", eot.grid_sampling_multi, aoi_utm, points_utm, fields=fields)
+    bands = benchmark(eot.grid_sampling_multi, aoi_utm, points_utm, fields=fields)
+    assert bands["count"].sum() == len(points_utm)
+
+
+def test_composite(benchmark, check_memory, scenes, tmp_path):
+    out_tif = str(tmp_path / "composite.tif")
+    check_memory("composite", ct.composite_scenes, scenes, out_tif)
+    used = benchmark.pedantic(ct.composite_scenes, args=(scenes, out_tif), rounds=3, iterations=1)
+    assert used == scenes
+
+
+def test_animate(benchmark, check_memory, monthly_pngs, sizes, tmp_path):
+    import matplotlib
+    font_path = os.path.join(matplotlib.get_data_path(), "fonts", "ttf", "DejaVuSans-Bold.ttf")
+    gif_path = str(tmp_path / "timeline.gif")
+    start, end = "2020-01-01", pd.Timestamp("2020-01-01") + pd.DateOffset(months=sizes["frames"] - 1)
+    check_memory("animate", s2p.timeline_gif, monthly_pngs, gif_path, start, end, font_path)
+    benchmark.pedantic(s2p.timeline_gif, args=(monthly_pngs, gif_path, start, end, font_path), rounds=3, iterations=1)
+    benchmark.extra_info["frames"] = sizes["frames"]
@@ -0,0 +1,28 @@
+"""Offline comparisons of the processing functions with the code they replaced, on synthetic data
+
+Every benchmark checks the new function gives the results of its reference implementation and
+prints a table of times (and peak memory or sizes). Run without NASA credentials, e.g.
+
+    python tests/benchmarks/compare.py
+    python tests/benchmarks/compare.py readpixc datacube
+"""
+
+import os
+import sys
+
+# the processing modules are flat modules in code/, imported by name as the scripts do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "code"))
+
+import compare_gridding
+import compare_pixc
+import compare_rasters
+import compare_s2
+
+benchmarks = {**compare_pixc.benchmarks, **compare_gridding.benchmarks, **compare_rasters.benchmarks,
+              **compare_s2.benchmarks}
+
+if __name__ == "__main__":
+    selected = sys.argv[1:] or list(benchmarks)
+    for name in selected:
+        print(f"########### {name}")
+        print(benchmarks[name]().to_string(index=False))
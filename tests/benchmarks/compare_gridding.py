@@ -0,0 +1,168 @@
+"""Gridding of PIXC points against the previous code
+
+eo_tools.binned_stats/grid_sampling_multi/plot_hist_map, raster_pipeline.generate_rasters,
+grid_accumulator and grid_spec.
+"""
+
+import os
+
+import eo_tools as eot
+import geopandas as gpd
+import grid_spec
+import numpy as np
+import pandas as pd
+import pixc_io
+import raster_pipeline as rp
+from grid_accumulator import grid_trimmed_files
+from grid_spec import GridSpec
+from helpers import (
+    aoi_path,
+    bench_dir,
+    make_synthetic_trimmed,
+    measure,
+    synthetic_trimmed_archive,
+    timed,
+)
+from scipy.stats import binned_statistic_2d
+
+########### ----------------------- Benchmarks ----------------------- ###########
+
+def bench_gridding(n_points=(100000, 1000000), resolutions=(500, 100)):
+    # grouped median + count engine of grid_sampling against two scipy binned_statistic_2d passes
+    aoi_utm = gpd.read_file(aoi_path)
+    minx, miny, maxx, maxy = aoi_utm.total_bounds
+    rng = np.random.default_rng(0)
+
+    rows = []
+    for n in n_points:
+        x = rng.uniform(minx, maxx, n)
+        y = rng.uniform(miny, maxy, n)
+        z = rng.normal(1030, 2, n).astype(np.float32)
+        for res in resolutions:
+            x_edges = minx + res * np.arange(int(np.ceil((maxx - minx) / res)) + 1)
+            y_edges = miny + res * np.arange(int(np.ceil((maxy - miny) / res)) + 1)
+
+            def with_scipy(x=x, y=y, z=z, x_edges=x_edges, y_edges=y_edges):
+                median = binned_statistic_2d(y, x, z, statistic="median", bins=[y_edges, x_edges]).statistic
+                count = binned_statistic_2d(y, x, None, statistic="count", bins=[y_edges, x_edges]).statistic
+                return median, count
+
+            (median_ref, count_ref), t_ref = timed(with_scipy)
+            rasters, t_new = timed(eot.binned_stats, x, y, z, x_edges, y_edges, stats=("count", "median"))
+            _, t_all = timed(eot.binned_stats, x, y, z, x_edges, y_edges, stats=eot.grid_statistics + ("p10", "p90"))
+            assert np.array_equal(median_ref, rasters["median"], equal_nan=True)
+            assert np.array_equal(count_ref, rasters["count"])
+
+            rows.append({
+                "points": n,
+                "resolution_m": res,
+                "cells": (len(x_edges) - 1) * (len(y_edges) - 1),
+                "scipy_median_count_s": t_ref,
+                "binned_stats_median_count_s": t_new,
+                "binned_stats_all_s": t_all,
+            })
+    return pd.DataFrame(rows)
+
+
+def bench_multi_gridding(n_points=(1000000,), fields=("heightEGM", "water_frac", "phase_noise_std", "sig0")):
+    # one grid_sampling call per field against a single grid_sampling_multi pass
+    aoi_utm = gpd.read_file(aoi_path)
+    rows = []
+    for n in n_points:
+        gdf = make_synthetic_trimmed(aoi_utm.to_crs(4326), n)
+        separate, t_ref = timed(lambda gdf=gdf: {f: eot.grid_sampling(aoi_utm, gdf, buffer=0.01, field=f) for f in fields})
+        bands, t_new = timed(eot.grid_sampling_multi, aoi_utm, gdf, fields=fields, buffer=0.01)
+        for f in fields:
+            assert np.array_equal(separate[f], bands[f"{f}_median"], equal_nan=True)
+        rows.append({"points": n, "fields": len(fields), "per_field_s": t_ref, "multi_s": t_new})
+    return pd.DataFrame(rows)
+
+
+def bench_raster_pool(n_dates=16, files_per_date=4, n_points=20000, workers=(1, 2, 4, 8)):
+    # wall time of per-date raster generation against number of worker processes
+    aoi_utm = gpd.read_file(aoi_path)
+    paths = synthetic_trimmed_archive(n_dates * files_per_date, n_points=n_points, folder="archive_pool")
+    files_by_date = {}
+    for path in paths:
+        files_by_date.setdefault(pixc_io.parse_pixc_filename(path)["start"].date(), []).append(path)
+
+    rows = []
+    reference = None
+    for n in workers:
+        out_dir = os.path.join(bench_dir, f"rasters_{n}") + os.sep
+        os.makedirs(out_dir, exist_ok=True)
+        (results, failed), t = timed(rp.generate_rasters, files_by_date, aoi_utm, out_dir, hist_dir=out_dir, n_workers=n)
+        assert not failed
+        # same rasters whatever the number of workers
+        rasters = [eot.read_band(r["raster"], "water_frac_median") for r in results]
+        if reference is None:
+            reference, t_serial = rasters, t
+        assert all(np.array_equal(a, b, equal_nan=True) for a, b in zip(reference, rasters))
+        rows.append({"workers": n, "dates": len(results), "wall_s": t, "speedup": t_serial / t, "cpus": os.cpu_count()})
+    return pd.DataFrame(rows)
+
+
+def bench_streaming_grid(n_files=(50, 200), n_points=20000, resolution=100, fields=("heightEGM", "water_frac")):
+    # peak memory of load-everything-then-grid against the streaming accumulator, and median error
+    aoi_utm = gpd.read_file(aoi_path)
+    rows = []
+    for n in n_files:
+        paths = synthetic_trimmed_archive(n, n_points=n_points, folder="archive_streaming")
+
+        def load_and_grid(paths=paths):
+            gdf = eot.load_trimmed_pixc_data(paths)
+            return eot.grid_sampling_multi(aoi_utm, gdf, fields=fields, buffer=0.01, grid_resolution=resolution)
+
+        bands, t_ref, mem_ref = measure(load_and_grid)
+        acc, t_new, mem_new = measure(grid_trimmed_files, paths, aoi_utm, fields=fields, grid_resolution=resolution, buffer=0.01)
+        error = max(np.nanmax(np.abs(bands[f"{f}_median"] - acc.statistic(f, "median"))) for f in fields)
+        assert np.array_equal(bands["count"], acc.statistic(None, "count"))
+
+        rows.append({"files": n, "points": n * n_points, "load_grid_s": t_ref, "load_grid_peak_MB": mem_ref,
+                     "streaming_s": t_new, "streaming_peak_MB": mem_new, "state_MB": acc.nbytes() / 2**20,
+                     "max_median_error": error})
+    return pd.DataFrame(rows)
+
+
+def bench_grid_spec(resolutions=(100, 20, 10)):
+    # grid definition from the grid_from_shp meshgrid against GridSpec (first call and memoised)
+    aoi_utm = gpd.read_file(aoi_path)
+    rows = []
+    for res in resolutions:
+        (x_grid, _), t_ref, mem_ref = measure(eot.grid_from_shp, aoi_utm, res, buffer=0.01)
+        grid_spec._grid_cache.clear()
+        grid, t_new, mem_new = measure(GridSpec.from_shapefile, aoi_utm, res, buffer=0.01)
+        _, t_cached = timed(GridSpec.from_shapefile, aoi_utm, res, buffer=0.01)
+        assert grid.x0 == x_grid.min()
+        rows.append({"resolution_m": res, "cells": grid.nx * grid.ny, "meshgrid_s": t_ref, "meshgrid_MB": mem_ref,
+                     "gridspec_s": t_new, "gridspec_MB": mem_new, "gridspec_cached_s": t_cached})
+    return pd.DataFrame(rows)
+
+
+def bench_hist_map(n_points=(200000, 2000000), field="heightEGM"):
+    # plot_hist_map per date: every point drawn by matplotlib against points binned into the map image
+    import matplotlib
+    matplotlib.use("Agg")
+    aoi_ll = gpd.read_file(aoi_path).to_crs("EPSG:4326")
+    out_dir = os.path.join(bench_dir, "hist_map") + os.sep
+    os.makedirs(out_dir, exist_ok=True)
+    rows = []
+    for n in n_points:
+        gdf = make_synthetic_trimmed(aoi_ll, n_points=n)
+        _, t_scatter = timed(eot.plot_hist_map, gdf, field, aoi_ll, f"scatter_{n}", out_dir, method="scatter")
+        # first date renders the AOI background, later dates reuse it
+        eot._map_backgrounds.clear()
+        _, t_first = timed(eot.plot_hist_map, gdf, field, aoi_ll, f"raster_{n}", out_dir)
+        _, t_raster = timed(eot.plot_hist_map, gdf, field, aoi_ll, f"raster_{n}", out_dir)
+        rows.append({"points": n, "scatter_s": t_scatter, "raster_first_s": t_first, "raster_s": t_raster})
+    return pd.DataFrame(rows)
+
+
+benchmarks = {
+    "gridding": bench_gridding,
+    "multi_gridding": bench_multi_gridding,
+    "raster_pool": bench_raster_pool,
+    "streaming_grid": bench_streaming_grid,
+    "grid_spec": bench_grid_spec,
+    "hist_map": bench_hist_map,
+}
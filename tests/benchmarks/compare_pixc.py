@@ -0,0 +1,245 @@
+"""PIXC reading, AOI clipping, trimmed file storage, loading and reprojection against the previous code
+
+readPIXC and AOIClipper (swot_download_tools, aoi_tools), pixc_io storage, eo_tools.load_trimmed_pixc_data,
+coords projections and the instrumentation hooks.
+"""
+
+import os
+
+import coords
+import eo_tools as eot
+import geopandas as gpd
+import instrumentation as instr
+import numpy as np
+import pandas as pd
+import pixc_io
+import swot_download_tools as sdt
+import xarray as xr
+from aoi_tools import AOIClipper
+from helpers import (
+    aoi_path,
+    bench_dir,
+    make_synthetic_pixc,
+    make_synthetic_trimmed,
+    measure,
+    synthetic_trimmed_archive,
+    synthetic_trimmed_filename,
+    timed,
+)
+
+########### ----------------------- Reference implementations ----------------------- ###########
+
+def readPIXC_mfdataset(filename: str, aoi: gpd.GeoDataFrame | None = None, classes=('open_water',), engine="netcdf4"):
+    # previous readPIXC: full-array reads through open_mfdataset, then class mask
+    with xr.open_mfdataset(filename, group="pixel_cloud", engine=engine) as nc:
+        class_flat = nc.classification.values.ravel()
+        class_condition = np.isin(class_flat, sdt.translateClass(classes))
+        class_flat = class_flat[class_condition]
+        lon_flat = nc.longitude.values.ravel()[class_condition]
+        lat_flat = nc.latitude.values.ravel()[class_condition]
+        data = {"lat": lat_flat, "lon": lon_flat, "class": class_flat}
+        for var in sdt.pixc_variables:
+            data[var] = nc[var].values.ravel()[class_condition]
+        data["heightEGM"] = data["height"] - data["geoid"] - data["solid_earth_tide"] - data["load_tide_fes"] - data["pole_tide"]
+        gdf = gpd.GeoDataFrame(pd.DataFrame(data), geometry=gpd.points_from_xy(lon_flat, lat_flat), crs=4326)
+        if aoi is not None:
+            gdf = gpd.clip(gdf, aoi)
+    return gdf
+
+
+def load_trimmed_pixc_data_concat(trimmed_filelist):
+    # previous loader: serial reads with pd.concat inside the loop
+    gdf_pixc_all = gpd.GeoDataFrame()
+    for trimmed_file in trimmed_filelist:
+        gdf_temp = pixc_io.read_trimmed_pixc(trimmed_file).rename(columns={"time": "date"}).set_index("date")
+        gdf_pixc_all = pd.concat([gdf_pixc_all, gdf_temp])
+    return gdf_pixc_all
+
+
+def project_points_to_crs(df, crs):
+    # reference: geometry built on load, reprojected by the pipeline and again by the gridding
+    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df["lon"].to_numpy(), df["lat"].to_numpy()), crs="EPSG:4326")
+    gdf = gdf.to_crs(crs).to_crs(crs)
+    return gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy()
+
+
+########### ----------------------- Benchmarks ----------------------- ###########
+
+def bench_readpixc(sizes=((1000, 1000), (3000, 1000)), aoi_overlap=0.3, classes=('open_water', 'water_near_land')):
+    # time and peak memory of readPIXC against the full-array reference
+    aoi_ll = gpd.read_file(aoi_path).to_crs("EPSG:4326")
+    rows = []
+    for n_lines, n_pixels in sizes:
+        path = os.path.join(bench_dir, f"pixc_{n_lines}x{n_pixels}_{aoi_overlap}.nc")
+        if not os.path.exists(path):
+            make_synthetic_pixc(path, aoi_ll, n_lines=n_lines, n_pixels=n_pixels, aoi_overlap=aoi_overlap)
+
+        gdf_ref, t_ref, mem_ref = measure(readPIXC_mfdataset, path, aoi=aoi_ll, classes=classes)
+        gdf_new, t_new, mem_new = measure(sdt.readPIXC, path, aoi=aoi_ll, classes=classes)
+        assert len(gdf_ref) == len(gdf_new)
+
+        rows.append({
+            "points": n_lines * n_pixels,
+            "kept": len(gdf_new),
+            "reference_s": t_ref,
+            "readPIXC_s": t_new,
+            "reference_peak_MB": mem_ref,
+            "readPIXC_peak_MB": mem_new,
+        })
+    return pd.DataFrame(rows)
+
+
+def bench_aoi_clip(n_points=(100000, 1000000), cell_size=0.005):
+    # points/second of AOIClipper modes against gpd.clip, on points spread over the AOI bounding box
+    aoi_ll = gpd.read_file(aoi_path).to_crs("EPSG:4326")
+    minx, miny, maxx, maxy = aoi_ll.total_bounds
+    rng = np.random.default_rng(0)
+
+    rows = []
+    for n in n_points:
+        lon = rng.uniform(minx - 0.2, maxx + 0.2, n)
+        lat = rng.uniform(miny - 0.2, maxy + 0.2, n)
+
+        def with_gpd_clip(lon=lon, lat=lat):
+            gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(lon, lat), crs=4326)
+            return len(gpd.clip(gdf, aoi_ll))
+
+        clippers = {
+            "prepared": AOIClipper(aoi_ll),
+            "rasterised": AOIClipper(aoi_ll, cell_size=cell_size),
+        }
+        n_ref, t_ref = timed(with_gpd_clip)
+        row = {"points": n, "kept": n_ref, "gpd.clip_pts_per_s": n / t_ref}
+        for name, clipper in clippers.items():
+            mask, t = timed(clipper.mask, lon, lat)
+            assert mask.sum() == n_ref
+            row[f"{name}_pts_per_s"] = n / t
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def bench_storage(n_points=(10000, 100000)):
+    # write/read throughput and file size of trimmed GeoJSON against GeoParquet
+    aoi_ll = gpd.read_file(aoi_path).to_crs("EPSG:4326")
+    rows = []
+    for i, n in enumerate(n_points):
+        gdf = make_synthetic_trimmed(aoi_ll, n_points=n)
+        stem = os.path.join(bench_dir, synthetic_trimmed_filename(i))
+        geojson_path = stem + ".geojson"
+        parquet_path = stem + ".parquet"
+
+        _, t_write_geojson = timed(gdf.to_file, geojson_path, driver="GeoJSON")
+        _, t_read_geojson = timed(gpd.read_file, geojson_path)
+        _, t_write_parquet = timed(pixc_io.write_trimmed_pixc, gdf, parquet_path)
+        _, t_read_parquet = timed(pixc_io.read_trimmed_pixc, parquet_path)
+        _, t_read_columns = timed(pixc_io.read_trimmed_pixc, parquet_path, columns=["lon", "lat", "water_frac"], geometry=False)
+
+        rows.append({
+            "points": n,
+            "geojson_MB": os.path.getsize(geojson_path) / 2**20,
+            "parquet_MB": os.path.getsize(parquet_path) / 2**20,
+            "geojson_write_pts_per_s": n / t_write_geojson,
+            "parquet_write_pts_per_s": n / t_write_parquet,
+            "geojson_read_pts_per_s": n / t_read_geojson,
+            "parquet_read_pts_per_s": n / t_read_parquet,
+            "parquet_read_3col_pts_per_s": n / t_read_columns,
+        })
+    return pd.DataFrame(rows)
+
+
+def bench_loader(n_files=(10, 100, 1000), n_points=2000):
+    # scaling of load_trimmed_pixc_data with number of granules against the concat-in-loop reference
+    rows = []
+    for n in n_files:
+        paths = synthetic_trimmed_archive(n, n_points=n_points)
+        gdf_ref, t_ref = timed(load_trimmed_pixc_data_concat, paths)
+        gdf_new, t_new = timed(eot.load_trimmed_pixc_data, paths)
+        _, t_cols = timed(eot.load_trimmed_pixc_data, paths, columns=["lon", "lat", "water_frac"], geometry=False, downcast=True)
+        assert len(gdf_ref) == len(gdf_new)
+        rows.append({
+            "files": n,
+            "points": len(gdf_new),
+            "concat_loop_s": t_ref,
+            "load_trimmed_pixc_data_s": t_new,
+            "3col_downcast_s": t_cols,
+            "concat_loop_ms_per_file": 1000 * t_ref / n,
+            "load_ms_per_file": 1000 * t_new / n,
+        })
+    return pd.DataFrame(rows)
+
+
+def bench_reprojection(n_points=(100000, 1000000), n_batches=2000, batch_size=1000):
+    # lon/lat to UTM through geometries against cached transformer and stored x/y columns
+    aoi_utm = gpd.read_file(aoi_path)
+    crs = aoi_utm.crs
+    rows = []
+    for n in n_points:
+        df = pd.DataFrame(make_synthetic_trimmed(aoi_utm.to_crs(4326), n).drop(columns="geometry"))
+        (x_ref, y_ref), t_ref = timed(project_points_to_crs, df, crs)
+        _, t_add = timed(coords.add_xy, df, crs)
+        (x, y), t_get = timed(coords.get_xy, df, crs)
+        assert np.allclose(x, x_ref, rtol=0, atol=1e-6) and np.allclose(y, y_ref, rtol=0, atol=1e-6)
+        _, t_grid = timed(eot.grid_sampling_multi, aoi_utm, df, fields=("heightEGM",))
+        rows.append({"points": n, "geometry_to_crs_s": t_ref, "add_xy_s": t_add, "stored_xy_s": t_get,
+                     "grid_multi_s": t_grid})
+
+    # many small batches (e.g. per-file reads): transformer made per call against the cached one
+    from pyproj import Transformer
+    lon, lat = df["lon"].to_numpy()[:batch_size], df["lat"].to_numpy()[:batch_size]
+    _, t_new_each = timed(lambda: [Transformer.from_crs("EPSG:4326", crs, always_xy=True).transform(lon, lat)
+                                   for _ in range(n_batches)])
+    _, t_cached = timed(lambda: [coords.transform_xy(lon, lat, "EPSG:4326", crs) for _ in range(n_batches)])
+    rows.append({"points": f"{n_batches} x {batch_size}", "geometry_to_crs_s": t_new_each, "add_xy_s": t_cached})
+    return pd.DataFrame(rows)
+
+
+def bench_instrumentation(n_calls=100000, size=(2000, 1000), repeats=3):
+    # cost of the instrumentation hooks when disabled and enabled, per call and on readPIXC
+    @instr.timed
+    def noop():
+        pass
+
+    def hooks():
+        for _ in range(n_calls):
+            with instr.stage("bench"):
+                pass
+            instr.count("bench")
+            noop()
+
+    def loop():
+        for _ in range(n_calls):
+            pass
+
+    aoi_ll = gpd.read_file(aoi_path).to_crs("EPSG:4326")
+    path = os.path.join(bench_dir, f"pixc_{size[0]}x{size[1]}_0.3.nc")
+    if not os.path.exists(path):
+        make_synthetic_pixc(path, aoi_ll, n_lines=size[0], n_pixels=size[1])
+    clipper = AOIClipper(aoi_ll, crs="EPSG:4326")
+    sdt.readPIXC(path, clipper)  # warm up file cache
+
+    rows = []
+    _, t_loop = timed(loop)
+    for mode in ("disabled", "enabled", "trace_memory"):
+        instr.disable()
+        instr.reset()
+        if mode != "disabled":
+            instr.enable(trace_memory=mode == "trace_memory")
+        _, t_hooks = timed(hooks)
+        instr.reset()
+        t_read = min(timed(sdt.readPIXC, path, clipper)[1] for _ in range(repeats))
+        counters = instr.counters()
+        rows.append({"mode": mode, "hook_ns": (t_hooks - t_loop) / n_calls * 1e9, "readPIXC_s": t_read,
+                     "stages": len(instr.records()), "points_read": counters.get("pixc.points_read", 0)})
+    instr.disable()
+    instr.reset()
+    return pd.DataFrame(rows)
+
+
+benchmarks = {
+    "readpixc": bench_readpixc,
+    "aoi_clip": bench_aoi_clip,
+    "storage": bench_storage,
+    "loader": bench_loader,
+    "reprojection": bench_reprojection,
+    "instrumentation": bench_instrumentation,
+}
@@ -0,0 +1,194 @@
+"""Raster time series against the view_pixc.ipynb loops
+
+datacube.RasterCube, eo_tools.extract_points_from_rasters/reduce_rasters and temporal_aggregation.
+"""
+
+import itertools
+import os
+import shutil
+
+import eo_tools as eot
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import raster_io as rio
+import rasterio
+import rasterio.transform
+import rasterio.windows
+import temporal_aggregation as ta
+from datacube import RasterCube
+from helpers import (
+    bench_dir,
+    measure,
+    random_points,
+    synthetic_date_products,
+    synthetic_raster_stack,
+    timed,
+)
+
+########### ----------------------- Reference implementations ----------------------- ###########
+
+def extract_raster_height_from_latlon(utm_y, utm_x, raster_file, buffer_size=0, band=1):
+    # per-file window read of view_pixc.ipynb: one rasterio.open per point and date
+    with rasterio.open(raster_file) as src:
+        row, col = src.index(utm_x, utm_y)
+        buffer_pixels = int(buffer_size / src.transform.a)
+        window = rasterio.windows.Window(col - buffer_pixels, row - buffer_pixels, 2 * buffer_pixels + 1, 2 * buffer_pixels + 1)
+        return src.read(band, window=window, masked=True).mean()
+
+
+def per_file_time_series(x, y, tif_files, buffer):
+    # view_pixc.ipynb double loop over points and files, as a (points, files) array
+    values = [[extract_raster_height_from_latlon(y[p], x[p], f, buffer_size=buffer) for f in tif_files] for p in range(len(x))]
+    return np.ma.filled(np.ma.array(values, dtype=np.float64), np.nan)
+
+
+def notebook_reductions(tif_files, band=1):
+    # view_pixc.ipynb: mean_raster accumulators, np.stack of presence masks, compute_flooded_extent per file
+    sum_array = count_array = None
+    for f in tif_files:
+        with rasterio.open(f) as src:
+            data = src.read(band, masked=True)
+            if sum_array is None:
+                sum_array = np.zeros(data.shape, dtype=np.float64)
+                count_array = np.zeros(data.shape, dtype=np.uint32)
+            valid_mask = ~data.mask
+            sum_array[valid_mask] += data.data[valid_mask]
+            count_array[valid_mask] += 1
+    mean = np.divide(sum_array, count_array, out=np.full_like(sum_array, np.nan), where=count_array != 0)
+
+    presence_stack = []
+    for f in tif_files:
+        with rasterio.open(f) as src:
+            presence_stack.append(~src.read(band, masked=True).mask)
+    presence_stack = np.stack(presence_stack, axis=0)
+    occurrence = presence_stack.sum(axis=0) / presence_stack.shape[0]
+
+    extents = []
+    for f in tif_files:
+        with rasterio.open(f) as src:
+            data = src.read(band, masked=True)
+            extents.append(np.sum(~data.mask) * abs(src.transform.a * src.transform.e))
+    return mean, occurrence, np.array(extents)
+
+
+def period_means_from_files(tif_files, freq, band="heightEGM_median"):
+    # view_pixc.ipynb period loop: files of every period found by their date strings and re-read per period
+    # (count-weighted here, as the aggregator). Returns {period start: (mean, count)}
+    dates = eot.raster_dates(tif_files)
+    edges = ta.period_edges(freq, dates.min(), dates.max())
+    out = {}
+    for start, end in itertools.pairwise(edges):
+        all_dates = pd.date_range(start, end - pd.Timedelta(days=1), freq="D").strftime("%Y-%m-%d").tolist()
+        files = [f for f in tif_files if any(d in os.path.basename(f) for d in all_dates)]
+        if not files:
+            continue
+        total = weight = None
+        for f in files:
+            with rasterio.open(f) as src:
+                values = rio.read_scaled(src, src.descriptions.index(band) + 1, dtype=np.float64)
+                count = rio.read_scaled(src, src.descriptions.index("count") + 1, dtype=np.float64)
+            w = np.where(np.isfinite(values), count, 0.0)
+            total = np.nan_to_num(values) * w + (0 if total is None else total)
+            weight = w + (0 if weight is None else weight)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[start.date()] = (total / weight, weight)
+    return out
+
+
+########### ----------------------- Benchmarks ----------------------- ###########
+
+def bench_datacube(n_dates=100, n_points=20, resolution=500, buffer=1000):
+    # time series of n_points over n_dates: per-file window reads against one RasterCube read
+    grid, tif_files, cube_path = synthetic_raster_stack(n_dates, resolution)
+    x, y = random_points(grid, n_points, margin=buffer + resolution)
+
+    reference, t_ref = timed(per_file_time_series, x, y, tif_files, buffer)
+    cube = RasterCube(cube_path)
+    ts, t_cube = timed(cube.time_series, x, y, bands=["heightEGM_median"], buffer=buffer)
+    _, t_map = timed(cube.read_map, "heightEGM_median", cube.dates[n_dates // 2])
+    cube.close()
+    assert np.allclose(reference, ts["value"].to_numpy().reshape(n_points, len(tif_files)), equal_nan=True)
+
+    return pd.DataFrame([{"points": n_points, "dates": len(tif_files), "per_file_s": t_ref, "cube_s": t_cube,
+                          "cube_map_read_s": t_map}])
+
+
+def bench_point_extraction(n_dates=100, n_points=(20, 200), resolution=500, buffer=1000):
+    # eo_tools.extract_points_from_rasters (each raster read once, in parallel) against per point x file reads
+    grid, tif_files, _ = synthetic_raster_stack(n_dates, resolution)
+    rows = []
+    for n in n_points:
+        x, y = random_points(grid, n, margin=buffer + resolution)
+        points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs=grid.crs)
+        reference, t_ref = timed(per_file_time_series, x, y, tif_files, buffer)
+        df, t_new = timed(eot.extract_points_from_rasters, points, tif_files, buffer=buffer, band="heightEGM_median")
+        assert np.allclose(reference, df["value"].to_numpy().reshape(n, len(tif_files)), equal_nan=True)
+        rows.append({"points": n, "rasters": len(tif_files), "per_point_file_s": t_ref, "extract_s": t_new})
+    return pd.DataFrame(rows)
+
+
+def bench_raster_reductions(n_dates=100, resolutions=(500, 100), threads=(1, 4)):
+    # occurrence, mean and flooded area: three notebook passes against one reduce_rasters pass
+    rows = []
+    for resolution in resolutions:
+        grid, tif_files, _ = synthetic_raster_stack(n_dates, resolution)
+        (mean, occurrence, extents), t_ref, mem_ref = measure(notebook_reductions, tif_files)
+        for n in threads:
+            (rasters, table), t_new, mem_new = measure(
+                eot.reduce_rasters, tif_files, reductions=("occurrence", "mean", "count", "min", "max", "first_date", "last_date"),
+                n_threads=n)
+            assert np.allclose(rasters["mean"], mean, rtol=1e-6, equal_nan=True)
+            assert np.allclose(rasters["occurrence"], occurrence)
+            assert np.allclose(table["flooded_area_m2"], extents)
+            rows.append({"rasters": len(tif_files), "shape": grid.shape, "threads": n, "notebook_s": t_ref,
+                         "reduce_s": t_new, "notebook_peak_MB": mem_ref, "reduce_peak_MB": mem_new})
+    return pd.DataFrame(rows)
+
+
+def bench_temporal_aggregation(freqs=("W-MON", "MS", "QS-DEC", "YS-OCT"), n_dates=240, resolution=200):
+    # weekly to hydrological-year levels: per-period re-reads of the date files against cached chained levels
+    tif_files, cube_path = synthetic_date_products(n_dates, resolution=resolution)
+    reference, t_ref = timed(lambda: {f: period_means_from_files(tif_files, f) for f in freqs})
+
+    work = os.path.join(bench_dir, "aggregation")
+    if os.path.exists(work):
+        shutil.rmtree(work)
+    os.makedirs(work)
+    cube_copy = os.path.join(work, "cube.nc")
+    with open(cube_path, "rb") as src, open(cube_copy, "wb") as dst:
+        dst.write(src.read())
+    aggregator = ta.TemporalAggregator(cube_copy, os.path.join(work, "levels"))
+    _, t_chain = timed(aggregator.aggregate_levels, freqs)
+    _, t_cached = timed(aggregator.aggregate_levels, freqs)
+
+    max_error = 0.0
+    for freq in freqs:
+        level = aggregator.level(freq)
+        assert [d for d in level.dates] == list(reference[freq])
+        for date, (mean, count) in reference[freq].items():
+            assert np.array_equal(level.read_map("count", date), count)
+            max_error = max(max_error, float(np.nanmax(np.abs(level.read_map("heightEGM_median", date) - mean))))
+        level.close()
+    aggregator.close()
+
+    # one new date appended to the datacube: only the periods holding it are rebuilt
+    cube = RasterCube(cube_copy, mode="a")
+    last = pd.Timestamp(cube.dates[-1]) + pd.Timedelta(days=3)
+    cube.append(last, {b: cube.read_map(b, cube.dates[-1]) for b in cube.bands})
+    cube.close()
+    aggregator = ta.TemporalAggregator(cube_copy, os.path.join(work, "levels"))
+    _, t_update = timed(aggregator.aggregate_levels, freqs)
+    aggregator.close()
+
+    return pd.DataFrame([{"dates": len(tif_files), "levels": len(freqs), "per_period_reads_s": t_ref,
+                          "chained_build_s": t_chain, "cached_s": t_cached, "append_update_s": t_update,
+                          "max_abs_error": max_error}])
+
+
+benchmarks = {
+    "datacube": bench_datacube,
+    "point_extraction": bench_point_extraction,
+    "raster_reductions": bench_raster_reductions,
+    "temporal_aggregation": bench_temporal_aggregation,
+}
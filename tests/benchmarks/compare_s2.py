@@ -0,0 +1,199 @@
+"""Sentinel-2 composites, task queue, COG previews and timeline gifs against the previous geotif2png/png2giff
+
+composite_tools, s2_pipeline, task_scheduler and raster_io.
+"""
+
+import glob
+import os
+import warnings
+
+import composite_tools as ct
+import numpy as np
+import pandas as pd
+import raster_io as rio
+import rasterio
+import rasterio.transform
+import rasterio.windows
+import s2_pipeline as s2p
+from helpers import (
+    bench_dir,
+    make_synthetic_s2,
+    measure,
+    timed,
+)
+from task_scheduler import run_tasks
+
+########### ----------------------- Reference implementations ----------------------- ###########
+
+def composite_stack(files):
+    # previous geotif2png monthly median: full scenes stacked in memory
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(np.stack([rasterio.open(f).read().astype(np.float32) for f in files], axis=0), axis=0)
+
+
+def preview_full_read(tif, size=(600, 500)):
+    # previous geotif2png png preview: full-resolution read and percentile, then resize
+    from PIL import Image
+    with rasterio.open(tif) as src:
+        rgb = np.nan_to_num(src.read([1, 2, 3]))
+    rgb = np.clip(rgb, 0, np.percentile(rgb, 99))
+    rgb = (rgb / rgb.max() * 255).astype(np.uint8)
+    return Image.fromarray(np.transpose(rgb, (1, 2, 0))).resize(size)
+
+
+def timeline_gif_frames(monthly_pngs, gif_path, timeline, font_path, frame_size=(600, 500), duration=600):
+    # previous png2giff: every labelled frame in a list, NO DATA font loaded and frame drawn per missing month,
+    # each frame quantised on its own by the GIF encoder
+    from PIL import Image, ImageDraw, ImageFont
+    font = ImageFont.truetype(font_path, 48)
+    frames = []
+    for dt in timeline:
+        label = dt.strftime("%Y-%m")
+        if (dt.year, dt.month) in monthly_pngs:
+            img = Image.open(monthly_pngs[(dt.year, dt.month)]).resize(frame_size)
+        else:
+            no_data_font = ImageFont.truetype(font_path, 64)
+            img = Image.new("RGB", frame_size, (0, 0, 0)).convert("RGBA")
+            draw = ImageDraw.Draw(img)
+            bbox = draw.textbbox((0, 0), "NO DATA", font=no_data_font)
+            draw.text(((img.width - bbox[2] + bbox[0]) // 2, (img.height - bbox[3] + bbox[1]) // 2), "NO DATA",
+                      fill=(255, 255, 255, 180), font=no_data_font, stroke_width=2, stroke_fill=(0, 0, 0, 200))
+            img = img.convert("RGB")
+        img = img.convert("RGBA")
+        draw = ImageDraw.Draw(img)
+        bbox = draw.textbbox((0, 0), label, font=font)
+        x, y = (img.width - bbox[2] + bbox[0]) // 2, 20
+        draw.rectangle([x - 8, y - 8, x + bbox[2] - bbox[0] + 8, y + bbox[3] - bbox[1] + 8], fill=(0, 0, 0, 160))
+        draw.text((x, y), label, fill=(255, 255, 255, 255), font=font)
+        frames.append(img.convert("RGB"))
+    frames[0].save(gif_path, save_all=True, append_images=frames[1:], duration=duration, loop=0)
+    return gif_path
+
+
+########### ----------------------- Benchmarks ----------------------- ###########
+
+def bench_composite(n_scenes=(8, 16), size=1500, reducers=("median", "mean", "p25")):
+    # block-windowed composite_scenes against stacking whole scenes, time and peak numpy memory
+    rows = []
+    for n in n_scenes:
+        files = make_synthetic_s2(os.path.join(bench_dir, "s2"), n_scenes=n, height=size, width=size)
+        reference, t_ref, mem_ref = measure(composite_stack, files)
+        out_tif = os.path.join(bench_dir, "s2_composite.tif")
+        _, t_new, mem_new = measure(ct.composite_scenes, files, out_tif, reducer="median")
+        with rasterio.open(out_tif) as src:
+            assert np.array_equal(reference, src.read(), equal_nan=True)
+        row = {"scenes": n, "pixels": size * size, "stack_s": t_ref, "stack_peak_MB": mem_ref,
+               "blocks_median_s": t_new, "blocks_peak_MB": mem_new}
+        for reducer in reducers[1:]:
+            row[f"blocks_{reducer}_s"] = timed(ct.composite_scenes, files, out_tif, reducer=reducer)[1]
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def bench_s2_tasks(n_boxes=4, n_months=3, scenes_per_month=4, size=1000, workers=(1, 4)):
+    # geotif2png task queue (composites and their pngs over all boxes) serial and on a process pool,
+    # then a second run where every task is up to date
+    rows = []
+    base = os.path.join(bench_dir, "s2_boxes")
+    boxes = [f"b{i + 1}" for i in range(n_boxes)]
+    for i, box in enumerate(boxes):
+        tif_path = os.path.join(base, box, "tif")
+        if os.path.isdir(tif_path):
+            continue
+        staging = os.path.join(base, box, "synthetic")
+        files = make_synthetic_s2(staging, n_scenes=n_months * scenes_per_month, height=size, width=size, seed=i)
+        os.makedirs(tif_path)
+        for j, f in enumerate(files):
+            # spread the scenes over months, named like the exports of the box
+            month, day = j // scenes_per_month + 1, j % scenes_per_month + 1
+            os.replace(f, os.path.join(tif_path, f"S2_RGB_2024-{month:02d}-{day:02d}_{box}.tif"))
+        os.rmdir(staging)
+    for n_workers in workers:
+        for path in glob.glob(os.path.join(base, "*", "monthly", "*")):
+            os.remove(path)
+        tasks = s2p.build_tasks(base, boxes, composite_threads=1)
+        report, t_run = timed(run_tasks, tasks, n_workers=n_workers)
+        _, t_rerun = timed(run_tasks, s2p.build_tasks(base, boxes), n_workers=n_workers)
+        rows.append({"workers": n_workers, "cpus": os.cpu_count(), "tasks": len(tasks), "done": (report["status"] == "done").sum(), "run_s": t_run, "up_to_date_rerun_s": t_rerun})
+    return pd.DataFrame(rows)
+
+
+def bench_cog(size=4000, encodings=("float32", "int16")):
+    # 3-band composite-like raster: previous LZW strip GeoTIFF against raster_io COGs, write time,
+    # file size and time of a 600x500 png preview (full read against overview read)
+    rng = np.random.default_rng(0)
+    coarse = rng.normal(1000, 300, (3, size // 50, size // 50)).astype(np.float32)
+    data = np.repeat(np.repeat(coarse, 50, axis=1), 50, axis=2) + rng.normal(0, 20, (3, size, size)).astype(np.float32)
+    data[:, rng.random((size, size)) < 0.05] = np.nan
+    transform = rasterio.transform.from_origin(700000, 9100000, 10, 10)
+    rows = []
+
+    strip_tif = os.path.join(bench_dir, "cog_strip.tif")
+
+    def write_strips():
+        with rasterio.open(strip_tif, "w", driver="GTiff", height=size, width=size, count=3, dtype="float32",
+                           crs="EPSG:32737", transform=transform, nodata=np.nan, compress="lzw") as dst:
+            dst.write(data)
+    _, t_write = timed(write_strips)
+    _, t_preview = timed(preview_full_read, strip_tif)
+    rows.append({"layout": "lzw strips", "write_s": t_write, "size_MB": os.path.getsize(strip_tif) / 1e6,
+                 "preview_s": t_preview})
+
+    for encoding in encodings:
+        cog_tif = os.path.join(bench_dir, f"cog_{encoding}.tif")
+        bands = {f"b{i + 1}": data[i] for i in range(3)}
+        _, t_write = timed(rio.write_raster, cog_tif, bands, transform, "EPSG:32737", encoding=encoding)
+        _, t_preview = timed(s2p.composite_to_png, cog_tif, os.path.join(bench_dir, f"cog_{encoding}.png"))
+        with rasterio.open(cog_tif) as src:
+            values = rio.read_scaled(src)
+            overviews = src.overviews(1)
+        assert np.array_equal(np.isnan(values), np.isnan(data))
+        rows.append({"layout": f"cog {encoding}", "write_s": t_write, "size_MB": os.path.getsize(cog_tif) / 1e6,
+                     "preview_s": t_preview, "overviews": overviews,
+                     "max_abs_error": float(np.nanmax(np.abs(values - data)))})
+    return pd.DataFrame(rows)
+
+
+def bench_gif(n_months=(72, 288), missing_fraction=0.3, frame_size=(600, 500)):
+    # monthly timeline gif: frames in a list (previous png2giff) against the streaming writer with a shared palette
+    import matplotlib
+    from PIL import Image
+    font_path = os.path.join(matplotlib.get_data_path(), "fonts", "ttf", "DejaVuSans-Bold.ttf")
+    monthly_path = os.path.join(bench_dir, "monthly_pngs")
+    os.makedirs(monthly_path, exist_ok=True)
+    rng = np.random.default_rng(0)
+    rows = []
+    for n in n_months:
+        timeline = pd.date_range("2000-01-01", periods=n, freq="MS")
+        for path in glob.glob(os.path.join(monthly_path, "*.png")):
+            os.remove(path)
+        pngs = {}
+        for dt in timeline:
+            if rng.random() < missing_fraction:
+                continue
+            # smooth synthetic scene, like a stretched composite
+            base = rng.normal(120, 40, (frame_size[1] // 20, frame_size[0] // 20, 3)).clip(0, 255).astype(np.uint8)
+            path = os.path.join(monthly_path, f"S2_RGB_{dt:%Y-%m}_median_b1.png")
+            Image.fromarray(base).resize(frame_size, Image.Resampling.BILINEAR).save(path)
+            pngs[(dt.year, dt.month)] = path
+        gif_ref = os.path.join(bench_dir, "timeline_ref.gif")
+        gif_new = os.path.join(bench_dir, "timeline_new.gif")
+        _, t_ref = timed(timeline_gif_frames, pngs, gif_ref, timeline, font_path, frame_size)
+        _, t_new = timed(s2p.timeline_gif, monthly_path, gif_new, timeline[0], timeline[-1], font_path,
+                         frame_size=frame_size)
+        with Image.open(gif_new) as im:
+            assert im.n_frames == n and im.size == frame_size
+        rows.append({"frames": n, "missing": n - len(pngs), "list_s": t_ref, "list_fps": n / t_ref,
+                     "list_frames_MB": n * frame_size[0] * frame_size[1] * 3 / 1e6, "stream_s": t_new,
+                     "stream_fps": n / t_new, "list_gif_MB": os.path.getsize(gif_ref) / 1e6,
+                     "stream_gif_MB": os.path.getsize(gif_new) / 1e6})
+    return pd.DataFrame(rows)
+
+
+benchmarks = {
+    "composite": bench_composite,
+    "s2_tasks": bench_s2_tasks,
+    "cog": bench_cog,
+    "gif": bench_gif,
+}
@@ -0,0 +1,76 @@
+import os
+import sys
+import tracemalloc
+
+import geopandas as gpd
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(REPO_DIR, "code"))
+
+from my_library.simulation import Simulator
+
+AOI_PATH = os.path.join(REPO_DIR, "data", "shapefiles", "wetland_fans_domain_37S.shp")
+
+# data sizes of each scale
+SCALES = {
+    "small": {"pixc": (500, 500), "trimmed_files": 10, "scenes": 8, "scene_size": 512, "frames": 24},
+    "medium": {"pixc": (2000, 1000), "trimmed_files": 50, "scenes": 16, "scene_size": 1500, "frames": 72},
+}
+
+# peak traced (python + numpy) memory budgets in MB per benchmark and scale
+MEMORY_BUDGETS_MB = {
+    "trim": {"small": 10, "medium": 80},
+    "load": {"small": 10, "medium": 220},
+    "grid": {"small": 120, "medium": 200},
+    "composite": {"small": 120, "medium": 720},
+    "animate": {"small": 10, "medium": 15},
+}
+
+
+@pytest.fixture(scope="session", params=list(SCALES))
+def scale(request):
+    return request.param
+
+
+@pytest.fixture(scope="session")
+def sizes(scale):
+    return SCALES[scale]
+
+
+@pytest.fixture(scope="session")
+def simulator():
+    return Simulator("benchmarks", seed=0)
+
+
+@pytest.fixture(scope="session")
+def aoi_utm():
+    return gpd.read_file(AOI_PATH)
+
+
+@pytest.fixture(scope="session")
+def aoi_ll(aoi_utm):
+    return aoi_utm.to_crs("EPSG:4326")
+
+
+@pytest.fixture(scope="session")
+def data_dir(tmp_path_factory, scale):
+    return tmp_path_factory.mktemp(f"data_{scale}")
+
+
+@pytest.fixture
+def check_memory(benchmark, scale):
+    # run func once under tracemalloc, record the peak with the benchmark and check it against the budget
+    def check(name, func, *args, **kwargs):
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["peak_MB"] = round(peak, 1)
+        budget = MEMORY_BUDGETS_MB[name][scale]
+        assert peak <= budget, f"{name} peak memory {peak:.0f} MB over the {budget} MB budget at scale {scale}"
+    return check
@@ -0,0 +1,167 @@
+"""Synthetic data and timing helpers shared by the comparison benchmarks
+
+Synthetic inputs are written to bench_dir and reused between runs.
+"""
+
+import glob
+import os
+import tempfile
+import time
+import tracemalloc
+
+import eo_tools as eot
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pixc_io
+from datacube import RasterCube
+from grid_spec import GridSpec
+
+from my_library.simulation import Simulator
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+########### ----------------------- USER INPUT ----------------------- ###########
+aoi_path = os.path.join(REPO_DIR, "data", "shapefiles", "wetland_fans_domain_37S.shp")
+bench_dir = os.path.join(tempfile.gettempdir(), "eo_usangu_benchmarks")
+os.makedirs(bench_dir, exist_ok=True)
+
+
+########### ----------------------- Synthetic data ----------------------- ###########
+
+def make_synthetic_pixc(path, aoi_ll: gpd.GeoDataFrame, n_lines=2000, n_pixels=1000, aoi_overlap=0.3, water_fraction=0.2, seed=0):
+    # SWOT PIXC tile of n_lines x n_pixels points, a fraction aoi_overlap of the lines inside the AOI
+    # bounding box, see my_library Simulator.pixc_granule
+    return Simulator("benchmark", seed=seed).pixc_granule(path, tuple(aoi_ll.total_bounds), n_lines=n_lines,
+                                                          n_pixels=n_pixels, water_fraction=water_fraction,
+                                                          aoi_overlap=aoi_overlap)
+
+
+def make_synthetic_trimmed(aoi_ll: gpd.GeoDataFrame, n_points=100000, seed=0):
+    # trimmed pixel cloud points (columns as written by readPIXC) spread over the AOI bounding box
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = aoi_ll.total_bounds
+    lon = rng.uniform(minx, maxx, n_points)
+    lat = rng.uniform(miny, maxy, n_points)
+    height = rng.normal(1030, 2, n_points).astype(np.float32)
+    geoid = rng.normal(-15, 0.1, n_points).astype(np.float32)
+    tides = rng.normal(0, 0.05, (3, n_points)).astype(np.float32)
+    data = {
+        "height": height,
+        "heightEGM": height - geoid - tides.sum(axis=0),
+        "lat": lat,
+        "lon": lon,
+        "geoid": geoid,
+        "solid_earth_tide": tides[0],
+        "load_tide": tides[1],
+        "pole_tide": tides[2],
+        "class": rng.choice([3, 4], n_points).astype(np.int8),
+        "water_frac": np.clip(rng.normal(0.8, 0.3, n_points), 0, 1.5).astype(np.float32),
+        "phase_noise_std": np.abs(rng.normal(0.05, 0.02, n_points)).astype(np.float32),
+        "dheight_dphase": rng.normal(10, 2, n_points).astype(np.float32),
+        "sig0": np.abs(rng.normal(20, 10, n_points)).astype(np.float32),
+    }
+    return gpd.GeoDataFrame(pd.DataFrame(data), geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326")
+
+
+def synthetic_trimmed_filename(i, date="20240101"):
+    return f"SWOT_L2_HR_PIXC_010_{i % 500:03d}_{i % 200:03d}L_{date}T{i % 24:02d}0000_{date}T{i % 24:02d}0010_PID0_01_trimmed"
+
+
+def make_synthetic_s2(folder, n_scenes=20, height=2000, width=2000, cloud_fraction=0.3, seed=0, compress=None):
+    # n_scenes 3-band float32 GeoTIFFs named like the Sentinel-2 exports (S2_RGB_YYYY-MM-DD_box.tif),
+    # all in the same month, with cloud patches set to NaN (compress: GeoTIFF compression, None for raw),
+    # see my_library Simulator.s2_stack
+    return Simulator("benchmark", seed=seed).s2_stack(folder, n_scenes=n_scenes, height=height, width=width,
+                                                      cloud_fraction=cloud_fraction, compress=compress)
+
+
+def synthetic_trimmed_archive(n_files, n_points=2000, folder="archive"):
+    # folder of n_files synthetic trimmed parquet granules, reused between runs
+    aoi_ll = gpd.read_file(aoi_path).to_crs("EPSG:4326")
+    folder = os.path.join(bench_dir, folder)
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(n_files):
+        date = (pd.Timestamp("2024-01-01") + pd.Timedelta(days=i // 4)).strftime("%Y%m%d")
+        path = os.path.join(folder, synthetic_trimmed_filename(i, date=date) + ".parquet")
+        if not os.path.exists(path):
+            pixc_io.write_trimmed_pixc(make_synthetic_trimmed(aoi_ll, n_points=n_points, seed=i), path)
+        paths.append(path)
+    return paths
+
+
+def synthetic_raster_stack(n_dates=100, resolution=500):
+    # per-date multi-band GeoTIFFs (heightEGM_median, count) on the AOI grid and the same dates in a
+    # RasterCube, reused between runs. Returns (grid, GeoTIFF files, cube path)
+    aoi_utm = gpd.read_file(aoi_path)
+    grid = GridSpec.from_shapefile(aoi_utm, resolution, buffer=0.01)
+    folder = os.path.join(bench_dir, "cube")
+    os.makedirs(folder, exist_ok=True)
+    cube_path = os.path.join(folder, f"cube_res{resolution}.nc")
+    rng = np.random.default_rng(0)
+
+    if not os.path.exists(cube_path):
+        cube = RasterCube.create(cube_path, grid, ["heightEGM_median", "count"])
+        for i in range(n_dates):
+            date = pd.Timestamp("2024-01-01") + pd.Timedelta(days=7 * i)
+            height = rng.normal(1030, 2, grid.shape)
+            height[rng.random(grid.shape) < 0.5] = np.nan
+            bands = {"heightEGM_median": height.astype(np.float32).astype(np.float64), "count": rng.poisson(5, grid.shape).astype(np.float64)}
+            eot.write_multiband_geotiff(os.path.join(folder, f"{date.date()}_res{resolution}_multiband.tif"), bands, grid.transform, grid.crs)
+            cube.append(date, bands)
+        cube.close()
+    tif_files = sorted(glob.glob(os.path.join(folder, f"*_res{resolution}_multiband.tif")))
+    return grid, tif_files, cube_path
+
+
+def random_points(grid, n_points, margin, seed=1):
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = grid.bounds
+    x = rng.uniform(minx + margin, maxx - margin, n_points)
+    y = rng.uniform(miny + margin, maxy - margin, n_points)
+    return x, y
+
+
+def synthetic_date_products(n_dates=240, every=3, resolution=200):
+    # per-date multi-band GeoTIFFs (heightEGM_median, count with NaN heights where count is 0) every few days
+    # and the same dates in a RasterCube, reused between runs. Returns (GeoTIFF files, cube path)
+    grid = GridSpec.from_shapefile(gpd.read_file(aoi_path), resolution, buffer=0.01)
+    folder = os.path.join(bench_dir, f"dates_res{resolution}")
+    os.makedirs(folder, exist_ok=True)
+    cube_path = os.path.join(folder, "cube.nc")
+    rng = np.random.default_rng(0)
+    if not os.path.exists(cube_path):
+        cube = RasterCube.create(cube_path + ".part", grid, ["heightEGM_median", "count"])
+        for i in range(n_dates):
+            date = pd.Timestamp("2023-07-01") + pd.Timedelta(days=every * i)
+            count = rng.poisson(3, grid.shape).astype(np.float64)
+            height = np.where(count > 0, rng.normal(1030, 2, grid.shape) + np.sin(i / 20), np.nan)
+            bands = {"heightEGM_median": height.astype(np.float32).astype(np.float64), "count": count}
+            eot.write_multiband_geotiff(os.path.join(folder, f"{date.date()}_res{resolution}_multiband.tif"), bands,
+                                        grid.transform, grid.crs)
+            cube.append(date, bands)
+        cube.close()
+        os.replace(cube_path + ".part", cube_path)
+    return sorted(glob.glob(os.path.join(folder, "*_multiband.tif"))), cube_path
+
+
+########### ----------------------- Timing ----------------------- ###########
+
+def timed(func, *args, **kwargs):
+    # wall time of one call
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def measure(func, *args, **kwargs):
+    # wall time and peak traced (python + numpy) memory of one call
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2**20
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# the processing modules are flat modules in code/, imported by name as the scripts do
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "code"))
+AOI_PATH = os.path.join(REPO_DIR, "data", "shapefiles", "wetland_fans_domain_37S.shp")
+
+
+@pytest.fixture(scope="session")
+def aoi_utm():
+    gpd = pytest.importorskip("geopandas")
+    return gpd.read_file(AOI_PATH)
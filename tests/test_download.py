@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+pytest.importorskip("earthaccess")
+pytest.importorskip("pyarrow")
+
+import pixc_io
+import swot_download_tools as sdt
+
+from my_library.simulation import Simulator
+
+
+class _Granule:
+    # stand-in for an earthaccess granule, only its data links are used
+    def __init__(self, filename):
+        self.data_links = [f"https://example.invalid/{filename}"]
+
+
+def _granule_name(i):
+    return f"SWOT_L2_HR_PIXC_010_{100 + i:03d}_100L_20240101T0000{i:02d}_20240101T0001{i:02d}_PID0_01.nc"
+
+
+@pytest.fixture(scope="module")
+def aoi_ll(aoi_utm):
+    return aoi_utm.to_crs("EPSG:4326")
+
+
+@pytest.fixture(scope="module")
+def source_granule(aoi_ll, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("source") / "pixc.nc")
+    return Simulator(name="pixc", seed=0).pixc_granule(path, tuple(aoi_ll.total_bounds), n_lines=200, n_pixels=100)
+
+
+def _copy_download(source, downloads):
+    # download_func copying the synthetic granule to the requested name, recording every call
+    def download(granule, download_path):
+        filename = granule.data_links[0].rsplit("/", 1)[-1]
+        downloads.append(filename)
+        with open(source, "rb") as src, open(os.path.join(download_path, filename), "wb") as dst:
+            dst.write(src.read())
+    return download
+
+
+def test_unrecorded_trimmed_files_are_adopted(source_granule, aoi_ll, tmp_path):
+
+    # a trimmed file from an older run, without a manifest record
+    granule = _Granule(_granule_name(0))
+    savepath = str(tmp_path / _granule_name(0).replace(".nc", "_trimmed.parquet"))
+    old = sdt.readPIXC(source_granule, None, classes=["land"])
+    pixc_io.write_trimmed_pixc(old, savepath)
+
+    # adopted as trimmed with the default classes and this AOI
+    downloads = []
+    download = _copy_download(source_granule, downloads)
+    failed = sdt.download_granule_list([granule], str(tmp_path), aoi=aoi_ll, download_func=download)
+    assert failed == {} and downloads == []
+    manifest = sdt.GranuleManifest(str(tmp_path / "pixc_manifest.sqlite"))
+    record = manifest.get(_granule_name(0)[:-3])
+    assert (record["status"], record["classes"], record["n_points"]) == ("done", None, len(old))
+
+    # reprocessed for other classes, then skipped with them
+    sdt.download_granule_list([granule], str(tmp_path), aoi=aoi_ll, classes=["open_water", "land"],
+                              download_func=download)
+    sdt.download_granule_list([granule], str(tmp_path), aoi=aoi_ll, classes=["land", "open_water"],
+                              download_func=download)
+    assert downloads == [_granule_name(0)]
+    assert manifest.get(_granule_name(0)[:-3])["classes"] == "land,open_water"
+
+    # a trimmed file changed on disk since it was recorded is reprocessed
+    with open(savepath, "r+b") as f:
+        f.seek(-20, os.SEEK_END)
+        f.write(b"x")
+    sdt.download_granule_list([granule], str(tmp_path), aoi=aoi_ll, classes=["open_water", "land"],
+                              download_func=download)
+    assert downloads == [_granule_name(0)] * 2
+    assert manifest.get(_granule_name(0)[:-3])["output_sha256"] == sdt.fileChecksum(savepath)
+    manifest.close()
+
+
+def test_pipeline_bounds_raw_files_isolates_failures_and_skips_reruns(source_granule, aoi_ll, tmp_path):
+
+    names = [_granule_name(i) for i in range(6)]
+    granules = [_Granule(name) for name in names]
+    raw_on_disk = []
+    downloads = []
+    copy = _copy_download(source_granule, downloads)
+
+    def download(granule, download_path):
+        filename = granule.data_links[0].rsplit("/", 1)[-1]
+        if filename == names[1]:
+            downloads.append(filename)
+            raise ConnectionError("server error")
+        copy(granule, download_path)
+        if filename == names[2]:
+            # corrupt download, fails in the trim worker
+            with open(os.path.join(download_path, filename), "wb") as f:
+                f.write(b"not a netcdf")
+        raw_on_disk.append(len([f for f in os.listdir(download_path) if f.endswith(".nc")]))
+
+    failed = sdt.download_granule_list(granules, str(tmp_path), aoi=aoi_ll, n_downloads=2, n_workers=2,
+                                       max_raw_files=2, download_func=download)
+    assert set(failed) == {names[1], names[2]}
+    assert max(raw_on_disk) <= 2
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".nc")]
+    for name in set(names) - {names[1], names[2]}:
+        assert os.path.exists(tmp_path / name.replace(".nc", "_trimmed.parquet"))
+
+    # a rerun only retries the failed granules
+    downloads.clear()
+    sdt.download_granule_list(granules, str(tmp_path), aoi=aoi_ll, n_downloads=2, n_workers=2, max_raw_files=2,
+                              download_func=download)
+    assert sorted(downloads) == sorted([names[1], names[2]])
+
+
+def _exit_worker(filepath, savepath, aoi=None, classes=("open_water",)):
+    # trim worker dying before it removes the raw file
+    os._exit(1)
+
+
+def test_pipeline_removes_raw_files_of_dead_workers(source_granule, aoi_ll, tmp_path, monkeypatch):
+
+    names = [_granule_name(i) for i in range(3)]
+    monkeypatch.setattr(sdt, "trimGranule", _exit_worker)
+    failed = sdt.download_granule_list([_Granule(name) for name in names], str(tmp_path), aoi=aoi_ll, n_downloads=2,
+                                       n_workers=2, max_raw_files=2, download_func=_copy_download(source_granule, []))
+    assert set(failed) == set(names)
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".nc")]
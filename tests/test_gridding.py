@@ -0,0 +1,185 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+pytest.importorskip("rasterio")
+
+import coords
+import eo_tools as eot
+import shapely
+from grid_accumulator import GridAccumulator
+from grid_spec import GridSpec
+
+
+@pytest.fixture(scope="module")
+def points(aoi_utm):
+    # lon/lat points over the AOI bounding box, as read with geometry=False
+    rng = np.random.default_rng(0)
+    minx, miny, maxx, maxy = aoi_utm.to_crs(coords.WGS84).total_bounds
+    n = 20000
+    return pd.DataFrame({"lon": rng.uniform(minx, maxx, n), "lat": rng.uniform(miny, maxy, n),
+                         "heightEGM": rng.normal(1030, 2, n), "water_frac": rng.uniform(0, 1, n)})
+
+
+def test_grouped_stats_matches_numpy():
+
+    rng = np.random.default_rng(1)
+    idx = rng.integers(-1, 50, 5000)
+    z = rng.normal(size=5000)
+    out = eot.grouped_stats(idx, z, 60, stats=("count", "mean", "std", "min", "max", "median", "p10", "p90"))
+    for b in range(60):
+        values = z[idx == b]
+        if len(values) == 0:
+            assert out["count"][b] == 0 and np.isnan(out["median"][b])
+            continue
+        assert out["count"][b] == len(values)
+        assert out["mean"][b] == pytest.approx(values.mean())
+        assert out["std"][b] == pytest.approx(values.std())
+        assert (out["min"][b], out["max"][b]) == (values.min(), values.max())
+        assert out["median"][b] == np.median(values)
+        assert out["p10"][b] == pytest.approx(np.percentile(values, 10))
+        assert out["p90"][b] == pytest.approx(np.percentile(values, 90))
+
+
+def test_grouped_stats_order_stats_ignore_nan():
+
+    rng = np.random.default_rng(2)
+    idx = rng.integers(0, 30, 3000)
+    z = rng.normal(size=3000)
+    z[rng.random(3000) < 0.2] = np.nan
+    z[idx == 7] = np.nan
+    out = eot.grouped_stats(idx, z, 30, stats=("count", "min", "median", "p25", "p90"), ignore_nan=True)
+    assert out["count"][7] == (idx == 7).sum()
+    assert np.isnan(out["median"][7]) and np.isnan(out["p90"][7])
+    for b in set(range(30)) - {7}:
+        values = z[idx == b]
+        assert out["min"][b] == np.nanmin(values)
+        assert out["median"][b] == np.nanmedian(values)
+        assert out["p25"][b] == pytest.approx(np.nanpercentile(values, 25))
+        assert out["p90"][b] == pytest.approx(np.nanpercentile(values, 90))
+
+
+def test_grouped_stats_nan_as_binned_statistic():
+
+    # by default NaN values give the rasters of scipy's binned_statistic, percentiles propagate NaN
+    binned_statistic = pytest.importorskip("scipy.stats").binned_statistic
+    rng = np.random.default_rng(3)
+    idx = rng.integers(0, 40, 2000)
+    z = rng.normal(size=2000)
+    z[rng.random(2000) < 0.05] = np.nan
+    z[idx == 5] = np.nan
+    stats = ("count", "sum", "mean", "std", "min", "max", "median")
+    out = eot.grouped_stats(idx, z, 40, stats=stats + ("p90",))
+    for stat in stats:
+        expected = binned_statistic(idx, z, statistic=stat, bins=np.arange(41)).statistic
+        np.testing.assert_array_equal(out[stat], expected, err_msg=stat)
+    expected = binned_statistic(idx, z, statistic=lambda v: np.percentile(v, 90), bins=np.arange(41)).statistic
+    np.testing.assert_allclose(out["p90"], expected, equal_nan=True)
+
+
+@pytest.mark.parametrize("stat", ["p150", "pXX", "p", "median2"])
+def test_grouped_stats_rejects_unknown_stats(stat):
+
+    with pytest.raises(ValueError, match="Unknown statistic"):
+        eot.grouped_stats(np.zeros(3, dtype=np.int64), np.ones(3), 1, stats=(stat,))
+
+
+def test_grid_sampling_multi_inputs_agree(aoi_utm, points):
+
+    # lon/lat columns, stored x/y columns and a projected GeoDataFrame grid the same way
+    fields = ("heightEGM", "water_frac")
+    from_ll = eot.grid_sampling_multi(aoi_utm, points, fields=fields, grid_resolution=500)
+    stored = eot.grid_sampling_multi(aoi_utm, coords.add_xy(points.copy(), aoi_utm.crs), fields=fields,
+                                     grid_resolution=500)
+    gdf = gpd.GeoDataFrame(points, geometry=gpd.points_from_xy(points.lon, points.lat), crs=coords.WGS84)
+    from_gdf = eot.grid_sampling_multi(aoi_utm, gdf.to_crs(aoi_utm.crs), fields=fields, grid_resolution=500)
+    for name, raster in from_ll.items():
+        np.testing.assert_array_equal(raster, stored[name])
+        np.testing.assert_allclose(raster, from_gdf[name], equal_nan=True)
+
+    # north-up rasters, every point inside the grid counted once
+    grid = GridSpec.from_shapefile(aoi_utm, 500)
+    x, y = coords.get_xy(points, aoi_utm.crs)
+    inside = (x >= grid.x0) & (x < grid.x0 + grid.nx * 500) & (y >= grid.y0) & (y < grid.y0 + grid.ny * 500)
+    assert from_ll["count"].shape == grid.shape
+    assert from_ll["count"].sum() == inside.sum()
+    row, col = grid.rowcol(x[inside][:1], y[inside][:1])
+    assert from_ll["count"][row[0], col[0]] >= 1
+
+
+def test_grid_sampling_multi_geotiff_encodings(aoi_utm, points, tmp_path):
+
+    # the default float64 GeoTIFF keeps the gridded heights as computed, float32 within its precision
+    bands = eot.grid_sampling_multi(aoi_utm, points, fields=("heightEGM",), grid_resolution=500,
+                                    filedate="f64", writeGeoTIFF=True, swot_raster_dir=f"{tmp_path}/")
+    eot.grid_sampling_multi(aoi_utm, points, fields=("heightEGM",), grid_resolution=500, filedate="f32",
+                            writeGeoTIFF=True, swot_raster_dir=f"{tmp_path}/", encoding="float32")
+    expected = bands["heightEGM_median"]
+    np.testing.assert_array_equal(eot.read_band(tmp_path / "f64_multiband.tif", "heightEGM_median"), expected)
+    np.testing.assert_allclose(eot.read_band(tmp_path / "f32_multiband.tif", "heightEGM_median"), expected,
+                               rtol=0, atol=1e-4, equal_nan=True)
+
+
+def test_accumulator_matches_grid_sampling(aoi_utm, points):
+
+    # chunked accumulation gives the count and mean of gridding all points at once
+    expected = eot.grid_sampling_multi(aoi_utm, points, fields=("heightEGM",), stat_methods=("mean",),
+                                       grid_resolution=500)
+    acc = GridAccumulator.from_shapefile(aoi_utm, 500, fields=("heightEGM",))
+    for chunk in np.array_split(np.arange(len(points)), 4):
+        acc.add(points.iloc[chunk])
+    np.testing.assert_array_equal(acc.statistic("heightEGM", "count"), expected["count"])
+    np.testing.assert_allclose(acc.statistic("heightEGM", "mean"), expected["heightEGM_mean"], rtol=1e-6,
+                               equal_nan=True)
+
+    # merging the accumulators of two halves gives the same histograms as adding everything to one
+    halves = [GridAccumulator.from_shapefile(aoi_utm, 500, fields=("heightEGM",), max_bins_per_cell=4)
+              for _ in range(2)]
+    halves[0].add(points.iloc[::2])
+    halves[1].add(points.iloc[1::2])
+    merged = GridAccumulator.merged(halves)
+    np.testing.assert_array_equal(merged.statistic("heightEGM", "count"), expected["count"])
+    assert merged.hist_counts["heightEGM"].sum() == expected["count"].sum()
+    keys = merged.hist_keys["heightEGM"]
+    assert np.all(keys[1:] > keys[:-1])
+
+
+def test_accumulator_rejects_histogram_overflow(aoi_utm, points):
+
+    # bins beyond the 32 bits of the histogram keys raise instead of corrupting other cells
+    acc = GridAccumulator.from_shapefile(aoi_utm, 500, fields=("heightEGM",), bin_widths={"heightEGM": 1e-7})
+    with pytest.raises(ValueError, match="overflow"):
+        acc.add(points)
+
+
+def test_get_xy_sources_agree(aoi_utm, points):
+
+    x, y = coords.get_xy(points, aoi_utm.crs)
+    gdf = gpd.GeoDataFrame(points, geometry=gpd.points_from_xy(points.lon, points.lat), crs=coords.WGS84)
+    np.testing.assert_allclose(coords.get_xy(gdf, aoi_utm.crs), (x, y))
+    stored = coords.add_xy(points.copy(), aoi_utm.crs)
+    assert list(stored.columns[-2:]) == list(coords.xy_columns(aoi_utm.crs))
+    np.testing.assert_array_equal(coords.get_xy(stored, aoi_utm.crs), (x, y))
+    # same crs is a no-op
+    np.testing.assert_array_equal(coords.transform_xy(x, y, aoi_utm.crs, aoi_utm.crs), (x, y))
+
+
+def test_get_xy_keeps_rows_of_empty_geometries(aoi_utm, points):
+
+    # missing and empty geometries give NaN coordinates in place, and are not gridded
+    head = points.iloc[:6]
+    geometry = list(gpd.points_from_xy(head.lon, head.lat))
+    geometry[1] = None
+    geometry[4] = shapely.Point()
+    gdf = gpd.GeoDataFrame(head, geometry=geometry, crs=coords.WGS84)
+    x, y = coords.get_xy(gdf, aoi_utm.crs)
+    expected_x, expected_y = coords.get_xy(head, aoi_utm.crs)
+    assert x.shape == y.shape == (6,)
+    assert np.isnan(x[[1, 4]]).all() and np.isnan(y[[1, 4]]).all()
+    keep = [0, 2, 3, 5]
+    np.testing.assert_allclose((x[keep], y[keep]), (expected_x[keep], expected_y[keep]))
+    bands = eot.grid_sampling_multi(aoi_utm, gdf, fields=("heightEGM",), grid_resolution=500)
+    expected = eot.grid_sampling_multi(aoi_utm, head.iloc[keep], fields=("heightEGM",), grid_resolution=500)
+    np.testing.assert_array_equal(bands["count"], expected["count"])
+    np.testing.assert_array_equal(bands["heightEGM_median"], expected["heightEGM_median"])
@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+gpd = pytest.importorskip("geopandas")
+
+import pixc_io
+
+
+def _points(classes):
+    lon = [34.0 + 0.01 * i for i in range(len(classes))]
+    lat = [-8.2] * len(classes)
+    return gpd.GeoDataFrame({"lon": lon, "lat": lat, "class": classes, "heightEGM": 1030.0},
+                            geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326")
+
+
+def _name(i, day):
+    return f"SWOT_L2_HR_PIXC_010_{100 + i:03d}_100L_202401{day:02d}T000000_202401{day:02d}T000010_PID0_01_trimmed"
+
+
+def test_index_query_and_legacy_archive(tmp_path):
+
+    # two GeoParquet files, a GeoJSON converted already and a legacy GeoJSON only
+    pixc_io.write_trimmed_pixc(_points([4, 4, 3]), str(tmp_path / f"{_name(0, 1)}.parquet"))
+    pixc_io.write_trimmed_pixc(_points([3]), str(tmp_path / f"{_name(1, 2)}.parquet"))
+    _points([4]).to_file(tmp_path / f"{_name(1, 2)}.geojson", driver="GeoJSON")
+    _points([4, 4]).to_file(tmp_path / f"{_name(2, 3)}.geojson", driver="GeoJSON")
+    files = pixc_io.trimmed_files(str(tmp_path))
+    assert [f.rsplit("_trimmed", 1)[1] for f in files] == [".parquet", ".parquet", ".geojson"]
+
+    with pixc_io.PixcIndex(str(tmp_path / "pixc_index.sqlite")) as index:
+        index.add_files(files)
+        assert len(index.query()) == 3
+        open_water = index.query(classes=[4])
+        assert list(open_water["n_points"]) == [3, 2]
+        assert open_water["date"].dtype.kind == "M"
+        assert list(index.files_by_date(start="2024-01-02", passes=[101])) == [pd.Timestamp("2024-01-02").date()]
@@ -0,0 +1,170 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("geopandas")
+rasterio = pytest.importorskip("rasterio")
+pytest.importorskip("netCDF4")
+
+import composite_tools as ct
+import eo_tools as eot
+import raster_io as rio
+import temporal_aggregation as ta
+from datacube import RasterCube
+from grid_spec import GridSpec
+
+from my_library.simulation import Simulator
+
+
+@pytest.fixture(scope="module")
+def grid(aoi_utm):
+    return GridSpec.from_shapefile(aoi_utm, 2000, buffer=0.01)
+
+
+@pytest.fixture(scope="module")
+def date_products(grid, tmp_path_factory):
+    # per-date heightEGM_median/count GeoTIFFs every 5 days, heights NaN where there are no points
+    folder = tmp_path_factory.mktemp("dates")
+    rng = np.random.default_rng(0)
+    files = []
+    for i in range(40):
+        date = pd.Timestamp("2024-01-03") + pd.Timedelta(days=5 * i)
+        count = rng.poisson(2, grid.shape).astype(np.float64)
+        height = np.where(count > 0, rng.normal(1030, 2, grid.shape), np.nan).astype(np.float32).astype(np.float64)
+        path = str(folder / f"{date.date()}_res2000_multiband.tif")
+        eot.write_multiband_geotiff(path, {"heightEGM_median": height, "count": count}, grid.transform, grid.crs)
+        files.append(path)
+    return files
+
+
+def test_composite_median_matches_numpy(tmp_path):
+
+    scenes = Simulator(name="s2", seed=0).s2_stack(str(tmp_path / "s2"), n_scenes=5, height=300, width=200)
+    out_tif = str(tmp_path / "median.tif")
+    used = ct.composite_scenes(scenes, out_tif, reducer="median", block_size=128)
+    assert used == scenes
+    stack = []
+    for f in scenes:
+        with rasterio.open(f) as src:
+            stack.append(src.read())
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # pixels cloudy in every scene
+        expected = np.nanmedian(np.stack(stack), axis=0)
+    with rasterio.open(out_tif) as src:
+        np.testing.assert_allclose(src.read(), expected, equal_nan=True)
+
+
+def test_composite_records_its_scenes(tmp_path):
+
+    s2p = pytest.importorskip("s2_pipeline")
+    scenes = Simulator(name="s2", seed=0).s2_stack(str(tmp_path / "s2"), n_scenes=4, height=64, width=64)
+    out_tif = str(tmp_path / "median.tif")
+    ct.composite_scenes(scenes[:3], out_tif, block_size=32)
+    assert set(ct.recorded_scenes(out_tif)) == set(scenes[:3])
+    assert s2p.composite_up_to_date(scenes[:3], out_tif)
+    # a late scene or a removed one makes the month out of date
+    assert not s2p.composite_up_to_date(scenes, out_tif)
+    assert not s2p.composite_up_to_date(scenes[:2], out_tif)
+
+
+def test_cog_writer_removes_partial_outputs(grid, tmp_path, monkeypatch):
+
+    # a failed COG translation leaves neither the partial COG nor the temporary GeoTIFF behind
+    def failing_copy(src_path, dst_path, **kwargs):
+        with open(dst_path, "wb") as f:
+            f.write(b"partial")
+        raise rasterio.errors.RasterioIOError("disk full")
+
+    monkeypatch.setattr(rasterio.shutil, "copy", failing_copy)
+    out_tif = str(tmp_path / "out.tif")
+    writer = rio.CogWriter(out_tif, grid.ny, grid.nx, 1, grid.crs, grid.transform, tmp_dir=str(tmp_path))
+    writer.write(np.zeros(grid.shape))
+    with pytest.raises(rasterio.errors.RasterioIOError, match="disk full"):
+        writer.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_reduce_rasters_matches_numpy(date_products):
+
+    rasters, table = eot.reduce_rasters(date_products, reductions=("occurrence", "count", "mean", "max"),
+                                        band="heightEGM_median", block_size=16)
+    stack = np.stack([eot.read_band(f, "heightEGM_median") for f in date_products])
+    valid = ~np.isnan(stack)
+    np.testing.assert_array_equal(rasters["count"], valid.sum(axis=0))
+    np.testing.assert_allclose(rasters["occurrence"], valid.mean(axis=0), rtol=1e-6)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        np.testing.assert_allclose(rasters["mean"], np.nanmean(stack, axis=0), rtol=1e-6, equal_nan=True)
+        np.testing.assert_allclose(rasters["max"], np.nanmax(stack, axis=0), rtol=1e-6, equal_nan=True)
+    assert list(table["valid_pixels"]) == list(valid.sum(axis=(1, 2)))
+
+
+def test_datacube_round_trip(grid, date_products, tmp_path):
+
+    cube = RasterCube.create(str(tmp_path / "cube.nc"), grid, ["heightEGM_median", "count"])
+    for f, date in zip(date_products[:5], eot.raster_dates(date_products[:5])):
+        cube.append_geotiff(f, date)
+    assert cube.dates == [d.date() for d in eot.raster_dates(date_products[:5])]
+    np.testing.assert_array_equal(cube.read_map("count", cube.dates[2]), eot.read_band(date_products[2], "count"))
+
+    # points at opposite corners: one block over all dates, or one window per point when it is over the cap
+    x = grid.x0 + grid.resolution * np.array([0.5, grid.nx - 1.5])
+    y = grid.y0 + grid.resolution * np.array([1.5, grid.ny - 0.5])
+    one_block = cube.time_series(x, y, bands=("count",), buffer=grid.resolution)
+    per_point = cube.time_series(x, y, bands=("count",), buffer=grid.resolution, max_block_cells=grid.nx * grid.ny)
+    pd.testing.assert_frame_equal(one_block, per_point)
+    assert len(one_block) == 2 * 5 and one_block["n_valid"].gt(0).all()
+    cube.close()
+
+
+def test_temporal_levels_chain_and_update(grid, date_products, tmp_path):
+
+    # seasons and hydrological years built from cached months match those built from the dates
+    freqs = ("MS", "QS-DEC", "YS-OCT")
+    chained = ta.TemporalAggregator(date_products[:-1], str(tmp_path / "chained"))
+    chained.aggregate_levels(freqs)
+    for freq in freqs[1:]:
+        direct = ta.TemporalAggregator(date_products[:-1], str(tmp_path / f"direct_{freq}"))
+        direct.aggregate(freq)
+        a, b = chained.level(freq), direct.level(freq)
+        assert a.dates == b.dates
+        for date in a.dates:
+            for band in ("heightEGM_median", "count", "n_dates"):
+                np.testing.assert_allclose(a.read_map(band, date), b.read_map(band, date), rtol=1e-6, equal_nan=True)
+        a.close()
+        b.close()
+        direct.close()
+    chained.close()
+
+    # a new date only rebuilds the periods holding it
+    updated = ta.TemporalAggregator(date_products, str(tmp_path / "chained"))
+    level = updated.level("MS")
+    before = {d: level.read_map("count", d) for d in level.dates}
+    level.close()
+    updated.aggregate_levels(freqs)
+    level = updated.level("MS")
+    changed = [d for d in level.dates if d not in before or not np.array_equal(before[d], level.read_map("count", d))]
+    level.close()
+    updated.close()
+    last = eot.raster_dates(date_products[-1:])[0]
+    assert changed == [last.replace(day=1).date()]
+
+
+def test_extract_points_per_point_windows(grid, date_products):
+
+    # points at opposite corners read as one block or, over the cell cap, one window per point
+    gpd = pytest.importorskip("geopandas")
+    x = grid.x0 + grid.resolution * np.array([0.5, grid.nx - 1.5, 3.2])
+    y = grid.y0 + grid.resolution * np.array([1.5, grid.ny - 0.5, 2.7])
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs=grid.crs)
+    kwargs = {"buffer": grid.resolution, "band": "count", "n_threads": 4}
+    one_block = eot.extract_points_from_rasters(points, date_products[:6], **kwargs)
+    per_point = eot.extract_points_from_rasters(points, date_products[:6], max_block_cells=9, **kwargs)
+    pd.testing.assert_frame_equal(one_block, per_point)
+    counts = np.stack([eot.read_band(f, "count") for f in date_products[:6]])
+    row, col = grid.rowcol(x[:1], y[:1])
+    window = counts[:, max(row[0] - 1, 0):row[0] + 2, max(col[0] - 1, 0):col[0] + 2]
+    np.testing.assert_allclose(one_block.loc[one_block["id"] == 0, "value"], window.mean(axis=(1, 2)))
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from my_library.simulation import PIXC_CLASSES, Simulator
+
+
+def test_simulate_bounds_and_seed():
+
+    a = Simulator(name="a", low=2.0, high=10.0, seed=1).simulate(1000)
+    b = Simulator(name="b", low=2.0, high=10.0, seed=1).simulate(1000)
+    assert a.shape == (1000,)
+    assert ((a >= 2.0) & (a < 10.0)).all()
+    assert np.array_equal(a, b)
+
+
+def test_pixc_granule(tmp_path):
+
+    xr = pytest.importorskip("xarray")
+    bounds = (34.0, -8.5, 34.5, -8.0)
+    path = Simulator(name="pixc", seed=0).pixc_granule(str(tmp_path / "pixc.nc"), bounds, n_lines=100, n_pixels=50,
+                                                       water_fraction=0.4, aoi_overlap=0.5)
+    with xr.open_dataset(path, group="pixel_cloud") as nc:
+        assert nc.sizes["points"] == 5000
+        assert nc.classification.attrs["flag_meanings"].split() == list(PIXC_CLASSES)
+        classes = nc.classification.values
+        assert set(np.unique(classes)) <= set(range(1, 8))
+        assert abs((classes >= 3).mean() - 0.4) < 0.05
+        inside = (nc.latitude.values >= bounds[1]) & (nc.latitude.values <= bounds[3])
+        assert abs(inside.mean() - 0.5) < 0.05
+
+
+def test_s2_stack(tmp_path):
+
+    rasterio = pytest.importorskip("rasterio")
+    paths = Simulator(name="s2", seed=0).s2_stack(str(tmp_path), n_scenes=3, height=200, width=300, cloud_fraction=0.25)
+    assert len(paths) == 3
+    with rasterio.open(paths[0]) as src:
+        data = src.read()
+        assert (src.count, src.height, src.width) == (3, 200, 300)
+    assert abs(np.isnan(data[0]).mean() - 0.25) < 0.01
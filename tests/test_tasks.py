@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+import instrumentation as instr
+from task_scheduler import Task, run_tasks
+
+
+def _write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+def _fail():
+    raise RuntimeError("boom")
+
+
+def test_run_tasks_order_skip_and_failures(tmp_path):
+
+    a, b = str(tmp_path / "a.txt"), str(tmp_path / "b.txt")
+    tasks = [
+        Task("b", "write", _write, (b, "b"), inputs=[a], outputs=[b], deps=["a"]),
+        Task("a", "write", _write, (a, "a"), outputs=[a]),
+        Task("bad", "fail", _fail),
+        Task("after bad", "write", _write, (str(tmp_path / "c.txt"), "c"), deps=["bad"]),
+    ]
+    report = run_tasks(tasks, n_workers=1).set_index("name")
+    assert report.loc[["a", "b"], "status"].tolist() == ["done", "done"]
+    assert report.loc["a", "end"] <= report.loc["b", "start"]
+    assert report.loc["bad", "status"] == "failed"
+    assert report.loc["after bad", "status"] == "blocked"
+    assert not os.path.exists(tmp_path / "c.txt")
+
+    # outputs newer than their inputs are skipped on the next run
+    report = run_tasks(tasks[:2], n_workers=1).set_index("name")
+    assert report["status"].tolist() == ["skipped", "skipped"]
+
+
+def test_instrumentation_records_only_when_enabled():
+
+    instr.reset()
+    with instr.stage("off"):
+        instr.count("things", 3)
+    assert instr.records().empty and instr.counters() == {}
+
+    instr.enable()
+    try:
+        with instr.stage("outer"):
+            with instr.stage("inner"):
+                instr.count("things", 3)
+            instr.count("things")
+        records = instr.records()
+    finally:
+        instr.disable()
+        instr.reset()
+    assert records["stage"].tolist() == ["inner", "outer"]
+    assert records.set_index("stage").loc["inner", "parent"] == "outer"
+
+
+def test_build_tasks_checks_gif_kwargs(tmp_path):
+
+    pytest.importorskip("rasterio")
+    pytest.importorskip("PIL")
+    import s2_pipeline as s2p
+
+    # the gif needs a font, missing it fails when the tasks are built rather than after the composites
+    os.makedirs(tmp_path / "b1" / "tif")
+    with pytest.raises(ValueError, match="font_path"):
+        s2p.build_tasks(str(tmp_path), ["b1"], gif_flag=True)
+    tasks = s2p.build_tasks(str(tmp_path), ["b1"], gif_flag=True, years=(2021, 2022),
+                            gif_kwargs={"font_path": "font.ttf", "end_date": "2022-06-01"})
+    gif = next(t for t in tasks if t.stage == "gif")
+    assert gif.kwargs == {"start_date": "2021-01-01", "end_date": "2022-06-01", "font_path": "font.ttf"}